@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'OpenAiChatbot.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the app registry is ready.
+from chatbot.websocket import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # WebSocket connections (the /ws/chat/ transport) bypass Django's HTTP
+    # handler; everything else is served by Django.
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -36,10 +36,203 @@ CORS_ALLOW_ALL_ORIGINS = True  # For development only
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
-    ]
+    ],
+    # orjson when installed, else DRF's JSONRenderer; same JSON either way.
+    'DEFAULT_RENDERER_CLASSES': [
+        'chatbot.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')  # None uses the public API
+
+# Shared upstream connection pool (see chatbot/clients.py)
+OPENAI_HTTP = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,
+    'CONNECT_TIMEOUT': 5.0,
+    'TIMEOUT': 60.0,
+    'HTTP2': True,  # used only when the h2 package is installed
+}
+
+# Prompt assembly (see chatbot/context.py). POLICY is 'drop_oldest' or
+# 'keep_ends' (the first KEEP_FIRST messages plus up to KEEP_LAST recent ones).
+CHAT_CONTEXT = {
+    'DEFAULT_BUDGET': 4096,
+    'RESERVE_TOKENS': 1024,  # left free for the reply
+    'POLICY': 'drop_oldest',
+    'KEEP_FIRST': 2,
+    'KEEP_LAST': None,
+}
+
+# Rolling conversation summaries (see chatbot/summary.py). Once EVERY new
+# messages pile up beyond the KEEP_RECENT newest, the older ones are folded
+# into Conversation.summary and replaced by it in the prompt.
+CHAT_SUMMARY = {
+    'ENABLED': False,
+    'EVERY': 10,
+    'KEEP_RECENT': 6,
+    'MODEL': None,  # None uses the chat model
+    'BACKGROUND': False,  # refresh on a worker thread instead of inline
+}
+
+# Response cache in front of the upstream call (see chatbot/cache.py). The
+# semantic tier needs NumPy and reuses answers to near-identical questions.
+CHAT_RESPONSE_CACHE = {
+    'ENABLED': os.getenv('CHAT_RESPONSE_CACHE') == '1',
+    'TTL': 3600,
+    'MAX_ENTRIES': 10000,
+    'SEMANTIC': False,
+    'SEMANTIC_THRESHOLD': 0.92,
+}
+
+# Single-flight coalescing of identical in-flight prompts (see
+# chatbot/coalesce.py). BACKEND is an optional CACHES alias that extends it
+# across worker processes.
+CHAT_COALESCE = {
+    'ENABLED': True,
+    'BACKEND': None,
+    'WAIT_TIMEOUT': 60,
+}
+
+# Upstream call scheduler (see chatbot/upstream.py). Set RPM/TPM a little
+# under the account's OpenAI limits; BACKEND is an optional CACHES alias that
+# shares the budget between worker processes. Calls that would wait more than
+# MAX_WAIT seconds for the budget are turned away with a 503.
+CHAT_UPSTREAM = {
+    'RPM': None,
+    'TPM': None,
+    'MAX_WAIT': 30.0,
+    'BACKEND': None,
+    'MAX_RETRIES': 4,
+    'BREAKER_THRESHOLD': 5,
+    'BREAKER_COOLDOWN': 30.0,
+}
+
+# Model routing (see chatbot/routing.py). Routes are tried cheapest TIER
+# first, skipping those whose MAX_PROMPT_TOKENS the prompt exceeds, and fail
+# over down the list on errors or after TIMEOUT seconds. Routes may point at
+# another endpoint with BASE_URL/API_KEY. Example:
+#     {'NAME': 'mini', 'MODEL': 'gpt-4o-mini', 'MAX_PROMPT_TOKENS': 4000},
+#     {'NAME': 'full', 'MODEL': 'gpt-4o', 'TIER': 1, 'TIMEOUT': 30},
+CHAT_ROUTING = {
+    'ROUTES': [
+        {'NAME': 'default', 'MODEL': 'gpt-3.5-turbo'},
+    ],
+    'PREFER_FASTER': True,
+    'SLOW_P95': None,
+}
+
+# Background chat jobs (see chatbot/jobs.py), requested with
+# "background": true. BACKEND 'thread' runs them in an in-process pool;
+# 'database' leaves them queued for `python manage.py run_chat_jobs`.
+CHAT_JOBS = {
+    'BACKEND': os.environ.get('CHAT_JOBS_BACKEND', 'thread'),
+    'WORKERS': 4,
+}
+
+# Job webhooks (see chatbot/webhooks.py): refused until SECRET is set, and
+# signed with it. ALLOWED_HOSTS limits where they go; left empty, any host
+# with only public addresses.
+CHAT_WEBHOOKS = {
+    'SECRET': os.getenv('CHAT_WEBHOOK_SECRET'),
+    'ALLOWED_HOSTS': [],
+}
+
+# Batch processing (see chatbot/batch.py): `manage.py chat_batch` and
+# POST /api/chat/batch/. DIR holds the endpoint's resumable outputs.
+CHAT_BATCH = {
+    'CONCURRENCY': 8,
+    'CHUNK_SIZE': 200,
+    'DIR': BASE_DIR / 'batches',
+}
+
+# WebSocket transport at /ws/chat/ (see chatbot/websocket.py), served by the
+# ASGI app only.
+CHAT_WEBSOCKET = {
+    'HEARTBEAT_INTERVAL': 20,
+    'MAX_MESSAGE_BYTES': 64 * 1024,
+}
+
+# Stopping generations through POST /api/chat/cancel/ (see
+# chatbot/cancellation.py). Set BACKEND to a shared CACHES alias when running
+# several worker processes, so a cancel reaches whichever one holds the stream.
+CHAT_CANCELLATION = {
+    'BACKEND': None,
+    'POLL_INTERVAL': 0.5,
+}
+
+# Per-stage timings, token counts and spend (see chatbot/metrics.py), served
+# for Prometheus at /metrics and summarised in a Server-Timing header. PRICES
+# are USD per 1000 tokens by model.
+CHAT_METRICS = {
+    'ENABLED': os.environ.get('CHAT_METRICS', '1') == '1',
+    'SERVER_TIMING': True,
+    'PRICES': {
+        'gpt-3.5-turbo': {'PROMPT': 0.0005, 'COMPLETION': 0.0015},
+    },
+}
+
+# Full-text search at /api/search/ (see chatbot/search.py). BACKEND None picks
+# SQLite FTS5 or PostgreSQL full-text search to match the database.
+CHAT_SEARCH = {
+    'BACKEND': None,
+    'SNIPPET_WORDS': 12,
+}
+
+# Retention (see chatbot/retention.py): `manage.py archive_conversations`
+# moves conversations idle past ARCHIVE_AFTER_DAYS into compressed JSONL files
+# under DIR and deletes them from the database in small batches. An archived
+# session is restored when it is used again.
+CHAT_RETENTION = {
+    'ARCHIVE_AFTER_DAYS': 90,
+    'PURGE_AFTER_DAYS': None,
+    'DIR': BASE_DIR / 'archive',
+    'COMPRESSION': 'gzip',
+    'CHUNK_SIZE': 200,
+    'DELETE_BATCH': 500,
+}
+
+# Serialization of conversation responses (see chatbot/rows.py). FAST maps
+# .values() rows instead of running the ModelSerializers; JSON responses of
+# COMPRESS_MIN_BYTES or more are sent brotli- or gzip-compressed.
+CHAT_SERIALIZATION = {
+    'FAST': True,
+    'COMPRESS_MIN_BYTES': 16 * 1024,
+}
+
+# The chat UI pages (see chatbot/ui.py): rendered once per process, sent
+# precompressed, and revalidated by ETag.
+CHAT_UI = {
+    'PAGE_CACHE': True,
+    'ASSET_MAX_AGE': 365 * 24 * 3600,
+}
+
+# Token quotas (see chatbot/quotas.py): upstream tokens per WINDOW seconds for
+# each authenticated user, chat session and client address (None: no limit).
+# Set BACKEND to a shared CACHES alias with several worker processes, and
+# IP_HEADER to e.g. 'HTTP_X_REAL_IP' behind a reverse proxy. Usage is written
+# to the TokenUsage table every FLUSH_INTERVAL seconds.
+CHAT_QUOTAS = {
+    'USER_TOKENS': None,
+    'SESSION_TOKENS': None,
+    'IP_TOKENS': None,
+    'WINDOW': 3600,
+    'BACKEND': None,
+    'IP_HEADER': 'REMOTE_ADDR',
+    'FLUSH_INTERVAL': 60,
+}
+
+# Per-session history cache (see chatbot/history.py). BACKEND is an optional
+# CACHES alias shared between worker processes; the local LRU is always used,
+# checked against a generation counter in BACKEND so edits reach every worker.
+CHAT_HISTORY_CACHE = {
+    'MAX_SESSIONS': 1024,
+    'BACKEND': None,
+    'TIMEOUT': 3600,
+}
 
 
 
@@ -60,6 +253,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'chatbot.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -101,9 +295,28 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock at BEGIN so a transaction that reads first
+            # waits in the busy handler instead of failing with "database is
+            # locked" when it later writes.
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# SQLite production mode (see chatbot/sqlite.py): pragmas applied to every
+# new connection, plus an optional single writer thread for chat turns.
+# Off unless SQLITE_TUNING=1: WAL mode persists in the database file.
+SQLITE_TUNING = {
+    'ENABLED': os.getenv('SQLITE_TUNING') == '1',
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'BUSY_TIMEOUT_MS': 5000,
+    'CACHE_SIZE_KB': 64 * 1024,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'SERIALIZE_WRITES': os.getenv('SQLITE_SERIALIZE_WRITES') == '1',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -140,3 +353,11 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic writes content-hashed names plus .gz/.br copies (see
+# chatbot/storage.py), served with far-future cache headers by chatbot.ui.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'chatbot.storage.CompressedManifestStaticFilesStorage'},
+}
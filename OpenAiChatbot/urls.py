@@ -17,10 +17,16 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
+from chatbot.ui import static_file
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('chatbot.urls')),
+    # Collected static files, fingerprinted and precompressed; a proxy or
+    # CDN in front can serve STATIC_ROOT itself instead.
+    path(f"{settings.STATIC_URL.lstrip('/')}<path:path>", static_file, name='static-file'),
 ]
@@ -0,0 +1,259 @@
+import copy
+import json
+import os
+import queue
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .history import HISTORY_FIELDS, CachedMessage, history_cache
+from .models import Conversation, Message
+from .quotas import Account, QuotaExceeded
+from .retention import archived_sessions, restore
+from .services import ChatbotService
+
+
+DEFAULT_BATCH_SETTINGS = {
+    'CONCURRENCY': 8,
+    'CHUNK_SIZE': 200,
+    # Where the batch endpoint keeps each run's output, for resuming.
+    # Defaults to BASE_DIR/batches.
+    'DIR': None,
+}
+
+
+def batch_settings():
+    return {**DEFAULT_BATCH_SETTINGS, **getattr(settings, 'CHAT_BATCH', {})}
+
+
+def output_path(batch_id):
+    directory = batch_settings()['DIR'] or os.path.join(settings.BASE_DIR, 'batches')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{batch_id}.jsonl')
+
+
+OK = 'ok'
+ERROR = 'error'
+
+
+def parse_records(lines, skip=()):
+    """Yield ``(line, session_id, message, error)`` for each non-blank input
+    line not in ``skip``. Records without a session id get a new one."""
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode()
+        if number in skip or not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            message = record['message']
+            if not isinstance(message, str) or not message:
+                raise ValueError("message must be a non-empty string")
+        except (ValueError, TypeError, KeyError) as e:
+            yield number, None, None, f"Invalid record: {e}"
+            continue
+        yield number, str(record.get('session_id') or uuid.uuid4()), message, None
+
+
+def completed_lines(path, retry_failed=False):
+    # Input lines already answered by an earlier run writing to ``path``.
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as output:
+        for line in output:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash.
+                continue
+            if result['status'] == OK or not retry_failed:
+                done.add(result['line'])
+    return done
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BatchRunner:
+    """Answers a stream of chat records with bounded concurrency.
+
+    Records are taken ``chunk_size`` at a time. For each chunk, conversations
+    are fetched (archived ones restored, missing ones created) with one
+    query each, and the history cache is primed with one query for every
+    conversation it lacks.
+    Records of the same session are answered in input order by one worker;
+    different sessions run on up to ``concurrency`` threads. Results are
+    yielded as each record finishes, not in input order.
+    When the service has an account, each record is checked against its
+    quotas, and its session's, before it is answered; records over quota
+    fail with a ``retry_after``.
+    """
+
+    def __init__(self, concurrency=None, chunk_size=None, use_cache=True, service=None):
+        config = batch_settings()
+        self.concurrency = concurrency or config['CONCURRENCY']
+        self.chunk_size = chunk_size or config['CHUNK_SIZE']
+        self.use_cache = use_cache
+        self.service = service or ChatbotService()
+        self.stop = threading.Event()
+
+    def results(self, records):
+        pool = None
+        if self.concurrency > 1:
+            pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='chat-batch')
+        try:
+            for chunk in chunked(records, self.chunk_size):
+                invalid, groups = self.prepare(chunk)
+                yield from invalid
+                if pool is None:
+                    for group in groups:
+                        yield from self.answer_group(group)
+                else:
+                    yield from self.answer_concurrently(pool, groups)
+                if self.stop.is_set():
+                    return
+        finally:
+            # Also reached when the consumer goes away (e.g. the client of
+            # the batch endpoint disconnects): no new records are started.
+            self.stop.set()
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def prepare(self, chunk):
+        invalid = []
+        groups = defaultdict(list)
+        for number, session_id, message, error in chunk:
+            if error:
+                invalid.append({'line': number, 'status': ERROR, 'error': error})
+            else:
+                groups[session_id].append((number, message))
+
+        conversations = Conversation.objects.in_bulk(groups, field_name='session_id')
+        absent = groups.keys() - conversations.keys()
+        for session_id in archived_sessions(absent) if absent else ():
+            if (conversation := restore(session_id)) is not None:
+                conversations[session_id] = conversation
+        missing = [
+            Conversation(session_id=session_id) for session_id in groups.keys() - conversations.keys()
+        ]
+        if missing:
+            Conversation.objects.bulk_create(missing, ignore_conflicts=True)
+            conversations.update(Conversation.objects.in_bulk(
+                [conversation.session_id for conversation in missing], field_name='session_id'
+            ))
+
+        # One query for the history of every conversation the cache lacks.
+        cold = {}
+        for conversation in conversations.values():
+            generation, history = history_cache.lookup(conversation.session_id)
+            if history is None:
+                cold[conversation] = generation
+        if cold:
+            histories = defaultdict(list)
+            rows = (
+                Message.objects.filter(conversation__in=list(cold))
+                .order_by('conversation_id', 'pk')
+                .values_list('conversation_id', *HISTORY_FIELDS)
+            )
+            for conversation_id, *fields in rows:
+                histories[conversation_id].append(CachedMessage(*fields))
+            for conversation, generation in cold.items():
+                history_cache.set(conversation.session_id, histories[conversation.pk], generation)
+
+        return invalid, [(conversations[session_id], items) for session_id, items in groups.items()]
+
+    def service_for(self, conversation):
+        # A copy of the service charging the conversation's session too.
+        account = self.service.account
+        if account is None:
+            return self.service
+        service = copy.copy(self.service)
+        service.account = Account(account.user_id, conversation.session_id, account.ip)
+        return service
+
+    def answer_group(self, group):
+        conversation, items = group
+        service = self.service_for(conversation)
+        for number, message in items:
+            if self.stop.is_set():
+                return
+            try:
+                if service.account is not None:
+                    service.account.check()
+                result = service.reply(conversation, message, self.use_cache)
+            except QuotaExceeded as e:
+                result = {
+                    'error': str(e), 'retry_after': e.retry_after, 'session_id': conversation.session_id
+                }
+            except Exception as e:
+                result = {'error': str(e), 'session_id': conversation.session_id}
+            yield {'line': number, 'status': ERROR if 'error' in result else OK, **result}
+
+    def answer_concurrently(self, pool, groups):
+        done = object()
+        results = queue.SimpleQueue()
+
+        def work(group):
+            try:
+                for result in self.answer_group(group):
+                    results.put(result)
+            finally:
+                results.put(done)
+                close_old_connections()
+
+        for group in groups:
+            pool.submit(work, group)
+        remaining = len(groups)
+        while remaining:
+            result = results.get()
+            if result is done:
+                remaining -= 1
+            else:
+                yield result
+
+
+class ResultWriter:
+    """Appends results to a JSONL file, flushed per line so a crashed run
+    can resume from what it wrote."""
+
+    def __init__(self, path):
+        self._file = open(path, 'a+')
+        # Terminate a line a crash cut short, so it stays one bad line.
+        if self._file.tell():
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != '\n':
+                self._file.write('\n')
+
+    def write(self, result):
+        self._file.write(json.dumps(result) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def run_batch(lines, path, retry_failed=False, **options):
+    """Answer the JSONL ``lines`` into the file at ``path``, skipping records
+    an earlier run already answered there. Yields each result as written."""
+    skip = completed_lines(path, retry_failed)
+    runner = BatchRunner(**options)
+    writer = ResultWriter(path)
+    try:
+        for result in runner.results(parse_records(lines, skip)):
+            writer.write(result)
+            yield result
+    finally:
+        writer.close()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.test import override_settings
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    # Benchmarks run against a throwaway test database so they never touch
+    # real conversations. SQLite gets a file instead of the shared in-memory
+    # test database so worker threads can open their own connections.
+    from chatbot.quotas import quota_settings, quotas
+
+    if connection.vendor == 'sqlite':
+        handle, path = tempfile.mkstemp(prefix='chatbot-bench-', suffix='.sqlite3')
+        os.close(handle)
+        connection.settings_dict['TEST']['NAME'] = path
+
+    old_name = connection.creation.create_test_db(
+        verbosity=verbosity, autoclobber=True, serialize=False
+    )
+    # No token usage recorded: the ledger would write it after the database
+    # is gone.
+    try:
+        with override_settings(CHAT_QUOTAS={**quota_settings(), 'FLUSH_INTERVAL': None}):
+            yield
+    finally:
+        quotas.ledger.discard()
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+def seed_conversations(count, size, chunk=50):
+    """Bulk-insert ``count`` conversations of ``size`` messages each and
+    return their session ids. Messages of ``chunk`` conversations are
+    interleaved, as they would be with concurrent sessions."""
+    from chatbot.models import Conversation, Message
+
+    session_ids = []
+    while len(session_ids) < count:
+        batch = min(chunk, count - len(session_ids))
+        with transaction.atomic():
+            conversations = Conversation.objects.bulk_create([
+                Conversation(session_id=str(uuid.uuid4()), last_seq=size) for _ in range(batch)
+            ])
+            Message.objects.bulk_create([
+                Message(
+                    conversation=conversation,
+                    role='user' if seq % 2 else 'assistant',
+                    content=f'Seeded message {seq}',
+                    token_count=8,
+                    seq=seq,
+                )
+                for seq in range(1, size + 1)
+                for conversation in conversations
+            ], batch_size=5000)
+        session_ids.extend(conversation.session_id for conversation in conversations)
+    return session_ids
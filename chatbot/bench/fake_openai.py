@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'Not found'}})
+            return
+
+        fake.record_request(body)
+        time.sleep(fake.latency)
+
+        failure = fake.next_failure()
+        if failure is not None:
+            status, retry_after = failure
+            headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+            self.send_json(status, {'error': {'message': 'Injected failure', 'type': 'fake'}}, headers)
+            return
+
+        if body.get('stream'):
+            self.send_stream(body)
+        else:
+            # Generation time at the configured token rate.
+            time.sleep(fake.token_delay * len(fake.reply.split()))
+            self.send_json(200, fake.completion(body))
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, body):
+        fake = self.server.fake
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            for chunk in fake.stream_chunks(body):
+                self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                time.sleep(fake.token_delay)
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream before the end.
+            fake.record_abort()
+            self.close_connection = True
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer:
+    """OpenAI-compatible chat completions server for tests and benchmarks.
+
+    Serves ``POST /v1/chat/completions`` from a background thread, sleeping
+    ``latency`` seconds before answering with ``reply`` (as a single JSON
+    completion or, when ``stream`` is requested, one SSE chunk per word).
+    Each word takes ``token_delay`` seconds to generate, streamed or not, so
+    ``token_delay = 1 / tokens_per_second``. ``aborted`` counts streams the
+    client closed before the end.
+    Point the app at it with ``OPENAI_BASE_URL = server.url``.
+
+    ``fail(count, status, retry_after)`` makes the next ``count`` requests
+    fail with ``status`` (429 by default) and an optional Retry-After header.
+    """
+
+    def __init__(self, latency=0.0, reply="This is a fake reply.", host='127.0.0.1', port=0,
+                 token_delay=0.0):
+        self.latency = latency
+        self.reply = reply
+        self.token_delay = token_delay
+        self.aborted = 0
+        self.requests = []
+        self.failures = []
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.request_queue_size = 1024
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def record_request(self, body):
+        with self._lock:
+            self.requests.append(body)
+
+    def record_abort(self):
+        with self._lock:
+            self.aborted += 1
+
+    def fail(self, count=1, status=429, retry_after=None):
+        with self._lock:
+            self.failures.extend([(status, retry_after)] * count)
+
+    def next_failure(self):
+        with self._lock:
+            return self.failures.pop(0) if self.failures else None
+
+    def usage(self, body):
+        prompt_tokens = sum(
+            len(str(message.get('content', '')).split()) for message in body.get('messages', [])
+        )
+        completion_tokens = len(self.reply.split())
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+
+    def completion(self, body):
+        return {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.reply},
+                'finish_reason': 'stop',
+            }],
+            'usage': self.usage(body),
+        }
+
+    def stream_chunks(self, body):
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            yield {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{
+                    'index': 0,
+                    'delta': {'content': word if i == 0 else ' ' + word},
+                    'finish_reason': None,
+                }],
+            }
+        if (body.get('stream_options') or {}).get('include_usage'):
+            yield {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [],
+                'usage': self.usage(body),
+            }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,180 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django.test import Client
+
+from . import percentile
+
+
+class Scenario:
+    """One kind of request issued over and over by the load runner.
+
+    ``sessions`` are the session ids of the seeded conversations.
+    """
+
+    name = None
+
+    def __init__(self, sessions, options):
+        self.sessions = sessions
+        self.options = options
+
+    def request(self, client, i):
+        raise NotImplementedError
+
+    def chat(self, client, message, session_id=None):
+        payload = {'message': message, 'cache': False}
+        if session_id:
+            payload['session_id'] = session_id
+        return client.post('/api/chat/', json.dumps(payload), content_type='application/json')
+
+
+class NewSessions(Scenario):
+    # First turns of new conversations.
+    name = 'new_sessions'
+
+    def request(self, client, i):
+        return self.chat(client, f'Load question {i}')
+
+
+class LongSessions(Scenario):
+    # Further turns of seeded conversations, each --seed-size messages long,
+    # spread so no two requests in flight share a conversation.
+    name = 'long_sessions'
+
+    def request(self, client, i):
+        return self.chat(client, f'Follow-up question {i}', self.sessions[i % len(self.sessions)])
+
+
+class HistoryListing(Scenario):
+    # Alternates the conversation list and one conversation's messages.
+    name = 'history_listing'
+
+    def request(self, client, i):
+        if i % 2:
+            return client.get('/api/conversations/')
+        session_id = self.sessions[i % len(self.sessions)]
+        return client.get(f'/api/conversations/{session_id}/messages/')
+
+
+class ConcurrentWrites(Scenario):
+    # Every request appends to one of a few hot conversations, so turns
+    # contend for the same rows.
+    name = 'concurrent_writes'
+
+    def request(self, client, i):
+        hot = self.sessions[:self.options['hot_sessions']]
+        return self.chat(client, f'Contended question {i}', hot[i % len(hot)])
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (
+    NewSessions, LongSessions, HistoryListing, ConcurrentWrites
+)}
+
+
+def run_scenario(scenario, requests, concurrency):
+    """Issue ``requests`` requests of ``scenario``, ``concurrency`` at a time,
+    and return its report row."""
+    local = threading.local()
+    lock = threading.Lock()
+    outcomes = []
+
+    def call(i):
+        # One client and one query counter per thread; the counter wraps the
+        # thread's own database connection.
+        if not hasattr(local, 'client'):
+            local.client = Client()
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = scenario.request(local.client, i)
+        elapsed = time.perf_counter() - started
+        with lock:
+            outcomes.append((elapsed, response.status_code, queries[0]))
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench-load') as pool:
+            list(pool.map(call, range(requests)))
+    else:
+        for i in range(requests):
+            call(i)
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _, _ in outcomes]
+    return {
+        'requests': len(outcomes),
+        'rps': len(outcomes) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'queries_per_request': sum(queries for _, _, queries in outcomes) / len(outcomes),
+        'errors': sum(status_code >= 400 for _, status_code, _ in outcomes),
+    }
+
+
+def run_scenarios(names, sessions, options):
+    results = {}
+    for name in names:
+        scenario = SCENARIOS[name](random.sample(sessions, len(sessions)), options)
+        results[name] = run_scenario(scenario, options['requests'], options['concurrency'])
+    return results
+
+
+# Allowed growth in queries per request before it counts as a regression;
+# counts are near-deterministic, so this only absorbs cache warm-up noise.
+QUERY_SLACK = 0.5
+
+
+def regressions(results, baseline, parameters, tolerance):
+    """Compare ``results`` with the stored ``baseline`` runs made with the
+    same ``parameters``. Returns one line per metric that got worse by more
+    than ``tolerance`` (a fraction)."""
+    found = []
+    for name, result in results.items():
+        entry = baseline.get(name)
+        if entry is None or entry['parameters'] != parameters:
+            continue
+        before = entry['result']
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            found.append(f"{name}: rps {result['rps']:.1f} < baseline {before['rps']:.1f}")
+        for key in ('p95', 'p99'):
+            if result[key] > before[key] * (1 + tolerance):
+                found.append(
+                    f"{name}: {key} {result[key] * 1000:.1f}ms > baseline {before[key] * 1000:.1f}ms"
+                )
+        if result['queries_per_request'] > before['queries_per_request'] + QUERY_SLACK:
+            found.append(
+                f"{name}: {result['queries_per_request']:.1f} queries/request"
+                f" > baseline {before['queries_per_request']:.1f}"
+            )
+        if result['errors'] > before['errors']:
+            found.append(f"{name}: {result['errors']} errors > baseline {before['errors']}")
+    return found
+
+
+def load_baseline(path):
+    # {scenario: {'parameters': {...}, 'result': {...}}}
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baseline(path, results, parameters):
+    # Entries of scenarios not run this time are kept.
+    baseline = load_baseline(path)
+    for name, result in results.items():
+        baseline[name] = {'parameters': parameters, 'result': result}
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write('\n')
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+DEFAULT_CACHE_SETTINGS = {
+    'ENABLED': False,
+    'TTL': 3600,
+    'MAX_ENTRIES': 10000,
+    'SEMANTIC': False,
+    'SEMANTIC_THRESHOLD': 0.92,
+    'SEMANTIC_MAX_ENTRIES': 5000,
+    'EMBEDDER': 'chatbot.cache.hashed_embedding',
+    'EMBEDDING_DIM': 512,
+}
+
+
+def cache_settings():
+    return {**DEFAULT_CACHE_SETTINGS, **getattr(settings, 'CHAT_RESPONSE_CACHE', {})}
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def prompt_key(model, messages):
+    """Hash of the model and the full prompt, insensitive to case and spacing."""
+    payload = json.dumps(
+        [model, [[message['role'], normalize(message['content'])] for message in messages]]
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+_token = re.compile(r'\w+')
+
+
+def hashed_embedding(text, dim):
+    # Local, dependency-free embedding: hashed word unigrams plus character
+    # trigrams, L2-normalised. Swap in a real model through EMBEDDER.
+    vector = np.zeros(dim, dtype=np.float32)
+    words = _token.findall(normalize(text))
+    for word in words:
+        vector[zlib.crc32(word.encode()) % dim] += 1.0
+        padded = f' {word} '
+        for i in range(len(padded) - 2):
+            vector[zlib.crc32(padded[i:i + 3].encode()) % dim] += 0.5
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+
+class ExactCache:
+    """LRU of prompt hash -> reply, with entries expiring after TTL seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, reply = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return reply
+
+    def set(self, key, reply, ttl, max_entries, now):
+        with self._lock:
+            self._entries[key] = (now + ttl, reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SemanticIndex:
+    """In-process nearest-neighbour index over prompt embeddings.
+
+    Vectors live in one preallocated matrix so a lookup is a single
+    matrix-vector product. Entries are partitioned by ``scope`` (a hash of
+    everything in the prompt except the question itself) so answers are only
+    reused under the same context. When full, the least recently used slot
+    is overwritten; expired entries never match.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dim = None
+
+    def _allocate(self, size, dim):
+        self._dim = dim
+        self._vectors = np.zeros((size, dim), dtype=np.float32)
+        self._expires = np.zeros(size)
+        self._used = np.zeros(size)
+        self._scopes = np.zeros(size, dtype=np.int64)
+        self._replies = [None] * size
+
+    def search(self, scope, vector, threshold, now):
+        with self._lock:
+            if self._dim != len(vector):
+                return None
+            scores = self._vectors @ vector
+            live = (self._expires > now) & (self._scopes == scope)
+            scores[~live] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            self._used[best] = now
+            return self._replies[best]
+
+    def add(self, scope, vector, reply, ttl, size, now):
+        with self._lock:
+            if self._dim != len(vector) or len(self._replies) != size:
+                self._allocate(size, len(vector))
+            # Expired slots go first, then the least recently used.
+            slot = int(np.argmin(np.where(self._expires > now, self._used, -1.0)))
+            self._vectors[slot] = vector
+            self._expires[slot] = now + ttl
+            self._used[slot] = now
+            self._scopes[slot] = scope
+            self._replies[slot] = reply
+
+    def clear(self):
+        with self._lock:
+            self._dim = None
+
+
+class ResponseCache:
+    """Two-tier cache of assistant replies in front of the upstream call.
+
+    The exact tier matches the whole prompt by hash. The optional semantic
+    tier (needs NumPy) matches the last user message by embedding
+    similarity among prompts that share the rest of their context.
+    """
+
+    def __init__(self):
+        self.exact = ExactCache()
+        self.semantic = SemanticIndex()
+        self.stats = CacheStats()
+
+    def _semantic_query(self, model, messages, config):
+        if not config['SEMANTIC'] or np is None or messages[-1]['role'] != 'user':
+            return None, None
+        embed = import_string(config['EMBEDDER'])
+        # The context hash, shortened to fit an int64 slot of the index.
+        scope = int(prompt_key(model, messages[:-1])[:15], 16)
+        return scope, embed(messages[-1]['content'], config['EMBEDDING_DIM'])
+
+    def get(self, model, messages):
+        config = cache_settings()
+        if not config['ENABLED']:
+            return None
+        now = time.monotonic()
+
+        reply = self.exact.get(prompt_key(model, messages), now)
+        if reply is not None:
+            self.stats.record('exact_hits')
+            return reply
+
+        scope, vector = self._semantic_query(model, messages, config)
+        if vector is not None:
+            reply = self.semantic.search(scope, vector, config['SEMANTIC_THRESHOLD'], now)
+            if reply is not None:
+                self.stats.record('semantic_hits')
+                return reply
+
+        self.stats.record('misses')
+        return None
+
+    def set(self, model, messages, reply):
+        config = cache_settings()
+        if not config['ENABLED'] or not reply:
+            return
+        now = time.monotonic()
+        self.exact.set(prompt_key(model, messages), reply, config['TTL'], config['MAX_ENTRIES'], now)
+
+        scope, vector = self._semantic_query(model, messages, config)
+        if vector is not None:
+            self.semantic.add(
+                scope, vector, reply, config['TTL'], config['SEMANTIC_MAX_ENTRIES'], now
+            )
+
+    def clear(self):
+        self.exact.clear()
+        self.semantic.clear()
+        self.stats.reset()
+
+
+response_cache = ResponseCache()
+
+
+def cache_stats():
+    return response_cache.stats.snapshot()
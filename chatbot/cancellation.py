@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+DEFAULT_CANCELLATION_SETTINGS = {
+    # Django cache alias through which cancel requests reach generations
+    # running in other worker processes. None: this process only.
+    'BACKEND': None,
+    # Seconds between checks of BACKEND while a generation runs.
+    'POLL_INTERVAL': 0.5,
+    # How long a cancel request stays visible in BACKEND.
+    'TIMEOUT': 300,
+}
+
+
+def cancellation_settings():
+    return {**DEFAULT_CANCELLATION_SETTINGS, **getattr(settings, 'CHAT_CANCELLATION', {})}
+
+
+def cancel_key(session_id):
+    return f'chatbot:cancel:{session_id}'
+
+
+class GenerationCancelled(Exception):
+    """The generation was stopped through ``generations.cancel``."""
+
+
+class Generation:
+    """One reply being generated for ``session_id``.
+
+    ``cancel`` may be called from any thread. Sync callers poll
+    ``cancelled`` between upstream chunks; async callers also run their
+    upstream awaits through ``run``, whose task is cancelled at once, so
+    the HTTP request to the upstream is aborted mid-flight.
+    """
+
+    def __init__(self, session_id, config):
+        self.session_id = session_id
+        self.config = config
+        self.started = time.time()
+        self._event = threading.Event()
+        self._task = None
+        self._checked = time.monotonic()
+
+    def cancel(self):
+        self._event.set()
+        task = self._task
+        if task is not None:
+            try:
+                task.get_loop().call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # Its event loop has already closed.
+                pass
+
+    def _poll_due(self):
+        if not self.config['BACKEND'] or self._event.is_set():
+            return False
+        now = time.monotonic()
+        if now - self._checked < self.config['POLL_INTERVAL']:
+            return False
+        self._checked = now
+        return True
+
+    def _requested(self, requested_at):
+        # Only cancel requests made after this generation started count.
+        if requested_at is not None and requested_at >= self.started:
+            self._event.set()
+
+    def cancelled(self):
+        if self._poll_due():
+            self._requested(caches[self.config['BACKEND']].get(cancel_key(self.session_id)))
+        return self._event.is_set()
+
+    async def acancelled(self):
+        if self._poll_due():
+            self._requested(await caches[self.config['BACKEND']].aget(cancel_key(self.session_id)))
+        return self._event.is_set()
+
+    async def _watch(self):
+        while not await self.acancelled():
+            await asyncio.sleep(self.config['POLL_INTERVAL'])
+        self.cancel()
+
+    async def run(self, coro):
+        # Awaits ``coro`` as a task ``cancel`` can interrupt. Raises
+        # GenerationCancelled for a cancel request; a CancelledError aimed
+        # at the caller itself (client disconnect) propagates unchanged.
+        if self._event.is_set():
+            coro.close()
+            raise GenerationCancelled()
+        self._task = asyncio.ensure_future(coro)
+        watcher = asyncio.create_task(self._watch()) if self.config['BACKEND'] else None
+        try:
+            return await self._task
+        except asyncio.CancelledError:
+            if self._event.is_set() and not asyncio.current_task().cancelling():
+                raise GenerationCancelled() from None
+            raise
+        finally:
+            self._task = None
+            if watcher is not None:
+                watcher.cancel()
+
+
+class GenerationRegistry:
+    """Generations in progress in this process, by session id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generations = defaultdict(set)
+
+    @contextmanager
+    def track(self, session_id):
+        generation = Generation(session_id, cancellation_settings())
+        with self._lock:
+            self._generations[session_id].add(generation)
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                active = self._generations[session_id]
+                active.discard(generation)
+                if not active:
+                    del self._generations[session_id]
+
+    def active(self, session_id):
+        with self._lock:
+            return len(self._generations.get(session_id, ()))
+
+    def cancel(self, session_id):
+        # Returns how many generations of this process were stopped. With
+        # BACKEND, other processes see the request at their next poll.
+        config = cancellation_settings()
+        if config['BACKEND']:
+            caches[config['BACKEND']].set(cancel_key(session_id), time.time(), config['TIMEOUT'])
+        with self._lock:
+            active = list(self._generations.get(session_id, ()))
+        for generation in active:
+            generation.cancel()
+        return len(active)
+
+
+generations = GenerationRegistry()
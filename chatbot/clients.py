@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from . import metrics
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+DEFAULT_HTTP_SETTINGS = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,
+    'CONNECT_TIMEOUT': 5.0,
+    'TIMEOUT': 60.0,
+    'HTTP2': True,
+    # Retries are left to the upstream scheduler (chatbot.upstream), which
+    # also paces requests and honours Retry-After.
+    'MAX_RETRIES': 0,
+}
+
+
+def http_settings():
+    return {**DEFAULT_HTTP_SETTINGS, **getattr(settings, 'OPENAI_HTTP', {})}
+
+
+class ConnectionStats:
+    """Counts upstream requests and how many of them opened a new connection.
+
+    httpcore only emits ``connection.connect_tcp`` trace events when a request
+    cannot be served from the keep-alive pool, so everything else is reuse.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self.trace
+
+    async def aon_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self.atrace
+
+    def trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self.new_connections += 1
+
+    async def atrace(self, event_name, info):
+        self.trace(event_name, info)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': self.requests - self.new_connections,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.new_connections = 0
+
+
+class ClientRegistry:
+    """Process-wide, lazily built OpenAI clients sharing one connection pool.
+
+    Sync clients are shared by every thread. Async clients are kept per event
+    loop, because httpx connections cannot move between loops.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.stats = ConnectionStats()
+
+    def _client_kwargs(self):
+        config = http_settings()
+        return config, {
+            'limits': httpx.Limits(
+                max_connections=config['MAX_CONNECTIONS'],
+                max_keepalive_connections=config['MAX_KEEPALIVE_CONNECTIONS'],
+                keepalive_expiry=config['KEEPALIVE_EXPIRY'],
+            ),
+            'timeout': httpx.Timeout(config['TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+            'http2': config['HTTP2'] and HTTP2_AVAILABLE,
+        }
+
+    def _key(self, factory, api_key, base_url):
+        return (factory, api_key or settings.OPENAI_API_KEY, base_url or settings.OPENAI_BASE_URL)
+
+    def get(self, factory=OpenAI, api_key=None, base_url=None):
+        # api_key and base_url default to the OPENAI_* settings.
+        key = self._key(factory, api_key, base_url)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                config, kwargs = self._client_kwargs()
+                http_client = DefaultHttpxClient(
+                    event_hooks={
+                        'request': [self.stats.on_request, metrics.upstream_request],
+                        'response': [metrics.upstream_response],
+                    },
+                    **kwargs
+                )
+                client = factory(
+                    api_key=key[1],
+                    base_url=key[2],
+                    http_client=http_client,
+                    max_retries=config['MAX_RETRIES'],
+                )
+                self._clients[key] = client
+        return client
+
+    def get_async(self, factory=AsyncOpenAI, api_key=None, base_url=None):
+        loop = asyncio.get_running_loop()
+        key = self._key(factory, api_key, base_url)
+
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                config, kwargs = self._client_kwargs()
+                http_client = DefaultAsyncHttpxClient(
+                    event_hooks={
+                        'request': [self.stats.aon_request, metrics.aupstream_request],
+                        'response': [metrics.aupstream_response],
+                    },
+                    **kwargs
+                )
+                client = factory(
+                    api_key=key[1],
+                    base_url=key[2],
+                    http_client=http_client,
+                    max_retries=config['MAX_RETRIES'],
+                )
+                clients[key] = client
+        return client
+
+    def reset(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._async_clients = weakref.WeakKeyDictionary()
+        for client in clients:
+            if isinstance(client, OpenAI):
+                client.close()
+        self.stats.reset()
+
+
+registry = ClientRegistry()
+
+
+def get_client(factory=OpenAI, api_key=None, base_url=None):
+    return registry.get(factory, api_key, base_url)
+
+
+def get_async_client(factory=AsyncOpenAI, api_key=None, base_url=None):
+    return registry.get_async(factory, api_key, base_url)
+
+
+def connection_stats():
+    return registry.stats.snapshot()
@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .cache import CacheStats
+
+
+DEFAULT_COALESCE_SETTINGS = {
+    'ENABLED': True,
+    'BACKEND': None,
+    'LOCK_TIMEOUT': 60,
+    'WAIT_TIMEOUT': 60,
+    'POLL_INTERVAL': 0.05,
+    'RESULT_TTL': 10,
+}
+
+
+def coalesce_settings():
+    return {**DEFAULT_COALESCE_SETTINGS, **getattr(settings, 'CHAT_COALESCE', {})}
+
+
+def lock_key(key):
+    return f'chatbot:inflight:{key}:lock'
+
+
+def result_key(key):
+    return f'chatbot:inflight:{key}:result'
+
+
+class SingleFlight:
+    """Runs one upstream call per prompt key at a time.
+
+    Callers that arrive while a call for the same key is in flight wait for
+    it and share its result (or exception). Within a process this is a map
+    of futures; with ``BACKEND`` set, a lock in that Django cache extends it
+    across processes: the lock holder publishes its result there and the
+    others poll for it, falling back to their own call if the holder fails
+    or the wait times out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._async_inflight = weakref.WeakKeyDictionary()
+        self.stats = CacheStats()
+
+    def do(self, key, fn, *args):
+        config = coalesce_settings()
+        if not config['ENABLED']:
+            return fn(*args)
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            self.stats.record('followers')
+            return future.result(timeout=config['WAIT_TIMEOUT'])
+
+        self.stats.record('leaders')
+        try:
+            result = self._shared(key, config, fn, *args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def ado(self, key, fn, *args):
+        config = coalesce_settings()
+        if not config['ENABLED']:
+            return await fn(*args)
+
+        # Futures belong to one event loop, so in-flight calls are tracked
+        # per loop.
+        inflight = self._async_inflight.setdefault(asyncio.get_running_loop(), {})
+        future = inflight.get(key)
+        if future is not None:
+            self.stats.record('followers')
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), config['WAIT_TIMEOUT'])
+            except asyncio.CancelledError:
+                # The leader's client went away; make the call ourselves.
+                if not future.cancelled():
+                    raise
+                return await fn(*args)
+
+        self.stats.record('leaders')
+        future = inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._ashared(key, config, fn, *args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception retrieved when nobody was waiting for it.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del inflight[key]
+
+    def _shared(self, key, config, fn, *args):
+        if not config['BACKEND']:
+            return fn(*args)
+        backend = caches[config['BACKEND']]
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + config['WAIT_TIMEOUT']
+
+        while not backend.add(lock_key(key), token, config['LOCK_TIMEOUT']):
+            result = backend.get(result_key(key))
+            if result is not None:
+                self.stats.record('remote_followers')
+                return result
+            if time.monotonic() > deadline:
+                return fn(*args)
+            time.sleep(config['POLL_INTERVAL'])
+
+        try:
+            result = fn(*args)
+            backend.set(result_key(key), result, config['RESULT_TTL'])
+            return result
+        finally:
+            if backend.get(lock_key(key)) == token:
+                backend.delete(lock_key(key))
+
+    async def _ashared(self, key, config, fn, *args):
+        if not config['BACKEND']:
+            return await fn(*args)
+        backend = caches[config['BACKEND']]
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + config['WAIT_TIMEOUT']
+
+        while not await backend.aadd(lock_key(key), token, config['LOCK_TIMEOUT']):
+            result = await backend.aget(result_key(key))
+            if result is not None:
+                self.stats.record('remote_followers')
+                return result
+            if time.monotonic() > deadline:
+                return await fn(*args)
+            await asyncio.sleep(config['POLL_INTERVAL'])
+
+        try:
+            result = await fn(*args)
+            await backend.aset(result_key(key), result, config['RESULT_TTL'])
+            return result
+        finally:
+            if await backend.aget(lock_key(key)) == token:
+                await backend.adelete(lock_key(key))
+
+
+single_flight = SingleFlight()
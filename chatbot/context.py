@@ -0,0 +1,122 @@
+from functools import lru_cache
+
+from django.conf import settings
+
+from .summary import summary_message
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Tokenizer used for the per-message count cached on Message.token_count.
+DEFAULT_TOKENIZER_MODEL = 'gpt-3.5-turbo'
+
+# Framing tokens the chat format adds around every message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+DROP_OLDEST = 'drop_oldest'
+KEEP_ENDS = 'keep_ends'
+
+DEFAULT_CONTEXT_SETTINGS = {
+    'MODEL_BUDGETS': {
+        'gpt-3.5-turbo': 16385,
+        'gpt-4': 8192,
+        'gpt-4o': 128000,
+        'gpt-4o-mini': 128000,
+    },
+    'DEFAULT_BUDGET': 4096,
+    'RESERVE_TOKENS': 1024,
+    'POLICY': DROP_OLDEST,
+    'KEEP_FIRST': 2,
+    'KEEP_LAST': None,
+}
+
+
+def context_settings():
+    return {**DEFAULT_CONTEXT_SETTINGS, **getattr(settings, 'CHAT_CONTEXT', {})}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text, model=DEFAULT_TOKENIZER_MODEL):
+    encoding = get_encoding(model)
+    if encoding is None:
+        # Rough English average when tiktoken is not installed.
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message):
+    tokens = message.token_count
+    if tokens is None:
+        tokens = count_tokens(message.content)
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextWindow:
+    """Assembles the prompt for one turn within the model's token budget.
+
+    The system prompt, and the conversation's running summary when there is
+    one, are always sent. Messages are offered newest first and accepted
+    until the budget is spent, so the prompt stays O(budget) however long
+    the conversation gets. With the ``keep_ends`` policy the first
+    ``KEEP_FIRST`` messages are pinned ahead of the newest ones, and at most
+    ``KEEP_LAST`` recent messages are kept. The newest message is always
+    accepted, even when it alone exceeds the budget.
+    """
+
+    def __init__(self, model, system_prompt=SYSTEM_PROMPT, summary=''):
+        config = context_settings()
+        budget = config['MODEL_BUDGETS'].get(model, config['DEFAULT_BUDGET'])
+        self.budget = budget - config['RESERVE_TOKENS']
+        self.policy = config['POLICY']
+        self.keep_first = config['KEEP_FIRST'] if self.policy == KEEP_ENDS else 0
+        self.keep_last = config['KEEP_LAST'] if self.policy == KEEP_ENDS else None
+        self.system = {"role": "system", "content": system_prompt}
+        self.used = count_tokens(system_prompt, model) + MESSAGE_OVERHEAD_TOKENS
+        self.summary = summary_message(summary) if summary else None
+        if self.summary:
+            self.used += count_tokens(self.summary['content'], model) + MESSAGE_OVERHEAD_TOKENS
+        self.head = []
+        self.tail = []
+
+    def pin(self, message):
+        self.used += message_tokens(message)
+        self.head.append({"role": message.role, "content": message.content})
+
+    def offer(self, message):
+        if self.keep_last is not None and len(self.tail) >= self.keep_last:
+            return False
+        tokens = message_tokens(message)
+        if self.tail and self.used + tokens > self.budget:
+            return False
+        self.used += tokens
+        self.tail.append({"role": message.role, "content": message.content})
+        return True
+
+    def fill(self, history):
+        """Select from ``history``, the chronological messages the summary
+        does not cover, and return the prompt."""
+        head = history[:self.keep_first]
+        for message in head:
+            self.pin(message)
+        for message in reversed(history[len(head):]):
+            if not self.offer(message):
+                break
+        return self.messages()
+
+    def messages(self):
+        preamble = [self.system, self.summary] if self.summary else [self.system]
+        return [*preamble, *self.head, *reversed(self.tail)]
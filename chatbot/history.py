@@ -0,0 +1,213 @@
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# The serialised form kept in the cache. It has the attributes ContextWindow
+# reads from Message rows, so either can be fed to it.
+CachedMessage = namedtuple('CachedMessage', ['pk', 'role', 'content', 'token_count', 'seq'])
+
+HISTORY_FIELDS = ('pk', 'role', 'content', 'token_count', 'seq')
+
+DEFAULT_HISTORY_SETTINGS = {
+    'MAX_SESSIONS': 1024,
+    'BACKEND': None,
+    'TIMEOUT': 3600,
+}
+
+
+def history_settings():
+    return {**DEFAULT_HISTORY_SETTINGS, **getattr(settings, 'CHAT_HISTORY_CACHE', {})}
+
+
+def cache_key(session_id):
+    return f'chatbot:history:{session_id}'
+
+
+def generation_key(session_id):
+    return f'chatbot:history:{session_id}:generation'
+
+
+class HistoryCache:
+    """Per-session message history, kept in a local LRU.
+
+    Entries are lists of ``CachedMessage`` in primary-key order. They are
+    appended to as messages are saved and dropped when a message is edited
+    or deleted (see chatbot/signals.py). When ``BACKEND`` names a Django
+    cache alias, entries are also written there so other worker processes
+    can start from them, and ``invalidate`` bumps a generation counter
+    there: a local entry is only used while its generation is current, so
+    an edit or delete in one process is seen by all of them. Callers must
+    treat returned lists as read-only, and pass ``set`` the generation
+    ``lookup`` returned before they read the history from the database, so
+    an invalidation in between leaves what they read out of date.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # session_id -> (generation, history); generation is None without
+        # BACKEND.
+        self._entries = OrderedDict()
+
+    def _backend(self):
+        alias = history_settings()['BACKEND']
+        return caches[alias] if alias else None
+
+    def _remember(self, session_id, generation, history):
+        with self._lock:
+            self._entries[session_id] = (generation, history)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > history_settings()['MAX_SESSIONS']:
+                self._entries.popitem(last=False)
+
+    def _local(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                self._entries.move_to_end(session_id)
+            return entry
+
+    def _shared(self, session_id, generation, stored):
+        # ``stored`` is the (generation, history) pair set() wrote to
+        # BACKEND, or None. Either way the local entry is out of date.
+        if stored is None or stored[0] != generation:
+            with self._lock:
+                self._entries.pop(session_id, None)
+            return None
+        self._remember(session_id, generation, stored[1])
+        return stored[1]
+
+    def lookup(self, session_id):
+        # (generation, history or None); the generation is None without
+        # BACKEND.
+        entry = self._local(session_id)
+        backend = self._backend()
+        if backend is None:
+            return None, entry[1] if entry is not None else None
+        generation = backend.get(generation_key(session_id), 0)
+        if entry is not None and entry[0] == generation:
+            return generation, entry[1]
+        return generation, self._shared(session_id, generation, backend.get(cache_key(session_id)))
+
+    async def alookup(self, session_id):
+        entry = self._local(session_id)
+        backend = self._backend()
+        if backend is None:
+            return None, entry[1] if entry is not None else None
+        generation = await backend.aget(generation_key(session_id), 0)
+        if entry is not None and entry[0] == generation:
+            return generation, entry[1]
+        return generation, self._shared(
+            session_id, generation, await backend.aget(cache_key(session_id))
+        )
+
+    def get(self, session_id):
+        return self.lookup(session_id)[1]
+
+    async def aget(self, session_id):
+        return (await self.alookup(session_id))[1]
+
+    def set(self, session_id, history, generation=None):
+        # ``generation``: from lookup() before ``history`` was read; read
+        # now when not given.
+        backend = self._backend()
+        if backend is None:
+            self._remember(session_id, None, history)
+            return
+        if generation is None:
+            generation = backend.get(generation_key(session_id), 0)
+        self._remember(session_id, generation, history)
+        backend.set(cache_key(session_id), (generation, history), history_settings()['TIMEOUT'])
+
+    async def aset(self, session_id, history, generation=None):
+        backend = self._backend()
+        if backend is None:
+            self._remember(session_id, None, history)
+            return
+        if generation is None:
+            generation = await backend.aget(generation_key(session_id), 0)
+        self._remember(session_id, generation, history)
+        await backend.aset(
+            cache_key(session_id), (generation, history), history_settings()['TIMEOUT']
+        )
+
+    def append(self, session_id, message):
+        # Only extends a cached entry, and only with the message right after
+        # its last one: load_history reads rows after the last cached one,
+        # so a message saved by another process in between would never be
+        # read. Such an entry is dropped instead.
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            history = entry[1]
+            if history and history[-1].seq >= message.seq:
+                return
+            if message.seq != (history[-1].seq if history else 0) + 1:
+                del self._entries[session_id]
+                return
+            history.append(CachedMessage(message.pk, message.role, message.content,
+                                         message.token_count, message.seq))
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+        if (backend := self._backend()) is not None:
+            backend.delete(cache_key(session_id))
+            # Never expires: local entries elsewhere have no expiry either,
+            # and a counter that reset to 0 could make one current again.
+            if not backend.add(generation_key(session_id), 1, None):
+                try:
+                    backend.incr(generation_key(session_id))
+                except ValueError:
+                    backend.add(generation_key(session_id), 1, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+history_cache = HistoryCache()
+
+
+def merge(history, rows):
+    last = history[-1].pk if history else 0
+    return history + [CachedMessage(*row) for row in rows if row[0] > last]
+
+
+def unsummarized(history, summarized_through):
+    if not summarized_through:
+        return history
+    return history[bisect_right(history, summarized_through, key=attrgetter('pk')):]
+
+
+def load_history(conversation):
+    """Return the conversation's messages, reading only rows newer than the cache."""
+    generation, history = history_cache.lookup(conversation.session_id)
+    history = history or []
+    last = history[-1].pk if history else 0
+    rows = list(
+        conversation.messages.filter(pk__gt=last).order_by('pk').values_list(*HISTORY_FIELDS)
+    )
+    if rows or not last:
+        history = merge(history, rows)
+        history_cache.set(conversation.session_id, history, generation)
+    return history
+
+
+async def aload_history(conversation):
+    generation, history = await history_cache.alookup(conversation.session_id)
+    history = history or []
+    last = history[-1].pk if history else 0
+    rows = [
+        row async for row in
+        conversation.messages.filter(pk__gt=last).order_by('pk').values_list(*HISTORY_FIELDS)
+    ]
+    if rows or not last:
+        history = merge(history, rows)
+        await history_cache.aset(conversation.session_id, history, generation)
+    return history
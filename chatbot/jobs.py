@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import httpx
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from .models import ChatJob
+from .quotas import Account
+from .serializers import ChatJobSerializer
+from .services import ChatbotService
+from .webhooks import WebhookRefused, check_url, signature_headers
+
+
+logger = logging.getLogger(__name__)
+
+THREAD = 'thread'
+DATABASE = 'database'
+
+DEFAULT_JOB_SETTINGS = {
+    # 'thread': run in this process's worker pool as soon as the job is
+    # committed. 'database': leave it queued for `manage.py run_chat_jobs`.
+    'BACKEND': THREAD,
+    'WORKERS': 4,
+    'POLL_INTERVAL': 1.0,
+    # Running jobs older than this are assumed orphaned by a crashed worker.
+    'STALE_AFTER': 600,
+    'MAX_ATTEMPTS': 3,
+    'WEBHOOK_TIMEOUT': 10.0,
+}
+
+
+def job_settings():
+    return {**DEFAULT_JOB_SETTINGS, **getattr(settings, 'CHAT_JOBS', {})}
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=job_settings()['WORKERS'], thread_name_prefix='chat-job'
+            )
+    return _executor
+
+
+def submit(message, session_id=None, use_cache=True, webhook_url='', account=None):
+    # The session id is fixed now so the client can continue the
+    # conversation before the job has run. The account's user and address
+    # are kept for the worker to charge.
+    job = ChatJob.objects.create(
+        session_id=session_id or str(uuid.uuid4()),
+        message=message,
+        use_cache=use_cache,
+        webhook_url=webhook_url or '',
+        user_id=account.user_id if account is not None else None,
+        ip=account.ip if account is not None else None,
+    )
+    if job_settings()['BACKEND'] == THREAD:
+        transaction.on_commit(lambda: executor().submit(run_in_worker, job.pk))
+    return job
+
+
+def claim(pk):
+    # Moves a queued job to running; False when another worker got it first.
+    return bool(ChatJob.objects.filter(pk=pk, status=ChatJob.QUEUED).update(
+        status=ChatJob.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1
+    ))
+
+
+def claim_next():
+    for pk in ChatJob.objects.filter(status=ChatJob.QUEUED).order_by('created_at').values_list(
+        'pk', flat=True
+    )[:10]:
+        if claim(pk):
+            return ChatJob.objects.get(pk=pk)
+    return None
+
+
+def requeue_stale(config):
+    # Jobs left running by a worker that died go back to the queue, or fail
+    # once they have used up MAX_ATTEMPTS.
+    cutoff = timezone.now() - timedelta(seconds=config['STALE_AFTER'])
+    stale = ChatJob.objects.filter(status=ChatJob.RUNNING, started_at__lt=cutoff)
+    stale.filter(attempts__gte=config['MAX_ATTEMPTS']).update(
+        status=ChatJob.FAILED,
+        result={'error': 'Job abandoned by its worker'},
+        finished_at=timezone.now(),
+    )
+    return stale.update(status=ChatJob.QUEUED)
+
+
+def run(job):
+    try:
+        account = Account(job.user_id, job.session_id, job.ip)
+        result = ChatbotService(account=account).chat(job.message, job.session_id, job.use_cache)
+    except Exception as e:
+        logger.exception("Chat job %s failed", job.pk)
+        result = {'error': str(e), 'session_id': job.session_id}
+
+    job.status = ChatJob.FAILED if 'error' in result else ChatJob.DONE
+    job.result = result
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'finished_at'])
+
+    if job.webhook_url:
+        notify(job)
+    return job
+
+
+def run_in_worker(pk):
+    try:
+        if claim(pk):
+            run(ChatJob.objects.get(pk=pk))
+    except Exception:
+        logger.exception("Chat job %s crashed", pk)
+    finally:
+        close_old_connections()
+
+
+def notify(job):
+    config = job_settings()
+    body = JSONRenderer().render(ChatJobSerializer(job).data)
+    try:
+        check_url(job.webhook_url)
+    except WebhookRefused as e:
+        logger.warning("Webhook for chat job %s refused: %s", job.pk, e)
+        return
+    try:
+        response = httpx.post(
+            job.webhook_url,
+            content=body,
+            headers={'Content-Type': 'application/json', **signature_headers(body)},
+            timeout=config['WEBHOOK_TIMEOUT'],
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning("Webhook for chat job %s failed: %s", job.pk, e)
+
+
+def drain(once=False, stop=None):
+    """Runs queued jobs one after another until the queue is empty (``once``)
+    or ``stop`` is set. Returns the number of jobs run."""
+    config = job_settings()
+    count = 0
+    while stop is None or not stop.is_set():
+        requeue_stale(config)
+        job = claim_next()
+        if job is None:
+            if once:
+                break
+            time.sleep(config['POLL_INTERVAL'])
+            continue
+        run(job)
+        count += 1
+    return count
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.retention import Archiver, compact
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply the CHAT_RETENTION policy: move conversations idle past "
+        "ARCHIVE_AFTER_DAYS into compressed archive files, forget archives "
+        "past PURGE_AFTER_DAYS, and refresh planner statistics. Safe to "
+        "interrupt; the next run resumes. Meant to run from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive conversations idle this many days (default: ARCHIVE_AFTER_DAYS).')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Archive at most this many conversations in this run.')
+        parser.add_argument('--no-purge', action='store_true',
+                            help='Skip purging expired archives and unused archive files.')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='VACUUM afterwards to return freed space (locks SQLite while it runs).')
+        parser.add_argument('--no-analyze', action='store_true',
+                            help='Skip ANALYZE.')
+
+    def handle(self, *args, **options):
+        archiver = Archiver(days=options['days'])
+        if archiver.config['ARCHIVE_AFTER_DAYS'] is None:
+            self.stdout.write("Archival is off (CHAT_RETENTION ARCHIVE_AFTER_DAYS is None).")
+        elif options['limit'] is not None and options['limit'] < 1:
+            raise CommandError("--limit must be at least 1.")
+        else:
+            archiver.run(limit=options['limit'])
+        if not options['no_purge']:
+            archiver.purge()
+        compact(vacuum=options['vacuum'], analyze=not options['no_analyze'])
+
+        stats = archiver.stats
+        self.stdout.write(
+            f"Archived {stats['archived']} conversations ({stats['messages']} messages), "
+            f"{stats['reactivated']} reactivated meanwhile; purged {stats['purged']} archives "
+            f"and removed {stats['files_removed']} unused archive files."
+        )
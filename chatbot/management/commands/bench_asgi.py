@@ -0,0 +1,95 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+
+from chatbot.bench import benchmark_database, percentile
+from chatbot.bench.fake_openai import FakeOpenAIServer
+from chatbot.clients import connection_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare concurrent chat throughput of the WSGI deployment (sync ChatView "
+        "on a fixed thread pool) and the ASGI deployment (AsyncChatView on one "
+        "event loop) against a stubbed upstream."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Requests in flight at once from the load generator.')
+        parser.add_argument('--wsgi-threads', type=int, default=8,
+                            help='Worker threads of the simulated WSGI process.')
+        parser.add_argument('--latency', type=float, default=0.25,
+                            help='Seconds the fake upstream takes per completion.')
+
+    def handle(self, *args, **options):
+        with FakeOpenAIServer(latency=options['latency']) as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='bench',
+                                  ALLOWED_HOSTS=['testserver']), \
+                benchmark_database():
+            results = [
+                ('wsgi', self.run_wsgi(options)),
+                ('asgi', self.run_asgi(options)),
+            ]
+
+        self.stdout.write(f"{'stack':<6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}")
+        for name, (elapsed, latencies, errors) in results:
+            self.stdout.write(
+                f"{name:<6}{len(latencies) / elapsed:>10.1f}"
+                f"{percentile(latencies, 50) * 1000:>10.1f}"
+                f"{percentile(latencies, 95) * 1000:>10.1f}{errors:>8}"
+            )
+        self.stdout.write(f"upstream connections: {connection_stats()}")
+
+    def payload(self, i):
+        return json.dumps({'message': f'Benchmark question {i}'})
+
+    def run_wsgi(self, options):
+        # Load generator threads issue requests; the semaphore stands in for
+        # the WSGI server's fixed worker thread count.
+        workers = threading.BoundedSemaphore(options['wsgi_threads'])
+
+        def call(i):
+            submitted = time.perf_counter()
+            with workers:
+                response = Client().post(
+                    '/api/chat/', self.payload(i), content_type='application/json'
+                )
+            return time.perf_counter() - submitted, response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            outcomes = list(pool.map(call, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+
+        latencies = [latency for latency, _ in outcomes]
+        errors = sum(status_code != 200 for _, status_code in outcomes)
+        return elapsed, latencies, errors
+
+    def run_asgi(self, options):
+        async def main():
+            client = AsyncClient()
+            semaphore = asyncio.Semaphore(options['concurrency'])
+
+            async def call(i):
+                async with semaphore:
+                    submitted = time.perf_counter()
+                    response = await client.post(
+                        '/api/chat/async/', self.payload(i), content_type='application/json'
+                    )
+                    return time.perf_counter() - submitted, response.status_code
+
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(*(call(i) for i in range(options['requests'])))
+            return time.perf_counter() - started, outcomes
+
+        elapsed, outcomes = asyncio.run(main())
+        latencies = [latency for latency, _ in outcomes]
+        errors = sum(status_code != 200 for _, status_code in outcomes)
+        return elapsed, latencies, errors
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chatbot.bench import benchmark_database, percentile
+from chatbot.bench.fake_openai import FakeOpenAIServer
+from chatbot.context import MESSAGE_OVERHEAD_TOKENS, count_tokens
+from chatbot.services import ChatbotService
+from chatbot.summary import SUMMARY_PROMPT
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay synthetic long conversations against a stubbed upstream and "
+        "compare prompt tokens per turn with and without rolling summaries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=3)
+        parser.add_argument('--turns', type=int, default=60)
+        parser.add_argument('--words', type=int, default=60,
+                            help='Words per synthetic user message and reply.')
+        parser.add_argument('--every', type=int, default=10)
+        parser.add_argument('--keep-recent', type=int, default=6)
+
+    def handle(self, *args, **options):
+        reply = ' '.join(['answer'] * options['words'])
+        # A budget large enough that truncation never kicks in, so the
+        # baseline shows the full cost of resending the history.
+        context = {'DEFAULT_BUDGET': 10 ** 9, 'MODEL_BUDGETS': {}, 'RESERVE_TOKENS': 0}
+        summary = {'EVERY': options['every'], 'KEEP_RECENT': options['keep_recent']}
+
+        with FakeOpenAIServer(reply=reply) as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='bench',
+                                  CHAT_CONTEXT=context), \
+                benchmark_database():
+            results = []
+            for name, enabled in (('full', False), ('summary', True)):
+                upstream.requests.clear()
+                with override_settings(CHAT_SUMMARY={**summary, 'ENABLED': enabled}):
+                    self.replay(options)
+                results.append((name, self.prompt_tokens(upstream.requests)))
+
+        self.stdout.write(
+            f"{'mode':<9}{'turns':>7}{'mean':>9}{'p95':>9}{'last':>9}{'summaries':>11}{'total':>11}"
+        )
+        for name, (chat_tokens, summary_tokens) in results:
+            total = sum(chat_tokens) + sum(summary_tokens)
+            self.stdout.write(
+                f"{name:<9}{len(chat_tokens):>7}{sum(chat_tokens) / len(chat_tokens):>9.0f}"
+                f"{percentile(chat_tokens, 95):>9}{chat_tokens[-1]:>9}"
+                f"{len(summary_tokens):>11}{total:>11}"
+            )
+
+        baseline, compressed = (sum(chat) for _, (chat, _) in results)
+        self.stdout.write(f"chat prompt tokens saved: {1 - compressed / baseline:.1%}")
+
+    def replay(self, options):
+        service = ChatbotService()
+        question = ' '.join(['question'] * options['words'])
+        for _ in range(options['conversations']):
+            session_id = None
+            for turn in range(options['turns']):
+                result = service.chat(f"{turn}: {question}", session_id)
+                session_id = result['session_id']
+
+    def prompt_tokens(self, requests):
+        chat_tokens, summary_tokens = [], []
+        for body in requests:
+            messages = body['messages']
+            tokens = sum(
+                count_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in messages
+            )
+            if messages[0]['content'] == SUMMARY_PROMPT:
+                summary_tokens.append(tokens)
+            else:
+                chat_tokens.append(tokens)
+        return chat_tokens, summary_tokens
@@ -0,0 +1,61 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chatbot.bench import benchmark_database, percentile, seed_conversations
+from chatbot.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway database with a growing number of messages and time "
+        "one session's history fetch at each size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2_000_000,
+                            help='Total messages seeded by the last stage.')
+        parser.add_argument('--conversation-size', type=int, default=200,
+                            help='Messages per seeded conversation.')
+        parser.add_argument('--tail', type=int, default=50,
+                            help='Messages fetched by the "last N" query.')
+        parser.add_argument('--samples', type=int, default=200)
+
+    def handle(self, *args, **options):
+        total = options['messages']
+        stages = sorted({stage for stage in (10_000, 100_000, 1_000_000) if stage < total} | {total})
+
+        self.stdout.write(
+            f"{'messages':>10}{'tail p50':>10}{'tail p99':>10}{'full p50':>10}{'full p99':>10}  (ms)"
+        )
+        with override_settings(SQLITE_TUNING={'ENABLED': True}), benchmark_database():
+            seeded = 0
+            for stage in stages:
+                if stage > seeded:
+                    seeded += self.seed(stage - seeded, options['conversation_size'])
+                tail, full = self.measure(options)
+                self.stdout.write(
+                    f"{seeded:>10}{percentile(tail, 50) * 1000:>10.2f}{percentile(tail, 99) * 1000:>10.2f}"
+                    f"{percentile(full, 50) * 1000:>10.2f}{percentile(full, 99) * 1000:>10.2f}"
+                )
+
+    def seed(self, count, size):
+        # Whole conversations, so ``count`` is rounded up.
+        return len(seed_conversations(-(-count // size), size)) * size
+
+    def measure(self, options):
+        ids = list(Conversation.objects.values_list('pk', flat=True))
+        sample = random.sample(ids, min(options['samples'], len(ids)))
+        conversations = list(Conversation.objects.filter(pk__in=sample))
+        tail, full = [], []
+        for conversation in conversations:
+            started = time.perf_counter()
+            list(Message.objects.tail(conversation, options['tail']))
+            tail.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            list(conversation.messages.all())
+            full.append(time.perf_counter() - started)
+        return tail, full
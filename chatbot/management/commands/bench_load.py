@@ -0,0 +1,85 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from chatbot.bench import benchmark_database, seed_conversations
+from chatbot.bench.fake_openai import FakeOpenAIServer
+from chatbot.bench.load import SCENARIOS, load_baseline, regressions, run_scenarios, save_baseline
+
+
+PARAMETERS = (
+    'requests', 'concurrency', 'latency', 'token_rate', 'seed_conversations', 'seed_size',
+    'hot_sessions',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run load scenarios through the full request stack against a fake "
+        "upstream and a seeded throwaway database. Reports RPS, latency "
+        "percentiles and queries per request, and compares them with a "
+        "stored baseline to catch regressions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated subset of: {', '.join(SCENARIOS)}.")
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per scenario.')
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Seconds the fake upstream waits before answering.')
+        parser.add_argument('--token-rate', type=float, default=0,
+                            help='Tokens per second the fake upstream generates (0: instant).')
+        parser.add_argument('--seed-conversations', type=int, default=200)
+        parser.add_argument('--seed-size', type=int, default=100,
+                            help='Messages per seeded conversation.')
+        parser.add_argument('--hot-sessions', type=int, default=4,
+                            help='Conversations shared by the concurrent_writes scenario.')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'bench-baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Record this run as the baseline instead of comparing.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Fraction by which RPS or p95/p99 may worsen before failing.')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        token_delay = 1 / options['token_rate'] if options['token_rate'] else 0.0
+        with FakeOpenAIServer(latency=options['latency'], token_delay=token_delay) as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='bench',
+                                  ALLOWED_HOSTS=['testserver']), \
+                benchmark_database():
+            sessions = seed_conversations(options['seed_conversations'], options['seed_size'])
+            results = run_scenarios(names, sessions, options)
+
+        self.stdout.write(
+            f"{'scenario':<18}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/req':>7}{'errors':>8}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<18}{result['rps']:>9.1f}{result['p50'] * 1000:>9.1f}"
+                f"{result['p95'] * 1000:>9.1f}{result['p99'] * 1000:>9.1f}"
+                f"{result['queries_per_request']:>7.1f}{result['errors']:>8}"
+            )
+
+        parameters = {key: options[key] for key in PARAMETERS}
+        if options['save_baseline']:
+            save_baseline(options['baseline'], results, parameters)
+            self.stdout.write(f"Baseline saved to {options['baseline']}")
+            return
+
+        baseline = load_baseline(options['baseline'])
+        compared = [name for name in results if baseline.get(name, {}).get('parameters') == parameters]
+        if not compared:
+            self.stdout.write("No baseline with these parameters; run with --save-baseline first.")
+            return
+        found = regressions(results, baseline, parameters, options['tolerance'])
+        if found:
+            raise CommandError("Performance regressions:\n  " + "\n  ".join(found))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against baseline ({', '.join(compared)})."))
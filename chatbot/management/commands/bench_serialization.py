@@ -0,0 +1,74 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+
+from chatbot.bench import benchmark_database, percentile, seed_conversations
+from chatbot.middleware import brotli
+from chatbot.models import Conversation
+from chatbot.renderers import ORJSONRenderer, orjson
+from chatbot.rows import conversation_data
+from chatbot.serializers import ConversationSerializer
+
+
+def serializer_payload(session_id):
+    conversation = Conversation.objects.prefetch_related('messages').get(session_id=session_id)
+    return ConversationSerializer(conversation).data, JSONRenderer()
+
+
+def fast_payload(session_id):
+    return conversation_data(Conversation.objects.get(session_id=session_id)), ORJSONRenderer()
+
+
+MODES = [('serializer', serializer_payload), ('fast', fast_payload)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Time GET /api/conversations/<session_id>/ payloads built by the "
+        "ModelSerializers and by the fast path (.values() rows, RowMapper, "
+        "orjson), for conversations of growing length, on a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000,5000',
+                            help='Comma-separated conversation lengths, in messages.')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        self.stdout.write(f"orjson: {'yes' if orjson else 'no'}, brotli: {'yes' if brotli else 'no'}")
+        self.stdout.write(
+            f"{'messages':>9} {'mode':<11}{'build p50':>10}{'render p50':>11}{'total p50':>10}"
+            f"{'KiB':>8}{'gzip KiB':>9}{'br KiB':>8}  (ms)"
+        )
+        with benchmark_database():
+            for size in sizes:
+                session_id = seed_conversations(1, size)[0]
+                outputs = {}
+                for name, payload in MODES:
+                    build, render, content = self.measure(payload, session_id, options['repeat'])
+                    outputs[name] = content
+                    compressed = brotli.compress(content, quality=5) if brotli else b''
+                    self.stdout.write(
+                        f"{size:>9} {name:<11}{percentile(build, 50) * 1000:>10.2f}"
+                        f"{percentile(render, 50) * 1000:>11.2f}"
+                        f"{percentile([b + r for b, r in zip(build, render)], 50) * 1000:>10.2f}"
+                        f"{len(content) / 1024:>8.1f}{len(compress_string(content)) / 1024:>9.1f}"
+                        f"{len(compressed) / 1024:>8.1f}"
+                    )
+                if json.loads(outputs['serializer']) != json.loads(outputs['fast']):
+                    raise CommandError(f"Fast output differs from the serializers at {size} messages.")
+
+    def measure(self, payload, session_id, repeat):
+        build, render = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            data, renderer = payload(session_id)
+            built = time.perf_counter()
+            content = renderer.render(data)
+            render.append(time.perf_counter() - built)
+            build.append(built - started)
+        return build, render, content
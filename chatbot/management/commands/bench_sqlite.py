@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.test import override_settings
+
+from chatbot.bench import benchmark_database, percentile
+from chatbot.services import ChatbotService, new_message, save_turn
+from chatbot.sqlite import writer
+
+
+MODES = [
+    # name, SQLITE_TUNING, transaction_mode
+    ('default', {'ENABLED': False}, None),
+    ('tuned', {'ENABLED': True}, 'IMMEDIATE'),
+    ('queued', {'ENABLED': True, 'SERIALIZE_WRITES': True}, 'IMMEDIATE'),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Stress concurrent chat-turn writes against a throwaway SQLite file and "
+        "compare lock errors and write latency with default settings, the tuned "
+        "pragmas, and the tuned pragmas plus the single-writer queue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--turns', type=int, default=100,
+                            help='Chat turns written by each thread.')
+        parser.add_argument('--new-session-every', type=int, default=5,
+                            help='Start a new conversation every N turns.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("bench_sqlite needs the default database to be SQLite.")
+
+        self.stdout.write(f"{'mode':<9}{'turns/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'locked':>8}{'rate':>8}")
+        for name, tuning, transaction_mode in MODES:
+            with override_settings(SQLITE_TUNING=tuning), \
+                    self.transaction_mode(transaction_mode), benchmark_database():
+                elapsed, latencies, locked = self.run(options)
+                writer.close()
+
+            total = options['threads'] * options['turns']
+            self.stdout.write(
+                f"{name:<9}{len(latencies) / elapsed:>9.1f}"
+                f"{percentile(latencies, 50) * 1000:>9.1f}"
+                f"{percentile(latencies, 99) * 1000:>9.1f}"
+                f"{locked:>8}{locked / total:>8.1%}"
+            )
+
+    @contextmanager
+    def transaction_mode(self, mode):
+        options = connection.settings_dict.setdefault('OPTIONS', {})
+        previous = options.pop('transaction_mode', None)
+        if mode:
+            options['transaction_mode'] = mode
+        try:
+            yield
+        finally:
+            options.pop('transaction_mode', None)
+            if previous:
+                options['transaction_mode'] = previous
+
+    def run(self, options):
+        # Each worker thread opens its own connection, so the pragmas and
+        # transaction mode of the current mode apply to it.
+        service = ChatbotService(client=object())
+        lock = threading.Lock()
+        latencies = []
+        locked = 0
+
+        def worker(_):
+            nonlocal locked
+            conversation = None
+            try:
+                for turn in range(options['turns']):
+                    started = time.perf_counter()
+                    try:
+                        if conversation is None or turn % options['new_session_every'] == 0:
+                            conversation = service.get_or_create_conversation(str(uuid.uuid4()))
+                        save_turn(
+                            conversation,
+                            new_message(conversation, 'user', f'Question {turn}'),
+                            new_message(conversation, 'assistant', f'Answer {turn}'),
+                        )
+                    except OperationalError as e:
+                        if 'locked' not in str(e):
+                            raise
+                        with lock:
+                            locked += 1
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            list(pool.map(worker, range(options['threads'])))
+        return time.perf_counter() - started, latencies, locked
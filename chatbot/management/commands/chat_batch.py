@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from chatbot.batch import ERROR, run_batch
+from chatbot.services import ChatbotService
+
+
+class Command(BaseCommand):
+    help = (
+        "Answer a JSONL file of {\"message\", \"session_id\"} records into an "
+        "output JSONL with one result per record. Rerunning with the same "
+        "output resumes where the previous run stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='JSONL file of chat records.')
+        parser.add_argument('output', help='JSONL file results are appended to.')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Sessions answered at once (default: CHAT_BATCH CONCURRENCY).')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Records prefetched together (default: CHAT_BATCH CHUNK_SIZE).')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Skip the response cache.')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also rerun records that failed in an earlier run.')
+        parser.add_argument('--serialize-writes', action='store_true',
+                            help='On SQLite, group concurrent turn writes into shared commits.')
+
+    def handle(self, *args, **options):
+        # None leaves it to SQLITE_TUNING SERIALIZE_WRITES.
+        service = ChatbotService(serialize_writes=True if options['serialize_writes'] else None)
+
+        answered = failed = 0
+        with open(options['input'], 'rb') as lines:
+            results = run_batch(
+                lines,
+                options['output'],
+                retry_failed=options['retry_failed'],
+                concurrency=options['concurrency'],
+                chunk_size=options['chunk_size'],
+                use_cache=not options['no_cache'],
+                service=service,
+            )
+            for result in results:
+                answered += 1
+                failed += result['status'] == ERROR
+                if options['verbosity'] > 1:
+                    self.stdout.write(json.dumps(result))
+
+        self.stdout.write(f"Answered {answered} records ({failed} failed) into {options['output']}.")
@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from chatbot.models import TokenUsage
+
+
+GROUPS = {
+    'user': 'user__username',
+    'session': 'session_id',
+    'ip': 'ip',
+    'model': 'model',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Report upstream token usage from the TokenUsage table, heaviest "
+        "first. Usage reaches the table up to CHAT_QUOTAS FLUSH_INTERVAL "
+        "seconds after it happens."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Report the last this many days.')
+        parser.add_argument('--by', choices=GROUPS, default='user')
+        parser.add_argument('--limit', type=int, default=20, help='Show at most this many rows.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['limit'] < 1:
+            raise CommandError("--days and --limit must be at least 1.")
+        column = GROUPS[options['by']]
+        rows = (
+            TokenUsage.objects.filter(period__gte=timezone.now() - timedelta(days=options['days']))
+            .values(column)
+            .annotate(
+                calls=Sum('calls'),
+                prompt=Sum('prompt_tokens'),
+                completion=Sum('completion_tokens'),
+                total=Sum(F('prompt_tokens') + F('completion_tokens')),
+            )
+            .order_by('-total')[:options['limit']]
+        )
+        self.stdout.write(f"{options['by']:<40} {'calls':>8} {'prompt':>12} {'completion':>12} {'total':>12}")
+        for row in rows:
+            name = row[column] or '-'
+            self.stdout.write(
+                f"{name:<40} {row['calls']:>8} {row['prompt']:>12} {row['completion']:>12} {row['total']:>12}"
+            )
@@ -0,0 +1,39 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chatbot.jobs import drain
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background chat jobs queued in the database (CHAT_JOBS BACKEND "
+        "'database'). Jobs left running by a crashed worker are requeued."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Jobs run concurrently.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when the queue is empty instead of polling.')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+
+        def worker(_):
+            try:
+                return drain(once=options['once'], stop=stop)
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            futures = [pool.submit(worker, i) for i in range(options['workers'])]
+            try:
+                total = sum(future.result() for future in futures)
+            except KeyboardInterrupt:
+                stop.set()
+                total = sum(future.result() for future in futures)
+
+        self.stdout.write(f"Ran {total} chat jobs.")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from chatbot.search import search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain the full-text index behind /api/search/. --rebuild recreates "
+        "the index (and, on SQLite, its triggers) from the messages table; "
+        "--optimize compacts it after bulk loads."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true')
+        parser.add_argument('--optimize', action='store_true')
+
+    def handle(self, *args, **options):
+        if not options['rebuild'] and not options['optimize']:
+            raise CommandError("Pass --rebuild and/or --optimize.")
+
+        backend = search_backend()
+        name = type(backend).__name__
+        try:
+            if options['rebuild']:
+                backend.rebuild()
+                self.stdout.write(f"Rebuilt the {name} index.")
+            if options['optimize']:
+                backend.optimize()
+                self.stdout.write(f"Optimized the {name} index.")
+        except DatabaseError as e:
+            raise CommandError(f"{name}: {e}")
@@ -0,0 +1,281 @@
+import asyncio
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+
+DEFAULT_METRICS_SETTINGS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+    # USD per 1000 tokens by model, e.g. {'gpt-4o-mini': {'PROMPT': 0.00015,
+    # 'COMPLETION': 0.0006}}. Models not listed count no cost.
+    'PRICES': {},
+}
+
+# Upper bounds in seconds, from a cache hit to a slow completion.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+
+def metrics_settings():
+    return {**DEFAULT_METRICS_SETTINGS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def series(name, labels, values):
+    if not labels:
+        return name
+    pairs = ','.join(f'{label}="{escape(value)}"' for label, value in zip(labels, values))
+    return f'{name}{{{pairs}}}'
+
+
+def number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def value(self, *values):
+        with self._lock:
+            return self._values.get(values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, total in items:
+            yield series(self.name, self.labels, values), total
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """Prometheus histogram: per label set, a count per bucket plus a sum.
+
+    ``observe`` is a bisect and two increments under a lock, cheap enough
+    for every request; cumulative counts are only built when scraped.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._lock = threading.Lock()
+        # Label values -> [count per bucket..., sum]
+        self._series = {}
+
+    def observe(self, value, *values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._series.get(values)
+            if counts is None:
+                counts = self._series[values] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *values):
+        with self._lock:
+            counts = self._series.get(values)
+            return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((values, list(counts)) for values, counts in self._series.items())
+        labels = self.labels + ('le',)
+        for values, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield series(f'{self.name}_bucket', labels, values + (number(bound),)), cumulative
+            yield series(f'{self.name}_sum', self.labels, values), counts[-1]
+            yield series(f'{self.name}_count', self.labels, values), cumulative
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class MetricsRegistry:
+    """The metrics of this process, in Prometheus text exposition format.
+
+    Values are per process; with several workers, scrape each one (or sum
+    them in Prometheus) as you would with prometheus_client's default mode.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {number(value)}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.register(Histogram(
+    'chat_stage_seconds', 'Time spent in each stage of a chat turn.', ['stage']
+))
+request_seconds = metrics.register(Histogram(
+    'chat_request_seconds',
+    'Chat view time until the response (for streams, its headers) is ready.',
+    ['view', 'status'],
+))
+tokens_total = metrics.register(Counter(
+    'chat_tokens_total', 'Tokens reported by the upstream in response.usage.', ['model', 'kind']
+))
+cost_total = metrics.register(Counter(
+    'chat_cost_usd_total', 'Upstream spend estimated from CHAT_METRICS PRICES.', ['model']
+))
+
+
+class Timings:
+    """Stage durations of one request, for its Server-Timing header."""
+
+    def __init__(self):
+        self.stages = {}
+        self.status = 500
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def header(self):
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items())
+
+    def finish(self, response):
+        self.status = response.status_code
+        if self.stages and metrics_settings()['SERVER_TIMING']:
+            response['Server-Timing'] = self.header()
+        return response
+
+
+_timings = ContextVar('chat_timings', default=None)
+
+
+def observe_stage(name, seconds):
+    if not metrics_settings()['ENABLED']:
+        return
+    stage_seconds.observe(seconds, name)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def timed_request(view):
+    timings = Timings()
+    token = _timings.set(timings)
+    started = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+        if metrics_settings()['ENABLED']:
+            request_seconds.observe(time.perf_counter() - started, view, str(timings.status))
+
+
+def instrument(view):
+    """Decorates a view method so its stages are timed under ``view`` and
+    reported in a Server-Timing header."""
+    def decorator(method):
+        if asyncio.iscoroutinefunction(method):
+            @wraps(method)
+            async def wrapper(self, request, *args, **kwargs):
+                with timed_request(view) as timings:
+                    return timings.finish(await method(self, request, *args, **kwargs))
+        else:
+            @wraps(method)
+            def wrapper(self, request, *args, **kwargs):
+                with timed_request(view) as timings:
+                    return timings.finish(method(self, request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def record_usage(model, usage):
+    prompt = getattr(usage, 'prompt_tokens', None)
+    completion = getattr(usage, 'completion_tokens', None)
+    if not isinstance(prompt, int) or not isinstance(completion, int):
+        return
+    config = metrics_settings()
+    if not config['ENABLED']:
+        return
+    tokens_total.inc(prompt, model, 'prompt')
+    tokens_total.inc(completion, model, 'completion')
+    price = config['PRICES'].get(model)
+    if price:
+        cost_total.inc(
+            (prompt * price.get('PROMPT', 0) + completion * price.get('COMPLETION', 0)) / 1000, model
+        )
+
+
+# httpx event hooks for the pooled clients (see chatbot/clients.py). The
+# response hook runs once the headers are in, before the body is read, which
+# gives the time to first byte of non-streamed completions; streams record it
+# at their first token instead.
+
+def upstream_request(request):
+    request.extensions['chat_started'] = time.perf_counter()
+
+
+def upstream_response(response):
+    started = response.request.extensions.get('chat_started')
+    if started is None or response.headers.get('content-type', '').startswith('text/event-stream'):
+        return
+    observe_stage('upstream_ttfb', time.perf_counter() - started)
+
+
+async def aupstream_request(request):
+    upstream_request(request)
+
+
+async def aupstream_response(response):
+    upstream_response(response)
@@ -0,0 +1,69 @@
+import re
+
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_string
+
+from .rows import serialization_settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+_accepts_br = re.compile(r'\bbr\b')
+_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def preferred_encoding(request):
+    # 'br', 'gzip' or None, from the request's Accept-Encoding.
+    accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if brotli is not None and _accepts_br.search(accepted):
+        return 'br'
+    if _accepts_gzip.search(accepted):
+        return 'gzip'
+    return None
+
+
+def compress(content, encoding, best=False):
+    # ``best`` for content compressed once and served many times.
+    if encoding == 'br':
+        return brotli.compress(content, quality=11 if best else 5)
+    return compress_string(content)
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """Brotli or gzip for large JSON responses, such as long histories.
+
+    Only JSON bodies of at least CHAT_SERIALIZATION COMPRESS_MIN_BYTES are
+    touched: small ones gain little, and pages with secrets in them are
+    not JSON here. Brotli is used when the brotli package is installed and
+    the client accepts it.
+    """
+
+    def process_response(self, request, response):
+        min_bytes = serialization_settings()['COMPRESS_MIN_BYTES']
+        if (
+            min_bytes is None
+            or response.streaming
+            or response.has_header('Content-Encoding')
+            or not response.get('Content-Type', '').startswith('application/json')
+            or len(response.content) < min_bytes
+        ):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = preferred_encoding(request)
+        if encoding is None:
+            return response
+        compressed = compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag'):
+            response['ETag'] = re.sub(r'^"', 'W/"', response['ETag'])
+        return response
@@ -0,0 +1,74 @@
+from django.db import migrations, models
+
+
+BATCH_SIZE = 5000
+
+
+def backfill_seq(apps, schema_editor):
+    # Numbers each conversation's messages from 1 in (timestamp, id) order.
+    # Rows are read per conversation rather than through one long cursor,
+    # because SQLite gives no isolation between a cursor and writes on the
+    # same connection.
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    Message = apps.get_model('chatbot', 'Message')
+    db = schema_editor.connection.alias
+
+    batch = []
+    conversations = []
+    for conversation_id in Conversation.objects.using(db).values_list('pk', flat=True):
+        ids = (
+            Message.objects.using(db)
+            .filter(conversation_id=conversation_id)
+            .order_by('timestamp', 'id')
+            .values_list('id', flat=True)
+        )
+        seq = 0
+        for seq, pk in enumerate(ids, start=1):
+            batch.append(Message(pk=pk, seq=seq))
+        conversations.append(Conversation(pk=conversation_id, last_seq=seq))
+
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.using(db).bulk_update(batch, ['seq'], batch_size=BATCH_SIZE)
+            batch = []
+    Message.objects.using(db).bulk_update(batch, ['seq'], batch_size=BATCH_SIZE)
+    Conversation.objects.using(db).bulk_update(conversations, ['last_seq'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['seq']},
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(
+                fields=['conversation', 'seq'], name='chatbot_message_conversation_seq'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp'], name='chatbot_msg_conv_ts_idx'),
+        ),
+    ]
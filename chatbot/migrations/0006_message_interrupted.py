@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_chatjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='interrupted',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,87 @@
+import logging
+
+from django.conf import settings
+from django.db import OperationalError, migrations
+
+
+logger = logging.getLogger(__name__)
+
+# The index as chatbot.search created it when this migration was written;
+# kept here so later changes to that module cannot rewrite history.
+SQLITE_INSTALL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chatbot_message_fts USING fts5(
+        content, content='chatbot_message', content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS chatbot_message_fts_ai AFTER INSERT ON chatbot_message BEGIN
+        INSERT INTO chatbot_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chatbot_message_fts_ad AFTER DELETE ON chatbot_message BEGIN
+        INSERT INTO chatbot_message_fts(chatbot_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chatbot_message_fts_au
+        AFTER UPDATE OF content ON chatbot_message BEGIN
+        INSERT INTO chatbot_message_fts(chatbot_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO chatbot_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    # Index the rows that predate the table.
+    "INSERT INTO chatbot_message_fts(chatbot_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS chatbot_message_fts_ai",
+    "DROP TRIGGER IF EXISTS chatbot_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chatbot_message_fts_au",
+    "DROP TABLE IF EXISTS chatbot_message_fts",
+]
+
+
+def postgres_install():
+    # The text search configuration is a setting; the index expression
+    # must match the one chatbot.search queries with.
+    config = getattr(settings, 'CHAT_SEARCH', {}).get('POSTGRES_CONFIG', 'english')
+    return [
+        "CREATE INDEX IF NOT EXISTS chatbot_message_content_fts ON chatbot_message "
+        f"USING GIN (to_tsvector('{config}', content))"
+    ]
+
+
+INSTALL = {
+    'sqlite': lambda: SQLITE_INSTALL,
+    'postgresql': postgres_install,
+}
+
+UNINSTALL = {
+    'sqlite': SQLITE_UNINSTALL,
+    'postgresql': ["DROP INDEX IF EXISTS chatbot_message_content_fts"],
+}
+
+
+def install_index(apps, schema_editor):
+    statements = INSTALL.get(schema_editor.connection.vendor)
+    if statements is None:
+        return
+    try:
+        for statement in statements():
+            schema_editor.execute(statement)
+    except OperationalError as e:
+        # SQLite built without FTS5; search falls back to ScanBackend.
+        logger.warning("Full-text index not installed: %s", e)
+
+
+def uninstall_index(apps, schema_editor):
+    for statement in UNINSTALL.get(schema_editor.connection.vendor, ()):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_message_interrupted'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_index, uninstall_index),
+    ]
@@ -1,19 +1,53 @@
 from django.db import models
 
 # Create your models here.
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from .context import count_tokens
+import uuid
 
 
 class Conversation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     session_id = models.CharField(max_length=100, unique=True)
+    summary = models.TextField(blank=True, default='')
+    summarized_through = models.BigIntegerField(null=True, blank=True)
+    last_seq = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Finds idle conversations for archival (see chatbot/retention.py).
+            models.Index(fields=['updated_at'], name='chatbot_conv_updated_idx'),
+        ]
+
     def __str__(self):
         return f"Conversation {self.session_id}"
 
+    @classmethod
+    def allocate_seq(cls, conversation_id, count=1, **updates):
+        # Reserves ``count`` consecutive Message.seq values and returns the
+        # first; ``updates`` are applied by the same UPDATE. Must run inside
+        # the transaction that inserts the messages: the UPDATE holds the row
+        # (or, on SQLite, the database) lock until it commits, so concurrent
+        # turns cannot get the same numbers.
+        cls.objects.filter(pk=conversation_id).update(
+            last_seq=models.F('last_seq') + count, **updates
+        )
+        last_seq = cls.objects.filter(pk=conversation_id).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
+
+class MessageQuerySet(models.QuerySet):
+    def tail(self, conversation, count):
+        # The newest ``count`` messages, oldest first, as an index range scan
+        # on (conversation, seq) instead of a sort over the whole history.
+        # Relies on conversation.last_seq being current.
+        return self.filter(
+            conversation=conversation, seq__gt=conversation.last_seq - count
+        ).order_by('seq')
+
 
 class Message(models.Model):
     ROLE_CHOICES = [
@@ -26,9 +60,117 @@ class Message(models.Model):
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    token_count = models.PositiveIntegerField(null=True, blank=True)
+    # 1, 2, 3... within the conversation, in insertion order.
+    seq = models.PositiveIntegerField()
+    # Set on both messages of a turn whose reply was cut short by a client
+    # disconnect or a cancel; the assistant message then holds what had been
+    # generated so far.
+    interrupted = models.BooleanField(default=False)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['seq']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='chatbot_message_conversation_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp'], name='chatbot_msg_conv_ts_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Counted once here so prompt assembly never re-tokenizes history.
+        if self.token_count is None:
+            self.token_count = count_tokens(self.content)
+        if self.seq is None:
+            with transaction.atomic():
+                self.seq = Conversation.allocate_seq(self.conversation_id)
+                super().save(*args, **kwargs)
+            if Message.conversation.is_cached(self):
+                self.conversation.last_seq = self.seq
+            return
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}"
+
+
+class ArchivedConversation(models.Model):
+    # A conversation moved out of the hot tables by chatbot/retention.py. Its
+    # messages are a line of ``file``, in the CHAT_RETENTION DIR; accessing
+    # the session again restores it.
+    session_id = models.CharField(max_length=100, unique=True)
+    file = models.CharField(max_length=255)
+    message_count = models.PositiveIntegerField()
+    last_activity = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_activity'], name='chatbot_archive_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"ArchivedConversation {self.session_id}"
+
+
+class TokenUsage(models.Model):
+    # Upstream tokens spent for a client, written in batches by
+    # chatbot/quotas.py: one row per flush and (hour, user, session, address,
+    # model), so reports sum over rows.
+    period = models.DateTimeField()
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    session_id = models.CharField(max_length=100, blank=True, default='')
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    model = models.CharField(max_length=100)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    calls = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['period'], name='chatbot_usage_period_idx'),
+            models.Index(fields=['user', 'period'], name='chatbot_usage_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"TokenUsage {self.period:%Y-%m-%d %H}h {self.model}"
+
+
+class ChatJob(models.Model):
+    # A chat turn submitted with "background": true, answered by a worker.
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    session_id = models.CharField(max_length=100)
+    message = models.TextField()
+    use_cache = models.BooleanField(default=True)
+    webhook_url = models.URLField(max_length=500, blank=True, default='')
+    # Whom the worker charges the turn's tokens to (see chatbot/quotas.py).
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    # The chat() payload: the reply, or the error.
+    result = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
-        ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='chatbot_job_status_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.role}: {self.content[:50]}"
\ No newline at end of file
+        return f"ChatJob {self.id} ({self.status})"
@@ -0,0 +1,423 @@
+import atexit
+import ipaddress
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import TokenUsage
+from .sqlite import run_write
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUOTA_SETTINGS = {
+    # Upstream tokens (prompt plus completion, as the upstream reports them)
+    # a client may use in any WINDOW seconds; None lifts that limit.
+    # USER_TOKENS applies to authenticated users, SESSION_TOKENS to each chat
+    # session and IP_TOKENS to each client address.
+    'USER_TOKENS': None,
+    'SESSION_TOKENS': None,
+    'IP_TOKENS': None,
+    'WINDOW': 3600,
+    # Django cache alias holding the counters, so every worker process
+    # shares them. None: this process's memory.
+    'BACKEND': None,
+    # request.META key of the client address; behind a reverse proxy, the
+    # header it sets (e.g. 'HTTP_X_REAL_IP').
+    'IP_HEADER': 'REMOTE_ADDR',
+    # Seconds between writes of the usage counted in this process to the
+    # TokenUsage table; None records no usage.
+    'FLUSH_INTERVAL': 60,
+}
+
+# (level, Account attribute, setting)
+LEVELS = (
+    ('user', 'user_id', 'USER_TOKENS'),
+    ('session', 'session_id', 'SESSION_TOKENS'),
+    ('ip', 'ip', 'IP_TOKENS'),
+)
+
+
+def quota_settings():
+    return {**DEFAULT_QUOTA_SETTINGS, **getattr(settings, 'CHAT_QUOTAS', {})}
+
+
+class QuotaExceeded(Exception):
+    """A client used up a token quota; it may retry after ``retry_after`` seconds."""
+
+    def __init__(self, level, retry_after):
+        super().__init__(f"Token quota exceeded ({level}); retry in {math.ceil(retry_after)}s")
+        self.level = level
+        self.retry_after = retry_after
+
+
+def sliding_count(current, previous, elapsed, window):
+    # Fixed windows, the previous one weighted by how much of it still falls
+    # within the last ``window`` seconds.
+    return current + previous * (1 - elapsed / window)
+
+
+def seconds_until_under(limit, current, previous, elapsed, window):
+    # When sliding_count drops below ``limit`` if nothing more is used.
+    if current < limit:
+        # In this window, as the previous one slides out.
+        if not previous:
+            return 0.0
+        return max(0.0, window * (1 - (limit - current) / previous) - elapsed)
+    # In the next window, as this one slides out in turn.
+    return window - elapsed + (window * (1 - limit / current) if current else 0.0)
+
+
+def usage_tokens(usage):
+    # (prompt, completion) from response.usage, or None when not reported.
+    prompt = getattr(usage, 'prompt_tokens', None)
+    completion = getattr(usage, 'completion_tokens', None)
+    if not isinstance(prompt, int) or not isinstance(completion, int):
+        return None
+    return prompt, completion
+
+
+# response.usage reduced to what quotas need; picklable, so it can travel
+# with a coalesced reply through a shared cache.
+Usage = namedtuple('Usage', ['prompt_tokens', 'completion_tokens'])
+
+
+def plain_usage(usage):
+    tokens = usage_tokens(usage)
+    return Usage(*tokens) if tokens is not None else None
+
+
+class LocalCounters:
+    """Token totals per key and fixed window, in this process's memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [window index, its total, the previous window's total]
+        self._counts = {}
+        self._index = None
+
+    def _totals(self, key, index):
+        entry = self._counts.get(key)
+        if entry is None or entry[0] < index - 1:
+            return 0, 0
+        if entry[0] == index - 1:
+            return 0, entry[1]
+        return entry[1], entry[2]
+
+    def totals(self, keys, index, window):
+        # [(current, previous)] for ``keys``.
+        with self._lock:
+            return [self._totals(key, index) for key in keys]
+
+    def add(self, keys, amount, index, window):
+        with self._lock:
+            if index != self._index:
+                # Once per window, forget keys idle for the last two.
+                self._counts = {key: entry for key, entry in self._counts.items() if entry[0] >= index - 1}
+                self._index = index
+            for key in keys:
+                current, previous = self._totals(key, index)
+                self._counts[key] = [index, current + amount, previous]
+
+    # No I/O, so the async variants are the same calls.
+    async def atotals(self, keys, index, window):
+        return self.totals(keys, index, window)
+
+    async def aadd(self, keys, amount, index, window):
+        self.add(keys, amount, index, window)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class CacheCounters:
+    """Token totals per key and fixed window in a shared Django cache."""
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def _key(self, key, index):
+        return f'chatbot:quota:{key}:{index}'
+
+    def _names(self, keys, index):
+        return [(self._key(key, index), self._key(key, index - 1)) for key in keys]
+
+    def totals(self, keys, index, window):
+        names = self._names(keys, index)
+        values = caches[self.alias].get_many([name for pair in names for name in pair])
+        return [(values.get(current, 0), values.get(previous, 0)) for current, previous in names]
+
+    async def atotals(self, keys, index, window):
+        names = self._names(keys, index)
+        values = await caches[self.alias].aget_many([name for pair in names for name in pair])
+        return [(values.get(current, 0), values.get(previous, 0)) for current, previous in names]
+
+    def add(self, keys, amount, index, window):
+        backend = caches[self.alias]
+        for key in keys:
+            name = self._key(key, index)
+            # Kept while it can still be the previous window.
+            backend.add(name, 0, 2 * window)
+            try:
+                backend.incr(name, amount)
+            except ValueError:
+                # Expired between add and incr.
+                backend.add(name, amount, 2 * window)
+
+    async def aadd(self, keys, amount, index, window):
+        backend = caches[self.alias]
+        for key in keys:
+            name = self._key(key, index)
+            await backend.aadd(name, 0, 2 * window)
+            try:
+                await backend.aincr(name, amount)
+            except ValueError:
+                await backend.aadd(name, amount, 2 * window)
+
+
+class UsageLedger:
+    """Usage counted in this process and not yet written to TokenUsage,
+    summed by (hour, user, session, address, model).
+
+    A daemon thread writes it every FLUSH_INTERVAL seconds, in one INSERT,
+    so recording usage never puts a database write on the request path.
+    What is pending when the process exits is written by an atexit hook.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+
+    def add(self, account, model, prompt, completion, interval):
+        period = timezone.now().replace(minute=0, second=0, microsecond=0)
+        key = (period, account.user_id, account.session_id or '', account.ip, model)
+        with self._lock:
+            totals = self._pending.get(key)
+            if totals is None:
+                totals = self._pending[key] = [0, 0, 0]
+            totals[0] += prompt
+            totals[1] += completion
+            totals[2] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(interval,), name='chat-usage', daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """Writes the pending usage; returns how many rows."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [
+            TokenUsage(
+                period=period, user_id=user_id, session_id=session_id, ip=ip, model=model,
+                prompt_tokens=prompt, completion_tokens=completion, calls=calls,
+            )
+            for (period, user_id, session_id, ip, model), (prompt, completion, calls) in pending.items()
+        ]
+        try:
+            run_write(TokenUsage.objects.bulk_create, rows)
+        except Exception:
+            # Kept for the next flush.
+            with self._lock:
+                for key, (prompt, completion, calls) in pending.items():
+                    totals = self._pending.setdefault(key, [0, 0, 0])
+                    totals[0] += prompt
+                    totals[1] += completion
+                    totals[2] += calls
+            raise
+        return len(rows)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def discard(self):
+        # Drops the pending usage unwritten (tests, benchmarks).
+        with self._lock:
+            self._pending.clear()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing token usage failed")
+            finally:
+                close_old_connections()
+
+
+class Quotas:
+    """Sliding-window token quotas per user, session and client address.
+
+    ``check`` runs before a chat turn does any database or upstream work and
+    raises QuotaExceeded when one of the client's windows is full; the turn
+    then ``charge``s the tokens the upstream reported. A request is admitted
+    while its client is under quota, so it may overshoot by its own usage.
+    Each window is two fixed ones, the older weighted by its overlap, which
+    needs two counters per key instead of a log of every request.
+    """
+
+    def __init__(self):
+        self.local = LocalCounters()
+        self.ledger = UsageLedger()
+
+    def counters(self, config):
+        if config['BACKEND']:
+            return CacheCounters(config['BACKEND'])
+        return self.local
+
+    def limits(self, account, config):
+        # [(level, counter key, limit)] of the account's limited levels.
+        return [
+            (level, f'{level}:{value}', config[setting])
+            for level, attribute, setting in LEVELS
+            if config[setting] is not None and (value := getattr(account, attribute)) is not None
+        ]
+
+    def clock(self, config):
+        # (window index, seconds into it)
+        now = time.time()
+        index = int(now // config['WINDOW'])
+        return index, now - index * config['WINDOW']
+
+    def verdict(self, limits, totals, elapsed, window):
+        waits = [
+            (seconds_until_under(limit, current, previous, elapsed, window), level)
+            for (level, _, limit), (current, previous) in zip(limits, totals)
+            if sliding_count(current, previous, elapsed, window) >= limit
+        ]
+        if waits:
+            retry_after, level = max(waits)
+            raise QuotaExceeded(level, retry_after)
+
+    def check(self, account):
+        config = quota_settings()
+        limits = self.limits(account, config)
+        if not limits:
+            return
+        index, elapsed = self.clock(config)
+        totals = self.counters(config).totals([key for _, key, _ in limits], index, config['WINDOW'])
+        self.verdict(limits, totals, elapsed, config['WINDOW'])
+
+    async def acheck(self, account):
+        config = quota_settings()
+        limits = self.limits(account, config)
+        if not limits:
+            return
+        index, elapsed = self.clock(config)
+        totals = await self.counters(config).atotals(
+            [key for _, key, _ in limits], index, config['WINDOW']
+        )
+        self.verdict(limits, totals, elapsed, config['WINDOW'])
+
+    def _record(self, account, model, tokens, config):
+        if config['FLUSH_INTERVAL'] is not None:
+            self.ledger.add(account, model, *tokens, config['FLUSH_INTERVAL'])
+
+    def charge(self, account, model, usage):
+        tokens = usage_tokens(usage)
+        if tokens is None:
+            return
+        config = quota_settings()
+        limits = self.limits(account, config)
+        if limits:
+            index, _ = self.clock(config)
+            self.counters(config).add([key for _, key, _ in limits], sum(tokens), index, config['WINDOW'])
+        self._record(account, model, tokens, config)
+
+    async def acharge(self, account, model, usage):
+        tokens = usage_tokens(usage)
+        if tokens is None:
+            return
+        config = quota_settings()
+        limits = self.limits(account, config)
+        if limits:
+            index, _ = self.clock(config)
+            await self.counters(config).aadd(
+                [key for _, key, _ in limits], sum(tokens), index, config['WINDOW']
+            )
+        self._record(account, model, tokens, config)
+
+    def reset(self):
+        # Forgets this process's counters and unwritten usage (tests).
+        self.local.reset()
+        self.ledger.discard()
+
+
+quotas = Quotas()
+
+
+class Account:
+    """Whom a chat turn's upstream tokens count against: an authenticated
+    user, a session and a client address, each optional.
+
+    Services given an account fill in ``session_id`` once a new session
+    has its id, so its usage is recorded under it.
+    """
+
+    def __init__(self, user_id=None, session_id=None, ip=None):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.ip = ip
+
+    def check(self):
+        quotas.check(self)
+
+    async def acheck(self):
+        await quotas.acheck(self)
+
+    def charge(self, model, usage):
+        quotas.charge(self, model, usage)
+
+    async def acharge(self, model, usage):
+        await quotas.acharge(self, model, usage)
+
+
+def parse_ip(value):
+    # The address in ``value``, normalised, or None; anything else a client
+    # put in a header never becomes a counter key.
+    try:
+        return str(ipaddress.ip_address((value or '').strip()))
+    except ValueError:
+        return None
+
+
+def request_account(request, user, session_id=None):
+    """The Account of an HTTP request. ``user`` is ``request.user``, or
+    ``await request.auser()`` in async views."""
+    return Account(
+        user.pk if user.is_authenticated else None,
+        session_id,
+        parse_ip(request.META.get(quota_settings()['IP_HEADER'])),
+    )
+
+
+def scope_account(scope, session_id=None):
+    """The Account of an ASGI connection (see chatbot/websocket.py), whose
+    ``scope['user']`` is set by an auth middleware stack, if any."""
+    header = quota_settings()['IP_HEADER']
+    if header == 'REMOTE_ADDR':
+        value = (scope.get('client') or (None,))[0]
+    else:
+        name = header.removeprefix('HTTP_').lower().replace('_', '-').encode('latin-1')
+        value = dict(scope.get('headers', [])).get(name, b'').decode('latin-1')
+    user = scope.get('user')
+    return Account(
+        user.pk if user is not None and user.is_authenticated else None,
+        session_id,
+        parse_ip(value),
+    )
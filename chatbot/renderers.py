@@ -0,0 +1,46 @@
+import json
+
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_encoder = JSONEncoder()
+
+if orjson is not None:
+    # Datetimes go through DRF's encoder, which writes UTC as Z; orjson's
+    # own format would change the wire format.
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def dumps(data):
+    """Compact UTF-8 JSON bytes, as DRF's JSONRenderer writes them; orjson
+    when it is installed."""
+    if orjson is not None:
+        content = orjson.dumps(data, default=_encoder.default, option=ORJSON_OPTIONS)
+    else:
+        content = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+    # Escaped by JSONRenderer too: they end lines in JavaScript.
+    return content.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class ORJSONRenderer(JSONRenderer):
+    # Falls back to JSONRenderer without orjson, and for indented output
+    # (the browsable API, or "Accept: application/json; indent=4").
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class FastJsonResponse(HttpResponse):
+    """JsonResponse for the plain Django views, encoded like ORJSONRenderer."""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
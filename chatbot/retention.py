@@ -0,0 +1,364 @@
+import gzip
+import io
+import json
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .history import history_cache
+from .models import ArchivedConversation, Conversation, Message
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DEFAULT_RETENTION_SETTINGS = {
+    # Conversations with no new turn for this many days are moved out of the
+    # hot tables into compressed archive files. None turns archival off.
+    'ARCHIVE_AFTER_DAYS': 90,
+    # Archived conversations idle for this many days are deleted for good.
+    # None keeps archives forever.
+    'PURGE_AFTER_DAYS': None,
+    # Where archive files are written. Defaults to BASE_DIR/archive.
+    'DIR': None,
+    # 'gzip', or 'zstd' (needs the zstandard package).
+    'COMPRESSION': 'gzip',
+    # Conversations per archive file.
+    'CHUNK_SIZE': 200,
+    # Message rows removed per DELETE; each batch is its own transaction,
+    # so the write lock is never held for long.
+    'DELETE_BATCH': 500,
+    # Seconds to sleep between delete batches, letting chat turns through.
+    'PAUSE': 0.0,
+}
+
+
+def retention_settings():
+    return {**DEFAULT_RETENTION_SETTINGS, **getattr(settings, 'CHAT_RETENTION', {})}
+
+
+def archive_dir():
+    directory = retention_settings()['DIR'] or os.path.join(settings.BASE_DIR, 'archive')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+SUFFIXES = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+CONVERSATION_FIELDS = (
+    'id', 'session_id', 'user_id', 'summary', 'summarized_through', 'last_seq', 'created_at', 'updated_at'
+)
+MESSAGE_FIELDS = ('id', 'role', 'content', 'timestamp', 'token_count', 'seq', 'interrupted')
+
+
+def open_archive(path, mode):
+    # Text-mode reader or writer ('rt' or 'wt') for an archive file, by suffix.
+    if path.endswith(SUFFIXES['zstd']):
+        if zstandard is None:
+            raise ImproperlyConfigured("zstd archives need the zstandard package.")
+        if mode == 'wt':
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return gzip.open(path, mode, encoding='utf-8')
+
+
+def archive_name(pks, compression):
+    # The chunk's first and last primary key, for people browsing the
+    # directory, and a random part: the same bounds recur when restored
+    # conversations are archived again, and their old file may still hold
+    # other conversations. Files of crashed runs are removed by purge()
+    # once older than PURGE_AFTER_DAYS.
+    if compression not in SUFFIXES:
+        raise ImproperlyConfigured(f"Unknown CHAT_RETENTION COMPRESSION: {compression!r}")
+    return f'conversations-{pks[0]:010d}-{pks[-1]:010d}-{uuid.uuid4().hex[:12]}{SUFFIXES[compression]}'
+
+
+def encode(value):
+    # Datetimes, with full precision (DjangoJSONEncoder keeps milliseconds).
+    return value.isoformat()
+
+
+def write_archive(path, records):
+    # Written beside the target and renamed into place, so a file that
+    # exists is always complete.
+    if os.path.exists(path):
+        raise FileExistsError(f"Archive {path} already exists")
+    partial = f'{path}.partial'
+    with open_archive(partial, 'wt') as file:
+        for record in records:
+            file.write(json.dumps(record, default=encode))
+            file.write('\n')
+    os.replace(partial, path)
+
+
+def read_record(archived):
+    path = os.path.join(archive_dir(), archived.file)
+    # Cheap substring test before parsing each line.
+    needle = json.dumps(archived.session_id)
+    with open_archive(path, 'rt') as file:
+        for line in file:
+            if needle in line:
+                record = json.loads(line)
+                if record['session_id'] == archived.session_id:
+                    return record
+    raise ValueError(f"{archived.session_id} is missing from {archived.file}")
+
+
+def conversation_records(pks):
+    """Archive records of the conversations ``pks``: each conversation's
+    fields plus its messages in ``seq`` order. Two queries per chunk."""
+    records = {
+        row['id']: {**row, 'messages': []}
+        for row in Conversation.objects.filter(pk__in=pks).order_by('pk').values(*CONVERSATION_FIELDS)
+    }
+    messages = (
+        Message.objects.filter(conversation_id__in=records)
+        .order_by('conversation_id', 'seq')
+        .values('conversation_id', *MESSAGE_FIELDS)
+    )
+    for message in messages:
+        records[message.pop('conversation_id')]['messages'].append(message)
+    return list(records.values())
+
+
+def delete_rows(model, pks):
+    # A plain DELETE. QuerySet.delete() would load every row to send
+    # post_delete, and the history-cache receivers query once per message;
+    # callers invalidate the cache themselves.
+    table = connection.ops.quote_name(model._meta.db_table)
+    placeholders = ', '.join(['%s'] * len(pks))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", list(pks))
+
+
+def load_messages(conversation_id, messages):
+    # Reinserts archived messages under their original ids. bulk_create
+    # stamps auto_now_add timestamps, so the archived ones are put back
+    # with bulk_update.
+    rows = [
+        Message(conversation_id=conversation_id, **{
+            field: message[field] for field in MESSAGE_FIELDS if field != 'timestamp'
+        })
+        for message in messages
+    ]
+    Message.objects.bulk_create(rows, batch_size=500)
+    for row, message in zip(rows, messages):
+        row.timestamp = parse_datetime(message['timestamp'])
+    Message.objects.bulk_update(rows, ['timestamp'], batch_size=500)
+
+
+def restore(session_id):
+    """Move an archived conversation back into the hot tables.
+
+    Returns the conversation, or None when ``session_id`` was never
+    archived. The conversation and its messages keep their original ids,
+    so links to them (search hits, message cursors) stay valid.
+    """
+    archived = ArchivedConversation.objects.filter(session_id=session_id).first()
+    if archived is None:
+        return None
+    record = read_record(archived)
+
+    user_id = record['user_id']
+    if user_id is not None and not User.objects.filter(pk=user_id).exists():
+        user_id = None
+    try:
+        with transaction.atomic():
+            conversation = Conversation(
+                id=record['id'],
+                session_id=session_id,
+                user_id=user_id,
+                summary=record['summary'],
+                summarized_through=record['summarized_through'],
+                last_seq=record['last_seq'],
+            )
+            # updated_at is now: being accessed again counts as activity.
+            conversation.save(force_insert=True)
+            conversation.created_at = parse_datetime(record['created_at'])
+            Conversation.objects.filter(pk=conversation.pk).update(created_at=conversation.created_at)
+            load_messages(conversation.pk, record['messages'])
+            archived.delete()
+    except IntegrityError:
+        # Restored meanwhile by another request.
+        return Conversation.objects.filter(session_id=session_id).first()
+    history_cache.invalidate(session_id)
+    return conversation
+
+
+arestore = sync_to_async(restore)
+
+
+def archived_sessions(session_ids):
+    return set(
+        ArchivedConversation.objects.filter(session_id__in=list(session_ids))
+        .values_list('session_id', flat=True)
+    )
+
+
+class Archiver:
+    """Moves idle conversations to archive files, ``CHUNK_SIZE`` at a time.
+
+    Each chunk is written to its archive file, then indexed in
+    ArchivedConversation, then evicted from the hot tables in short delete
+    batches. Rows that are indexed but still hot are the resume point: a
+    run that was interrupted is finished by the next one before it starts
+    new chunks. Eviction checks, in the transaction of every batch, that
+    the conversation had no new turn since it was archived; if it did, the
+    messages already deleted are put back and the archive entry dropped.
+    Run one Archiver at a time.
+    """
+
+    def __init__(self, days=None, config=None):
+        self.config = config or retention_settings()
+        if days is not None:
+            self.config['ARCHIVE_AFTER_DAYS'] = days
+        self.stats = {'archived': 0, 'messages': 0, 'reactivated': 0, 'purged': 0, 'files_removed': 0}
+
+    def cutoff(self, days):
+        return timezone.now() - timedelta(days=days)
+
+    def idle(self, limit):
+        return list(
+            Conversation.objects.filter(updated_at__lt=self.cutoff(self.config['ARCHIVE_AFTER_DAYS']))
+            .exclude(session_id__in=ArchivedConversation.objects.values('session_id'))
+            .order_by('pk').values_list('pk', flat=True)[:limit]
+        )
+
+    def run(self, limit=None):
+        if self.config['ARCHIVE_AFTER_DAYS'] is None:
+            return self.stats
+        self.evict_pending()
+        chunk_size = self.config['CHUNK_SIZE']
+        while limit is None or self.stats['archived'] < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - self.stats['archived'])
+            pks = self.idle(size)
+            if not pks:
+                break
+            self.archive_chunk(pks)
+        return self.stats
+
+    def archive_chunk(self, pks):
+        # Conversations with a turn since idle() ran stay hot.
+        cutoff = self.cutoff(self.config['ARCHIVE_AFTER_DAYS'])
+        records = [record for record in conversation_records(pks) if record['updated_at'] < cutoff]
+        if not records:
+            return
+        name = archive_name(pks, self.config['COMPRESSION'])
+        write_archive(os.path.join(archive_dir(), name), records)
+        ArchivedConversation.objects.bulk_create([
+            ArchivedConversation(
+                session_id=record['session_id'],
+                file=name,
+                message_count=len(record['messages']),
+                last_activity=record['updated_at'],
+            )
+            for record in records
+        ])
+        self.evict_pending()
+
+    def evict_pending(self):
+        # Archived conversations still in the hot tables.
+        pending = dict(
+            Conversation.objects.filter(session_id__in=ArchivedConversation.objects.values('session_id'))
+            .values_list('session_id', 'pk')
+        )
+        for archived in ArchivedConversation.objects.filter(session_id__in=list(pending)).order_by('pk'):
+            self.evict(pending[archived.session_id], archived)
+
+    def evict(self, pk, archived):
+        batch = self.config['DELETE_BATCH']
+        while True:
+            with transaction.atomic():
+                # Locks the row on databases that can, so a turn cannot
+                # start between this check and the delete.
+                idle = (
+                    Conversation.objects.select_for_update()
+                    .filter(pk=pk, updated_at__lte=archived.last_activity).exists()
+                )
+                if not idle:
+                    self.reactivate(pk, archived)
+                    return
+                ids = list(Message.objects.filter(conversation_id=pk).values_list('pk', flat=True)[:batch])
+                if ids:
+                    delete_rows(Message, ids)
+                else:
+                    delete_rows(Conversation, [pk])
+            if not ids:
+                break
+            self.stats['messages'] += len(ids)
+            if self.config['PAUSE']:
+                time.sleep(self.config['PAUSE'])
+
+        history_cache.invalidate(archived.session_id)
+        self.stats['archived'] += 1
+
+    def reactivate(self, pk, archived):
+        # A turn arrived after archival: the hot copy wins.
+        present = set(Message.objects.filter(conversation_id=pk).values_list('pk', flat=True))
+        missing = [message for message in read_record(archived)['messages'] if message['id'] not in present]
+        if missing:
+            load_messages(pk, missing)
+            self.stats['messages'] -= len(missing)
+        archived.delete()
+        history_cache.invalidate(archived.session_id)
+        self.stats['reactivated'] += 1
+
+    def purge(self):
+        """Forget archives idle past PURGE_AFTER_DAYS and remove archive files
+        older than that which no entry points to any more (all purged or
+        restored)."""
+        days = self.config['PURGE_AFTER_DAYS']
+        if days is None:
+            return self.stats
+        cutoff = self.cutoff(days)
+        expired = ArchivedConversation.objects.filter(last_activity__lt=cutoff)
+        while ids := list(expired.values_list('pk', flat=True)[:self.config['DELETE_BATCH']]):
+            delete_rows(ArchivedConversation, ids)
+            self.stats['purged'] += len(ids)
+
+        # Newer files may belong to a run that has not indexed them yet, and
+        # .partial ones to a run still writing them.
+        directory = archive_dir()
+        used = set(ArchivedConversation.objects.values_list('file', flat=True).distinct())
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if (
+                name.startswith('conversations-') and not name.endswith('.partial')
+                and name not in used and os.path.getmtime(path) < cutoff.timestamp()
+            ):
+                os.remove(path)
+                self.stats['files_removed'] += 1
+        return self.stats
+
+
+def compact(vacuum=False, analyze=True):
+    """Refresh planner statistics and, with ``vacuum``, give the space freed
+    by archival back to the filesystem. VACUUM rewrites the whole SQLite
+    file under an exclusive lock, so schedule it off-peak."""
+    tables = [
+        connection.ops.quote_name(model._meta.db_table)
+        for model in (Conversation, Message, ArchivedConversation)
+    ]
+    with connection.cursor() as cursor:
+        if vacuum and connection.vendor == 'sqlite':
+            cursor.execute("VACUUM")
+        elif vacuum and connection.vendor == 'postgresql':
+            for table in tables:
+                cursor.execute(f"VACUUM {table}")
+        if analyze:
+            keyword = 'ANALYZE TABLE' if connection.vendor == 'mysql' else 'ANALYZE'
+            for table in tables:
+                cursor.execute(f"{keyword} {table}")
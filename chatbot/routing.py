@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .upstream import UpstreamScheduler
+
+
+DEFAULT_ROUTING_SETTINGS = {
+    # Tried cheapest TIER first. Keys per route: NAME, MODEL, and optionally
+    # BASE_URL and API_KEY (default: the OPENAI_* settings), TIER,
+    # MAX_PROMPT_TOKENS (longer prompts skip the route), TIMEOUT (seconds
+    # before failing over) and UPSTREAM (CHAT_UPSTREAM overrides).
+    'ROUTES': [
+        {'NAME': 'default', 'MODEL': 'gpt-3.5-turbo'},
+    ],
+    'PREFER_FASTER': True,
+    'LATENCY_WINDOW': 300,
+    'SLOW_P95': None,
+    'FAILURE_PENALTY': 30.0,
+}
+
+
+def routing_settings():
+    return {**DEFAULT_ROUTING_SETTINGS, **getattr(settings, 'CHAT_ROUTING', {})}
+
+
+class LatencyTracker:
+    """Rolling latency samples of one backend over the last ``window`` seconds."""
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = deque()
+
+    def _expire(self, now):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+    def observe(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, seconds))
+            self._expire(now)
+
+    def percentile(self, pct):
+        with self._lock:
+            self._expire(time.monotonic())
+            values = sorted(seconds for _, seconds in self._samples)
+        if not values:
+            return None
+        return values[min(len(values) - 1, len(values) * pct // 100)]
+
+    def snapshot(self):
+        return {'p50': self.percentile(50), 'p95': self.percentile(95)}
+
+
+class Route:
+    def __init__(self, config, window):
+        self.name = config['NAME']
+        self.model = config['MODEL']
+        self.base_url = config.get('BASE_URL')
+        self.api_key = config.get('API_KEY')
+        self.tier = config.get('TIER', 0)
+        self.max_prompt_tokens = config.get('MAX_PROMPT_TOKENS')
+        self.timeout = config.get('TIMEOUT')
+        self.scheduler = UpstreamScheduler(self.name, config.get('UPSTREAM'))
+        self.latency = LatencyTracker(window)
+
+    def fits(self, prompt_tokens):
+        return self.max_prompt_tokens is None or prompt_tokens <= self.max_prompt_tokens
+
+    def client(self, default, build):
+        # Routes on the default endpoint share the service's client; others
+        # get a pooled one from ``build(api_key=..., base_url=...)``.
+        if self.base_url or self.api_key:
+            client = build(api_key=self.api_key, base_url=self.base_url)
+        else:
+            client = default
+        if self.timeout is not None:
+            client = client.with_options(timeout=self.timeout)
+        return client
+
+
+class ModelRouter:
+    """Chooses which backend answers a prompt, and in which order to fall back.
+
+    Routes whose ``MAX_PROMPT_TOKENS`` the prompt exceeds are skipped (unless
+    none would be left). The rest are ordered by cost ``TIER``; within a
+    tier, routes whose rolling p95 exceeds ``SLOW_P95`` go last and, with
+    ``PREFER_FASTER``, the lower p50 goes first. Failures count as a
+    ``FAILURE_PENALTY`` latency sample, so a failing backend drifts back
+    until its samples age out of ``LATENCY_WINDOW``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = None
+
+    def routes(self):
+        config = routing_settings()
+        key = repr((config['ROUTES'], config['LATENCY_WINDOW']))
+        with self._lock:
+            if self._routes is None or self._routes[0] != key:
+                routes = [Route(route, config['LATENCY_WINDOW']) for route in config['ROUTES']]
+                self._routes = key, routes
+            return self._routes[1]
+
+    def primary(self):
+        return self.routes()[0]
+
+    def candidates(self, prompt_tokens):
+        config = routing_settings()
+        routes = self.routes()
+        fitting = [route for route in routes if route.fits(prompt_tokens)] or routes
+
+        def rank(indexed):
+            index, route = indexed
+            p50, p95 = route.latency.percentile(50), route.latency.percentile(95)
+            slow = config['SLOW_P95'] is not None and p95 is not None and p95 > config['SLOW_P95']
+            faster = (p50 or 0.0) if config['PREFER_FASTER'] else 0.0
+            return route.tier, slow, faster, index
+
+        return [route for _, route in sorted(enumerate(fitting), key=rank)]
+
+    def record_failure(self, route):
+        route.latency.observe(routing_settings()['FAILURE_PENALTY'])
+
+    def stats(self):
+        return {route.name: route.latency.snapshot() for route in self.routes()}
+
+
+router = ModelRouter()
@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.utils import timezone
+
+
+DEFAULT_SERIALIZATION_SETTINGS = {
+    # Conversation endpoints read .values() rows and map them with RowMapper
+    # instead of going through the ModelSerializers. Same output.
+    'FAST': True,
+    # Brotli (with the brotli package) or gzip for JSON responses of at least
+    # this many bytes; None turns compression off. See chatbot/middleware.py.
+    'COMPRESS_MIN_BYTES': 16 * 1024,
+}
+
+
+def serialization_settings():
+    return {**DEFAULT_SERIALIZATION_SETTINGS, **getattr(settings, 'CHAT_SERIALIZATION', {})}
+
+
+def datetime_formatter():
+    # What DRF's DateTimeField outputs: ISO 8601 in the current time zone,
+    # with UTC written as Z.
+    zone = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def format(value):
+        if value is None:
+            return None
+        if zone is not None and timezone.is_aware(value):
+            value = value.astimezone(zone)
+        text = value.isoformat()
+        return text[:-6] + 'Z' if text.endswith('+00:00') else text
+
+    return format
+
+
+class RowMapper:
+    """Maps ``.values()`` rows to the dicts a ModelSerializer would output.
+
+    ``fields`` are the columns, in output order; ``datetimes`` are those
+    formatted like DRF's DateTimeField. Which columns need converting is
+    worked out once here, so a row costs one dict comprehension rather
+    than a walk over serializer fields.
+    """
+
+    def __init__(self, fields, datetimes=()):
+        self.columns = list(fields)
+        self._datetimes = frozenset(datetimes)
+
+    def _mapper(self):
+        # (name, converter or None) per column, bound to the current zone.
+        dt = datetime_formatter()
+        plan = [(name, dt if name in self._datetimes else None) for name in self.columns]
+
+        def map_row(row):
+            return {
+                name: row[name] if convert is None else convert(row[name])
+                for name, convert in plan
+            }
+
+        return map_row
+
+    def one(self, row):
+        return self._mapper()(row)
+
+    def many(self, rows):
+        map_row = self._mapper()
+        return [map_row(row) for row in rows]
+
+    def instance(self, obj):
+        # For a model instance already loaded (e.g. by get_object()).
+        return self.one({column: getattr(obj, column) for column in self.columns})
+
+
+# Mirrors of the serializers in chatbot/serializers.py; keep them in step.
+MESSAGE_ROWS = RowMapper(['id', 'role', 'content', 'timestamp', 'interrupted'], datetimes={'timestamp'})
+CONVERSATION_ROWS = RowMapper(['id', 'session_id', 'created_at', 'updated_at'], datetimes={'created_at', 'updated_at'})
+SUMMARY_ROWS = RowMapper(
+    ['id', 'session_id', 'message_count', 'last_message_at', 'created_at', 'updated_at'],
+    datetimes={'last_message_at', 'created_at', 'updated_at'},
+)
+
+
+def conversation_data(conversation):
+    """ConversationSerializer(conversation).data, from one .values() query
+    for the messages."""
+    data = CONVERSATION_ROWS.instance(conversation)
+    rows = MESSAGE_ROWS.many(conversation.messages.values(*MESSAGE_ROWS.columns))
+    # Same key order as ConversationSerializer.
+    return {
+        'id': data['id'], 'session_id': data['session_id'], 'messages': rows,
+        'created_at': data['created_at'], 'updated_at': data['updated_at'],
+    }
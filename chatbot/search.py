@@ -0,0 +1,293 @@
+import html
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from .models import Message
+
+
+DEFAULT_SEARCH_SETTINGS = {
+    # Dotted path of a SearchBackend subclass; None picks one for the
+    # database: SQLite FTS5, PostgreSQL full-text search, else ScanBackend.
+    'BACKEND': None,
+    # Roughly how many words of context each snippet shows.
+    'SNIPPET_WORDS': 12,
+    # Text search configuration of the PostgreSQL index.
+    'POSTGRES_CONFIG': 'english',
+}
+
+
+def search_settings():
+    return {**DEFAULT_SEARCH_SETTINGS, **getattr(settings, 'CHAT_SEARCH', {})}
+
+
+# Backends wrap matches in these; render_snippet turns them into <mark>
+# after HTML-escaping the text around them.
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+_term = re.compile(r'\w+\*?')
+
+
+def search_terms(query):
+    # Words of the query, each optionally ending in * for a prefix match.
+    # Everything else (quotes, operators, punctuation) is dropped, so user
+    # input can never be a syntax error.
+    return _term.findall(query)
+
+
+def render_snippet(text):
+    return html.escape(text).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+class SearchBackend:
+    """Ranked full-text search over message content.
+
+    ``search`` returns Message instances, best match first, each with
+    ``session_id``, ``snippet`` (HTML with ``<mark>`` around the matches)
+    and ``rank`` (higher is better) attributes. Backends that keep an index
+    install it from a migration and can rebuild it with
+    ``manage.py search_index``.
+    """
+
+    def search(self, query, offset, limit, session_id=None, role=None):
+        raise NotImplementedError
+
+    def install(self, schema_editor):
+        pass
+
+    def uninstall(self, schema_editor):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def optimize(self):
+        pass
+
+    def filters(self, session_id, role):
+        # SQL conditions and their params, on aliases m (message) and c
+        # (conversation).
+        conditions, params = [], []
+        if session_id:
+            conditions.append('c.session_id = %s')
+            params.append(session_id)
+        if role:
+            conditions.append('m.role = %s')
+            params.append(role)
+        return ''.join(f' AND {condition}' for condition in conditions), params
+
+    def finish(self, messages):
+        for message in messages:
+            message.snippet = render_snippet(message.snippet)
+        return messages
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """SQLite FTS5 index over chatbot_message.content.
+
+    ``chatbot_message_fts`` is an external-content FTS5 table: it stores
+    only the index, reading text back from chatbot_message by rowid.
+    Triggers keep it in step with every insert, update and delete,
+    including bulk_create and queryset deletes, which send no signals.
+
+    SQLite drops a table's triggers when a migration rebuilds it (most
+    AlterField/AddField operations on Message do), so such migrations must
+    end by calling ``install`` again; ``manage.py search_index --rebuild``
+    repairs a database where that was missed.
+    """
+
+    table = 'chatbot_message_fts'
+
+    def install(self, schema_editor):
+        for statement in (
+            f"""CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5(
+                content, content='chatbot_message', content_rowid='id',
+                tokenize='porter unicode61 remove_diacritics 2'
+            )""",
+            f"""CREATE TRIGGER IF NOT EXISTS {self.table}_ai AFTER INSERT ON chatbot_message BEGIN
+                INSERT INTO {self.table}(rowid, content) VALUES (new.id, new.content);
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {self.table}_ad AFTER DELETE ON chatbot_message BEGIN
+                INSERT INTO {self.table}({self.table}, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {self.table}_au
+                AFTER UPDATE OF content ON chatbot_message BEGIN
+                INSERT INTO {self.table}({self.table}, rowid, content)
+                VALUES ('delete', old.id, old.content);
+                INSERT INTO {self.table}(rowid, content) VALUES (new.id, new.content);
+            END""",
+        ):
+            schema_editor.execute(statement)
+        # Index the rows that predate the table.
+        schema_editor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')")
+        _fts5_installed.pop(schema_editor.connection.settings_dict['NAME'], None)
+
+    def uninstall(self, schema_editor):
+        for trigger in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {self.table}_{trigger}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {self.table}")
+        _fts5_installed.pop(schema_editor.connection.settings_dict['NAME'], None)
+
+    def rebuild(self):
+        with connection.schema_editor() as schema_editor:
+            self.install(schema_editor)
+
+    def optimize(self):
+        # Merges the index's b-trees into one; worth running after bulk loads.
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('optimize')")
+
+    def search(self, query, offset, limit, session_id=None, role=None):
+        terms = search_terms(query)
+        if not terms:
+            return []
+        # Each term quoted, so FTS5 reads it as a plain token; a trailing *
+        # outside the quotes keeps prefix matching.
+        match = ' '.join(
+            f'"{term.rstrip("*")}"' + ('*' if term.endswith('*') else '') for term in terms
+        )
+        where, params = self.filters(session_id, role)
+        sql = f"""
+            SELECT m.id, m.conversation_id, m.role, m.content, m.seq, m.timestamp,
+                   m.interrupted, c.session_id,
+                   snippet({self.table}, 0, %s, %s, '…', %s) AS snippet,
+                   -bm25({self.table}) AS rank
+            FROM {self.table}
+            JOIN chatbot_message m ON m.id = {self.table}.rowid
+            JOIN chatbot_conversation c ON c.id = m.conversation_id
+            WHERE {self.table} MATCH %s{where}
+            ORDER BY bm25({self.table}), m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        return self.finish(list(Message.objects.raw(sql, [
+            MARK_START, MARK_END, search_settings()['SNIPPET_WORDS'], match, *params, limit, offset
+        ])))
+
+
+class PostgresBackend(SearchBackend):
+    """PostgreSQL full-text search on a GIN expression index.
+
+    Postgres maintains the index itself, so there is nothing to keep in
+    sync; queries use websearch_to_tsquery, which accepts any user input.
+    """
+
+    index = 'chatbot_message_content_fts'
+
+    def vector(self):
+        return f"to_tsvector('{search_settings()['POSTGRES_CONFIG']}', m.content)"
+
+    def install(self, schema_editor):
+        config = search_settings()['POSTGRES_CONFIG']
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.index} ON chatbot_message "
+            f"USING GIN (to_tsvector('{config}', content))"
+        )
+
+    def uninstall(self, schema_editor):
+        schema_editor.execute(f"DROP INDEX IF EXISTS {self.index}")
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"REINDEX INDEX {self.index}")
+
+    def optimize(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE chatbot_message")
+
+    def search(self, query, offset, limit, session_id=None, role=None):
+        if not search_terms(query):
+            return []
+        config = search_settings()
+        words = config['SNIPPET_WORDS']
+        options = (
+            f'StartSel={MARK_START}, StopSel={MARK_END}, '
+            f'MaxWords={words}, MinWords={max(1, words // 2)}'
+        )
+        where, params = self.filters(session_id, role)
+        sql = f"""
+            SELECT m.id, m.conversation_id, m.role, m.content, m.seq, m.timestamp,
+                   m.interrupted, c.session_id,
+                   ts_headline(%s, m.content, q, %s) AS snippet,
+                   ts_rank({self.vector()}, q) AS rank
+            FROM chatbot_message m
+            JOIN chatbot_conversation c ON c.id = m.conversation_id,
+                 websearch_to_tsquery(%s, %s) q
+            WHERE {self.vector()} @@ q{where}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        return self.finish(list(Message.objects.raw(sql, [
+            config['POSTGRES_CONFIG'], options, config['POSTGRES_CONFIG'], query, *params, limit, offset
+        ])))
+
+
+class ScanBackend(SearchBackend):
+    """Unindexed fallback: every term must occur (case-insensitively), newest
+    first. Reads every message, so only fit for small databases."""
+
+    def search(self, query, offset, limit, session_id=None, role=None):
+        terms = [term.rstrip('*') for term in search_terms(query)]
+        if not terms:
+            return []
+        messages = Message.objects.annotate(session_id=F('conversation__session_id'))
+        for term in terms:
+            messages = messages.filter(content__icontains=term)
+        if session_id:
+            messages = messages.filter(conversation__session_id=session_id)
+        if role:
+            messages = messages.filter(role=role)
+
+        results = list(messages.order_by('-id')[offset:offset + limit])
+        words = search_settings()['SNIPPET_WORDS']
+        pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+        for message in results:
+            message.snippet = self.snippet(message.content, pattern, words)
+            message.rank = 0.0
+        return self.finish(results)
+
+    def snippet(self, content, pattern, words):
+        # ``words`` words, starting a little before the first match.
+        tokens = content.split()
+        first = next((i for i, token in enumerate(tokens) if pattern.search(token)), 0)
+        start = max(0, first - words // 2)
+        text = ' '.join(tokens[start:start + words])
+        marked = pattern.sub(lambda match: f'{MARK_START}{match.group(0)}{MARK_END}', text)
+        return ('…' if start else '') + marked + ('…' if start + words < len(tokens) else '')
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteFTSBackend,
+    'postgresql': PostgresBackend,
+}
+
+
+# Database name -> whether its FTS5 table exists, looked up once per process.
+_fts5_installed = {}
+
+
+def fts5_installed():
+    # False on SQLite builds without FTS5, where the migration skipped it.
+    name = connection.settings_dict['NAME']
+    installed = _fts5_installed.get(name)
+    if installed is None:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                [SQLiteFTSBackend.table]
+            )
+            installed = _fts5_installed[name] = cursor.fetchone() is not None
+    return installed
+
+
+def search_backend():
+    path = search_settings()['BACKEND']
+    if path:
+        return import_string(path)()
+    if connection.vendor == 'sqlite' and not fts5_installed():
+        return ScanBackend()
+    return VENDOR_BACKENDS.get(connection.vendor, ScanBackend)()
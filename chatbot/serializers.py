@@ -1,12 +1,13 @@
 from rest_framework import serializers
-from .models import Conversation, Message
+from .models import ChatJob, Conversation, Message
+from .webhooks import WebhookRefused, check_url
 
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['id', 'role', 'content', 'timestamp']
-        read_only_fields = ['id', 'timestamp']
+        fields = ['id', 'role', 'content', 'timestamp', 'interrupted']
+        read_only_fields = ['id', 'timestamp', 'interrupted']
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -18,9 +19,72 @@ class ConversationSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
 
+class ConversationSummarySerializer(serializers.ModelSerializer):
+    # List representation: no nested messages. Both counts come from
+    # annotations on the queryset (see ConversationViewSet.get_queryset).
+    message_count = serializers.IntegerField(read_only=True)
+    last_message_at = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = Conversation
+        fields = ['id', 'session_id', 'message_count', 'last_message_at', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
 class ChatRequestSerializer(serializers.Serializer):
     message = serializers.CharField()
     session_id = serializers.CharField(required=False)
+    stream = serializers.BooleanField(required=False, default=False)
+    # False skips the response cache lookup for this request.
+    cache = serializers.BooleanField(required=False, default=True)
+    # True queues the turn as a ChatJob and answers 202 with its id at once.
+    background = serializers.BooleanField(required=False, default=False)
+    webhook_url = serializers.URLField(required=False, allow_blank=True, default='')
+
+    def validate_webhook_url(self, value):
+        # Host names are resolved and checked again when the job is done.
+        if value:
+            try:
+                check_url(value, resolve=False)
+            except WebhookRefused as e:
+                raise serializers.ValidationError(str(e))
+        return value
+
+    def validate(self, data):
+        if data['stream'] and data['background']:
+            raise serializers.ValidationError("stream and background cannot be combined.")
+        if data['webhook_url'] and not data['background']:
+            raise serializers.ValidationError("webhook_url needs background.")
+        return data
+
+
+class CancelRequestSerializer(serializers.Serializer):
+    session_id = serializers.CharField()
+
+
+class SearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=200)
+    session_id = serializers.CharField(required=False)
+    role = serializers.ChoiceField(choices=Message.ROLE_CHOICES, required=False)
 
 
+class SearchHitSerializer(serializers.ModelSerializer):
+    # session_id, snippet and rank are set on each hit by the search backend.
+    message_id = serializers.IntegerField(source='id', read_only=True)
+    session_id = serializers.CharField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+    rank = serializers.FloatField(read_only=True)
 
+    class Meta:
+        model = Message
+        fields = ['message_id', 'session_id', 'role', 'seq', 'timestamp', 'snippet', 'rank', 'interrupted']
+        read_only_fields = fields
+
+
+class ChatJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.UUIDField(source='id', read_only=True)
+
+    class Meta:
+        model = ChatJob
+        fields = ['job_id', 'status', 'session_id', 'result', 'created_at', 'started_at', 'finished_at']
+        read_only_fields = fields
@@ -1,77 +1,691 @@
-from openai import OpenAI
-from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+from openai import OpenAI, AsyncOpenAI
+from .cache import prompt_key, response_cache
+from .cancellation import GenerationCancelled, generations
+from .coalesce import single_flight
+from .clients import get_client, get_async_client
+from .context import ContextWindow, count_tokens, message_tokens
+from .history import aload_history, history_cache, load_history, unsummarized
+from .metrics import observe_stage, record_usage, stage
 from .models import Conversation, Message
+from .quotas import plain_usage
+from .retention import arestore, restore
+from .sqlite import run_write
+from .summary import fold_count, run_in_background, summary_request, summary_settings
+from .routing import router
+from .upstream import UpstreamBusy
+from functools import partial
+import asyncio
+import logging
+import time
 import uuid
 
 
+logger = logging.getLogger(__name__)
+
+# Keeps fire-and-forget summary tasks referenced until they finish.
+_background_tasks = set()
+
+
+def new_message(conversation, role, content, interrupted=False):
+    # Built unsaved so a turn's messages can be written together. bulk_create
+    # bypasses Message.save(), so the token count is filled in here.
+    return Message(
+        conversation=conversation,
+        role=role,
+        content=content,
+        token_count=count_tokens(content),
+        interrupted=interrupted
+    )
+
+
+def interrupted_turn(conversation, user, chunks):
+    # The messages to save for a turn cut short: the user message, marked,
+    # and whatever part of the reply had been generated.
+    user.interrupted = True
+    if not chunks:
+        return [user]
+    return [user, new_message(conversation, 'assistant', ''.join(chunks), interrupted=True)]
+
+
+def write_turn(conversation, messages):
+    # One transaction per turn: a single commit (one fsync on SQLite) for
+    # the message rows and the conversation's updated_at bump.
+    with transaction.atomic():
+        first_seq = Conversation.allocate_seq(
+            conversation.pk, len(messages), updated_at=timezone.now()
+        )
+        for seq, message in enumerate(messages, start=first_seq):
+            message.seq = seq
+        Message.objects.bulk_create(messages)
+    conversation.last_seq = messages[-1].seq
+
+
+def fill_window(conversation, history, model):
+    return ContextWindow(model, summary=conversation.summary).fill(history)
+
+
+def prompt_tokens(history):
+    return sum(message_tokens(message) for message in history)
+
+
+def reply_result(reply, conversation, route):
+    return {
+        'message': reply,
+        'session_id': conversation.session_id,
+        'conversation_id': conversation.id,
+        'backend': route.name,
+        'model': route.model
+    }
+
+
+def error_result(error, conversation):
+    result = {
+        'error': str(error),
+        'session_id': conversation.session_id
+    }
+    if isinstance(error, UpstreamBusy):
+        result['retry_after'] = error.retry_after
+    return result
+
+
+def cancelled_result(conversation, chunks=()):
+    return {
+        'cancelled': True,
+        'message': ''.join(chunks),
+        'session_id': conversation.session_id,
+        'conversation_id': conversation.id
+    }
+
+
+def save_turn(conversation, *messages, serialize=None):
+    # ``serialize``: see run_write.
+    with stage('persistence'):
+        run_write(write_turn, conversation, messages, serialize=serialize)
+
+    # bulk_create sends no post_save, so extend the history cache here, once
+    # committed. Backends that do not return primary keys are caught up by
+    # load_history.
+    transaction.on_commit(partial(append_turn, conversation.session_id, messages))
+
+
+def append_turn(session_id, messages):
+    for message in messages:
+        if message.pk is not None:
+            history_cache.append(session_id, message)
+
+
+asave_turn = sync_to_async(save_turn)
+
+
+def owner_id(account):
+    # The authenticated user new conversations belong to.
+    return account.user_id if account is not None else None
+
+
 class ChatbotService:
-    def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        self.model = "gpt-3.5-turbo"
+    def __init__(self, client=None, account=None, serialize_writes=None):
+        self.client = client or get_client(OpenAI)
+        self.model = router.primary().model
+        # Whom upstream tokens are charged to (see chatbot/quotas.py).
+        self.account = account
+        # Whether turns go through the SQLite writer queue; None follows
+        # SQLITE_TUNING SERIALIZE_WRITES.
+        self.serialize_writes = serialize_writes
+
+    def client_for(self, route):
+        return route.client(self.client, partial(get_client, OpenAI))
+
+    def charge(self, model, usage):
+        if self.account is not None:
+            self.account.charge(model, usage)
+
+    def save_turn(self, conversation, *messages):
+        save_turn(conversation, *messages, serialize=self.serialize_writes)
 
     def get_or_create_conversation(self, session_id=None):
-        if session_id:
-            conversation, created = Conversation.objects.get_or_create(
-                session_id=session_id
-            )
-        else:
-            session_id = str(uuid.uuid4())
-            conversation = Conversation.objects.create(session_id=session_id)
+        with stage('conversation'):
+            if session_id:
+                try:
+                    conversation = Conversation.objects.get(session_id=session_id)
+                except Conversation.DoesNotExist:
+                    # Archived sessions come back on first use.
+                    conversation = restore(session_id) or Conversation.objects.get_or_create(
+                        session_id=session_id, defaults={'user_id': owner_id(self.account)}
+                    )[0]
+            else:
+                session_id = str(uuid.uuid4())
+                conversation = Conversation.objects.create(
+                    session_id=session_id, user_id=owner_id(self.account)
+                )
 
+        if self.account is not None:
+            self.account.session_id = conversation.session_id
         return conversation
 
     def get_conversation_history(self, conversation):
-        messages = conversation.messages.all()
         return [
             {"role": msg.role, "content": msg.content}
-            for msg in messages
+            for msg in load_history(conversation)
         ]
 
-    def chat(self, user_message, session_id=None):
+    def prompt_history(self, conversation, *pending):
+        # pending: unsaved messages of the current turn, sent after history.
+        with stage('history'):
+            history = load_history(conversation)
+        return [*unsummarized(history, conversation.summarized_through), *pending]
+
+    def build_messages(self, conversation, *pending, model=None):
+        return fill_window(
+            conversation, self.prompt_history(conversation, *pending), model or self.model
+        )
+
+    def update_summary(self, conversation):
+        # Folds all but the KEEP_RECENT newest unsummarised messages into the
+        # running summary once EVERY more of them have piled up.
+        config = summary_settings()
+        pending = unsummarized(load_history(conversation), conversation.summarized_through)
+        count = fold_count(len(pending), config)
+        if not count:
+            return False
+
+        folded = pending[:count]
+        request = summary_request(conversation.summary, folded)
+        route = router.primary()
+        client = self.client_for(route)
+        response = route.scheduler.call(lambda: client.chat.completions.create(
+            model=config['MODEL'] or route.model,
+            messages=request,
+            max_tokens=config['MAX_TOKENS']
+        ), request)
+        self.charge(config['MODEL'] or route.model, response.usage)
+        summary = response.choices[0].message.content
+
+        # Conditional on the old watermark so concurrent refreshes of the same
+        # conversation cannot overwrite a newer summary with an older one.
+        updated = Conversation.objects.filter(
+            pk=conversation.pk, summarized_through=conversation.summarized_through
+        ).update(summary=summary, summarized_through=folded[-1].pk)
+        if updated:
+            conversation.summary = summary
+            conversation.summarized_through = folded[-1].pk
+        return bool(updated)
+
+    def maybe_summarize(self, conversation):
+        config = summary_settings()
+        if not config['ENABLED']:
+            return
+        if config['BACKGROUND']:
+            run_in_background(self.update_summary, conversation)
+            return
+        try:
+            self.update_summary(conversation)
+        except Exception:
+            logger.exception("Conversation summary failed")
+
+    def complete(self, route, messages):
+        # Paced, retried and circuit-broken by the route's scheduler.
+        client = self.client_for(route)
+        started = time.monotonic()
+        try:
+            response = route.scheduler.call(lambda: client.chat.completions.create(
+                model=route.model,
+                messages=messages
+            ), messages)
+        except Exception:
+            # Here, not in answer(): callers sharing this call through
+            # single_flight get its error too, but it is one failure.
+            router.record_failure(route)
+            raise
+        elapsed = time.monotonic() - started
+        route.latency.observe(elapsed)
+        observe_stage('upstream', elapsed)
+        record_usage(route.model, response.usage)
+        # The usage goes along with the reply, so every caller that shares
+        # it through single_flight is charged for it.
+        return response.choices[0].message.content, plain_usage(response.usage)
+
+    def answer(self, conversation, history, use_cache=True):
+        # Returns (route, reply) from the first backend that answers.
+        error = None
+        for route in router.candidates(prompt_tokens(history)):
+            messages = fill_window(conversation, history, route.model)
+            # Answer from the cache when the same prompt was answered recently
+            reply = response_cache.get(route.model, messages) if use_cache else None
+            if reply is not None:
+                return route, reply
+            try:
+                # Identical prompts in flight at the same time share one call
+                reply, usage = single_flight.do(
+                    prompt_key(route.model, messages), self.complete, route, messages
+                )
+            except Exception as e:
+                logger.warning("Backend %s failed, falling back: %s", route.name, e)
+                error = e
+                continue
+            self.charge(route.model, usage)
+            response_cache.set(route.model, messages, reply)
+            return route, reply
+        raise error
+
+    def open_stream(self, conversation, history, routes):
+        # Returns (route, messages, stream); falls back only before the
+        # first token, as a half-sent reply cannot be switched.
+        error = None
+        for route in routes:
+            messages = fill_window(conversation, history, route.model)
+            client = self.client_for(route)
+            started = time.monotonic()
+            try:
+                stream = route.scheduler.call(lambda: client.chat.completions.create(
+                    model=route.model,
+                    messages=messages,
+                    stream=True,
+                    # A last chunk with response.usage, for the token metrics
+                    stream_options={'include_usage': True}
+                ), messages)
+            except Exception as e:
+                logger.warning("Backend %s failed, falling back: %s", route.name, e)
+                router.record_failure(route)
+                error = e
+                continue
+            route.latency.observe(time.monotonic() - started)
+            return route, messages, stream
+        raise error
+
+    def chat(self, user_message, session_id=None, use_cache=True):
         # Get or create conversation
         conversation = self.get_or_create_conversation(session_id)
+        return self.reply(conversation, user_message, use_cache)
 
-        # Save user message
-        Message.objects.create(
-            conversation=conversation,
-            role='user',
-            content=user_message
-        )
+    def reply(self, conversation, user_message, use_cache=True):
+        # One chat turn on an already loaded conversation (see chatbot/batch.py).
+
+        # The user message is saved together with the reply
+        user = new_message(conversation, 'user', user_message)
 
         # Get conversation history
-        messages = self.get_conversation_history(conversation)
+        history = self.prompt_history(conversation, user)
+
+        # Call OpenAI API through the first backend that answers
+        try:
+            with generations.track(conversation.session_id) as generation:
+                route, assistant_message = self.answer(conversation, history, use_cache)
+
+            # A blocking call cannot be interrupted, so a cancel that came in
+            # meanwhile only drops the reply.
+            if generation.cancelled():
+                self.save_turn(conversation, *interrupted_turn(conversation, user, ()))
+                return cancelled_result(conversation)
+
+            # Save both messages of the turn
+            self.save_turn(
+                conversation, user, new_message(conversation, 'assistant', assistant_message)
+            )
+
+            self.maybe_summarize(conversation)
 
-        # Add system message if it's a new conversation
-        if len(messages) == 1:
-            messages.insert(0, {
-                "role": "system",
-                "content": "You are a helpful assistant."
-            })
+            return reply_result(assistant_message, conversation, route)
 
-        # Call OpenAI API
+        except Exception as e:
+            if user.pk is None:
+                self.save_turn(conversation, user)
+            return error_result(e, conversation)
+
+    def stream_chat(self, user_message, session_id=None, use_cache=True):
+        # Yields (event, data) pairs: a 'token' per delta, then 'done' with
+        # the same payload as chat(), 'error', or 'cancelled' when stopped
+        # through generations.cancel(). Closing the generator early (client
+        # disconnect) closes the upstream stream; either way the partial
+        # reply is saved marked as interrupted.
+        conversation = self.get_or_create_conversation(session_id)
+        user = new_message(conversation, 'user', user_message)
+
+        history = self.prompt_history(conversation, user)
+        routes = router.candidates(prompt_tokens(history))
+
+        first = routes[0]
+        cached = None
+        if use_cache:
+            cached = response_cache.get(first.model, fill_window(conversation, history, first.model))
+        if cached is not None:
+            yield 'token', {'content': cached}
+            self.save_turn(conversation, user, new_message(conversation, 'assistant', cached))
+            yield 'done', reply_result(cached, conversation, first)
+            self.maybe_summarize(conversation)
+            return
+
+        with generations.track(conversation.session_id) as generation:
+            started = time.monotonic()
+            try:
+                route, messages, stream = self.open_stream(conversation, history, routes)
+            except Exception as e:
+                self.save_turn(conversation, user)
+                yield 'error', error_result(e, conversation)
+                return
+
+            chunks = []
+            cancelled = False
+            try:
+                for chunk in stream:
+                    # Checked per chunk: the sync client offers no way to
+                    # abort a read from another thread.
+                    if generation.cancelled():
+                        cancelled = True
+                        break
+                    if chunk.usage is not None:
+                        record_usage(route.model, chunk.usage)
+                        self.charge(route.model, chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not chunks:
+                            observe_stage('upstream_ttfb', time.monotonic() - started)
+                        chunks.append(delta)
+                        yield 'token', {'content': delta}
+            except GeneratorExit:
+                self.save_turn(conversation, *interrupted_turn(conversation, user, chunks))
+                raise
+            except Exception as e:
+                self.save_turn(conversation, user)
+                yield 'error', error_result(e, conversation)
+                return
+            finally:
+                stream.close()
+            observe_stage('upstream', time.monotonic() - started)
+
+        if cancelled:
+            self.save_turn(conversation, *interrupted_turn(conversation, user, chunks))
+            yield 'cancelled', cancelled_result(conversation, chunks)
+            return
+
+        assistant_message = ''.join(chunks)
+        response_cache.set(route.model, messages, assistant_message)
+
+        self.save_turn(conversation, user, new_message(conversation, 'assistant', assistant_message))
+
+        yield 'done', reply_result(assistant_message, conversation, route)
+
+        # After 'done' so the client never waits on the summary.
+        self.maybe_summarize(conversation)
+
+
+class AsyncChatbotService:
+    # Mirrors ChatbotService on AsyncOpenAI and the async ORM, so a waiting
+    # upstream call only parks a coroutine instead of a worker thread.
+    def __init__(self, client=None, account=None):
+        self.client = client or get_async_client(AsyncOpenAI)
+        self.model = router.primary().model
+        self.account = account
+
+    def client_for(self, route):
+        return route.client(self.client, partial(get_async_client, AsyncOpenAI))
+
+    async def charge(self, model, usage):
+        if self.account is not None:
+            await self.account.acharge(model, usage)
+
+    async def get_or_create_conversation(self, session_id=None):
+        with stage('conversation'):
+            if session_id:
+                try:
+                    conversation = await Conversation.objects.aget(session_id=session_id)
+                except Conversation.DoesNotExist:
+                    conversation = await arestore(session_id) or (
+                        await Conversation.objects.aget_or_create(
+                            session_id=session_id, defaults={'user_id': owner_id(self.account)}
+                        )
+                    )[0]
+            else:
+                session_id = str(uuid.uuid4())
+                conversation = await Conversation.objects.acreate(
+                    session_id=session_id, user_id=owner_id(self.account)
+                )
+
+        if self.account is not None:
+            self.account.session_id = conversation.session_id
+        return conversation
+
+    async def get_conversation_history(self, conversation):
+        return [
+            {"role": msg.role, "content": msg.content}
+            for msg in await aload_history(conversation)
+        ]
+
+    async def prompt_history(self, conversation, *pending):
+        with stage('history'):
+            history = await aload_history(conversation)
+        return [*unsummarized(history, conversation.summarized_through), *pending]
+
+    async def build_messages(self, conversation, *pending, model=None):
+        return fill_window(
+            conversation, await self.prompt_history(conversation, *pending), model or self.model
+        )
+
+    async def update_summary(self, conversation):
+        config = summary_settings()
+        pending = unsummarized(await aload_history(conversation), conversation.summarized_through)
+        count = fold_count(len(pending), config)
+        if not count:
+            return False
+
+        folded = pending[:count]
+        request = summary_request(conversation.summary, folded)
+        route = router.primary()
+        client = self.client_for(route)
+        response = await route.scheduler.acall(lambda: client.chat.completions.create(
+            model=config['MODEL'] or route.model,
+            messages=request,
+            max_tokens=config['MAX_TOKENS']
+        ), request)
+        await self.charge(config['MODEL'] or route.model, response.usage)
+        summary = response.choices[0].message.content
+
+        updated = await Conversation.objects.filter(
+            pk=conversation.pk, summarized_through=conversation.summarized_through
+        ).aupdate(summary=summary, summarized_through=folded[-1].pk)
+        if updated:
+            conversation.summary = summary
+            conversation.summarized_through = folded[-1].pk
+        return bool(updated)
+
+    async def _update_summary_logged(self, conversation):
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            await self.update_summary(conversation)
+        except Exception:
+            logger.exception("Conversation summary failed")
+
+    async def maybe_summarize(self, conversation):
+        config = summary_settings()
+        if not config['ENABLED']:
+            return
+        if config['BACKGROUND']:
+            task = asyncio.create_task(self._update_summary_logged(conversation))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            return
+        await self._update_summary_logged(conversation)
+
+    async def complete(self, route, messages):
+        client = self.client_for(route)
+        started = time.monotonic()
+        try:
+            response = await route.scheduler.acall(lambda: client.chat.completions.create(
+                model=route.model,
                 messages=messages
-            )
+            ), messages)
+        except Exception:
+            router.record_failure(route)
+            raise
+        elapsed = time.monotonic() - started
+        route.latency.observe(elapsed)
+        observe_stage('upstream', elapsed)
+        record_usage(route.model, response.usage)
+        return response.choices[0].message.content, plain_usage(response.usage)
 
-            assistant_message = response.choices[0].message.content
+    async def answer(self, conversation, history, use_cache=True):
+        error = None
+        for route in router.candidates(prompt_tokens(history)):
+            messages = fill_window(conversation, history, route.model)
+            reply = response_cache.get(route.model, messages) if use_cache else None
+            if reply is not None:
+                return route, reply
+            try:
+                reply, usage = await single_flight.ado(
+                    prompt_key(route.model, messages), self.complete, route, messages
+                )
+            except Exception as e:
+                logger.warning("Backend %s failed, falling back: %s", route.name, e)
+                error = e
+                continue
+            await self.charge(route.model, usage)
+            response_cache.set(route.model, messages, reply)
+            return route, reply
+        raise error
 
-            # Save assistant message
-            Message.objects.create(
-                conversation=conversation,
-                role='assistant',
-                content=assistant_message
+    async def open_stream(self, conversation, history, routes):
+        error = None
+        for route in routes:
+            messages = fill_window(conversation, history, route.model)
+            client = self.client_for(route)
+            started = time.monotonic()
+            try:
+                stream = await route.scheduler.acall(lambda: client.chat.completions.create(
+                    model=route.model,
+                    messages=messages,
+                    stream=True,
+                    # A last chunk with response.usage, for the token metrics
+                    stream_options={'include_usage': True}
+                ), messages)
+            except Exception as e:
+                logger.warning("Backend %s failed, falling back: %s", route.name, e)
+                router.record_failure(route)
+                error = e
+                continue
+            route.latency.observe(time.monotonic() - started)
+            return route, messages, stream
+        raise error
+
+    async def chat(self, user_message, session_id=None, use_cache=True):
+        conversation = await self.get_or_create_conversation(session_id)
+        user = new_message(conversation, 'user', user_message)
+
+        history = await self.prompt_history(conversation, user)
+
+        try:
+            with generations.track(conversation.session_id) as generation:
+                route, assistant_message = await generation.run(
+                    self.answer(conversation, history, use_cache)
+                )
+
+            await asave_turn(
+                conversation, user, new_message(conversation, 'assistant', assistant_message)
             )
 
-            return {
-                'message': assistant_message,
-                'session_id': conversation.session_id,
-                'conversation_id': conversation.id
-            }
+            await self.maybe_summarize(conversation)
+
+            return reply_result(assistant_message, conversation, route)
+
+        except GenerationCancelled:
+            await asave_turn(conversation, *interrupted_turn(conversation, user, ()))
+            return cancelled_result(conversation)
+
+        except asyncio.CancelledError:
+            # Under ASGI a client disconnect cancels the view, which has
+            # aborted the upstream request by the time this runs.
+            if user.pk is None:
+                await asave_turn(conversation, *interrupted_turn(conversation, user, ()))
+            raise
 
         except Exception as e:
-            return {
-                'error': str(e),
-                'session_id': conversation.session_id
-            }
+            if user.pk is None:
+                await asave_turn(conversation, user)
+            return error_result(e, conversation)
+
+    async def stream_chat(self, user_message, session_id=None, use_cache=True):
+        # Async counterpart of ChatbotService.stream_chat. Under ASGI a client
+        # disconnect cancels the response task, which closes the upstream
+        # stream in the finally block below. A cancel request also aborts
+        # the wait for the first token.
+        conversation = await self.get_or_create_conversation(session_id)
+        user = new_message(conversation, 'user', user_message)
+
+        history = await self.prompt_history(conversation, user)
+        routes = router.candidates(prompt_tokens(history))
+
+        first = routes[0]
+        cached = None
+        if use_cache:
+            cached = response_cache.get(first.model, fill_window(conversation, history, first.model))
+        if cached is not None:
+            yield 'token', {'content': cached}
+            await asave_turn(conversation, user, new_message(conversation, 'assistant', cached))
+            yield 'done', reply_result(cached, conversation, first)
+            await self.maybe_summarize(conversation)
+            return
+
+        with generations.track(conversation.session_id) as generation:
+            started = time.monotonic()
+            try:
+                route, messages, stream = await generation.run(
+                    self.open_stream(conversation, history, routes)
+                )
+            except GenerationCancelled:
+                await asave_turn(conversation, *interrupted_turn(conversation, user, ()))
+                yield 'cancelled', cancelled_result(conversation)
+                return
+            except asyncio.CancelledError:
+                await asave_turn(conversation, *interrupted_turn(conversation, user, ()))
+                raise
+            except Exception as e:
+                await asave_turn(conversation, user)
+                yield 'error', error_result(e, conversation)
+                return
+
+            chunks = []
+            cancelled = False
+            try:
+                async for chunk in stream:
+                    if await generation.acancelled():
+                        cancelled = True
+                        break
+                    if chunk.usage is not None:
+                        record_usage(route.model, chunk.usage)
+                        await self.charge(route.model, chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not chunks:
+                            observe_stage('upstream_ttfb', time.monotonic() - started)
+                        chunks.append(delta)
+                        yield 'token', {'content': delta}
+            except (GeneratorExit, asyncio.CancelledError):
+                await asave_turn(conversation, *interrupted_turn(conversation, user, chunks))
+                raise
+            except Exception as e:
+                await asave_turn(conversation, user)
+                yield 'error', error_result(e, conversation)
+                return
+            finally:
+                await stream.close()
+            observe_stage('upstream', time.monotonic() - started)
+
+        if cancelled:
+            await asave_turn(conversation, *interrupted_turn(conversation, user, chunks))
+            yield 'cancelled', cancelled_result(conversation, chunks)
+            return
+
+        assistant_message = ''.join(chunks)
+        response_cache.set(route.model, messages, assistant_message)
+
+        await asave_turn(
+            conversation, user, new_message(conversation, 'assistant', assistant_message)
+        )
+
+        yield 'done', reply_result(assistant_message, conversation, route)
+
+        await self.maybe_summarize(conversation)
@@ -0,0 +1,50 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .history import history_cache
+from .models import Conversation, Message
+
+
+def session_id_for(message):
+    # Messages are normally saved through their conversation, so this is
+    # usually served from the related-object cache without a query.
+    if Message.conversation.is_cached(message):
+        return message.conversation.session_id
+    return (
+        Conversation.objects.filter(pk=message.conversation_id)
+        .values_list('session_id', flat=True).first()
+    )
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    session_id = session_id_for(instance)
+    if session_id is None:
+        return
+    if created:
+        # Once committed: a rolled-back message must not reach later prompts.
+        transaction.on_commit(partial(history_cache.append, session_id, instance))
+    else:
+        invalidate(session_id)
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    session_id = session_id_for(instance)
+    if session_id is not None:
+        invalidate(session_id)
+
+
+def invalidate(session_id):
+    # Now, for this transaction's own reads, and again once committed:
+    # another process may cache the old rows in between.
+    history_cache.invalidate(session_id)
+    transaction.on_commit(partial(history_cache.invalidate, session_id))
+
+
+@receiver(post_delete, sender=Conversation)
+def conversation_deleted(sender, instance, **kwargs):
+    history_cache.invalidate(instance.session_id)
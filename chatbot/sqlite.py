@@ -0,0 +1,147 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+DEFAULT_SQLITE_SETTINGS = {
+    'ENABLED': False,
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'BUSY_TIMEOUT_MS': 5000,
+    'CACHE_SIZE_KB': 64 * 1024,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'TEMP_STORE': 'MEMORY',
+    'SERIALIZE_WRITES': False,
+    'MAX_BATCH': 64,
+}
+
+
+def sqlite_settings():
+    return {**DEFAULT_SQLITE_SETTINGS, **getattr(settings, 'SQLITE_TUNING', {})}
+
+
+def pragmas(config, in_transaction=False):
+    # SQLite refuses to change the journal mode or safety level inside a
+    # transaction; a connection opened in one keeps its defaults for those.
+    durability = [] if in_transaction else [
+        f"PRAGMA journal_mode={config['JOURNAL_MODE']}",
+        f"PRAGMA synchronous={config['SYNCHRONOUS']}",
+    ]
+    return durability + [
+        f"PRAGMA busy_timeout={int(config['BUSY_TIMEOUT_MS'])}",
+        # Negative cache_size is in KiB rather than pages.
+        f"PRAGMA cache_size={-int(config['CACHE_SIZE_KB'])}",
+        f"PRAGMA mmap_size={int(config['MMAP_SIZE'])}",
+        f"PRAGMA temp_store={config['TEMP_STORE']}",
+    ]
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    config = sqlite_settings()
+    if not config['ENABLED']:
+        return
+    in_transaction = connection.in_atomic_block or connection.connection.in_transaction
+    for pragma in pragmas(config, in_transaction):
+        connection.connection.execute(pragma)
+
+
+class WriteQueue:
+    """Funnels database writes through one thread.
+
+    SQLite allows a single writer at a time, so competing request threads
+    otherwise spend their time in the busy handler or fail with "database
+    is locked". Jobs that queue up while a commit is in progress are run in
+    one transaction, each inside its own savepoint, and share its fsync.
+    Callers block until their job has committed.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name='sqlite-writer', daemon=True
+                )
+                self._thread.start()
+            self._queue.put((fn, args, future))
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def close(self):
+        # Stops the writer and closes its connection; the next submit()
+        # starts a fresh one.
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _work(self):
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                batch = [job]
+                while len(batch) < sqlite_settings()['MAX_BATCH']:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self._commit(batch)
+                        return
+                    batch.append(job)
+                self._commit(batch)
+        finally:
+            connection.close()
+
+    def _commit(self, batch):
+        done = []
+        try:
+            with transaction.atomic():
+                for fn, args, future in batch:
+                    try:
+                        with transaction.atomic():
+                            done.append((future, fn(*args)))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:
+            for future, result in done:
+                future.set_exception(e)
+            return
+        for future, result in done:
+            future.set_result(result)
+
+
+writer = WriteQueue()
+
+
+def run_write(fn, *args, serialize=None):
+    """Run ``fn(*args)`` on the single writer when ``serialize`` is true
+    (None: when SERIALIZE_WRITES is on).
+
+    Writes made inside an open transaction stay on the caller's connection,
+    since the writer thread could not see or join that transaction.
+    """
+    if serialize is None:
+        serialize = sqlite_settings()['SERIALIZE_WRITES']
+    if connection.vendor == 'sqlite' and not connection.in_atomic_block and serialize:
+        return writer.run(fn, *args)
+    return fn(*args)
@@ -0,0 +1,297 @@
+const chatToggleBtn = document.getElementById("chatToggleBtn");
+const chatWrapper = document.getElementById("chatWrapper");
+const input = document.getElementById("userInput");
+const sendBtn = document.getElementById("sendBtn");
+const messagesDiv = document.getElementById("messages");
+const typingSound = document.getElementById("typingSound");
+
+let username = "";
+
+// Toggle chat
+chatToggleBtn.addEventListener("click", () => {
+    chatWrapper.style.display = chatWrapper.style.display === "flex" ? "none" : "flex";
+    if(chatWrapper.style.display === "flex") input.focus();
+});
+
+// Add message
+function addMessage(sender, text, time) {
+    const msgDiv = document.createElement("div");
+    msgDiv.classList.add("message", sender);
+    msgDiv.draggable = true;
+
+    const icon = document.createElement("i");
+    icon.classList.add("icon", sender === "user" ? "bi-person-fill" : "bi-robot");
+
+    const bubble = document.createElement("div");
+    bubble.classList.add("bubble");
+    bubble.textContent = text;
+
+    const timestamp = document.createElement("div");
+    timestamp.classList.add("timestamp");
+    timestamp.textContent = time;
+    bubble.appendChild(timestamp);
+
+    // Reactions
+    const reactions = document.createElement("div");
+    reactions.classList.add("reactions");
+    reactions.innerHTML = '<span>👍</span><span>❤️</span><span>👀</span>';
+    reactions.querySelectorAll('span').forEach(r => r.addEventListener('click', () => alert(`You reacted: ${r.textContent}`)));
+    bubble.appendChild(reactions);
+
+    msgDiv.append(icon, bubble);
+    messagesDiv.appendChild(msgDiv);
+    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+
+    // Drag events
+    msgDiv.addEventListener('dragstart', () => msgDiv.classList.add('dragging'));
+    msgDiv.addEventListener('dragend', () => msgDiv.classList.remove('dragging'));
+}
+
+// Format timestamp
+function formatTime() {
+    const now = new Date();
+    return now.getHours().toString().padStart(2,"0")+":"+now.getMinutes().toString().padStart(2,"0");
+}
+
+// One WebSocket per chat session: tokens stream in over it and Escape
+// cancels a reply in progress. Falls back to HTTP while it is unavailable.
+let sessionId = null;
+let socket = null;
+let pending = null;
+let httpStreaming = false;
+
+function connectSocket(){
+    if(!("WebSocket" in window)) return;
+    const scheme = location.protocol === "https:" ? "wss" : "ws";
+    const query = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : "";
+    const ws = new WebSocket(`${scheme}://${location.host}/ws/chat/${query}`);
+
+    ws.onopen = () => { socket = ws; };
+    ws.onmessage = event => {
+        const payload = JSON.parse(event.data);
+        if(payload.type === "session") sessionId = payload.session_id;
+        else if(payload.type === "ping") ws.send(JSON.stringify({type: "pong"}));
+        else if(pending) handleFrame(payload);
+    };
+    ws.onclose = () => {
+        if(socket === ws) socket = null;
+        if(pending){
+            pending.reject(new Error("Connection closed"));
+            pending = null;
+        }
+        setTimeout(connectSocket, 3000);
+    };
+}
+
+function handleFrame(payload){
+    const current = pending;
+    if(payload.type === "token"){
+        current.text += payload.content;
+        current.bubble.textContent = current.text;
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    } else if(payload.type === "done"){
+        pending = null;
+        if(!current.text) current.bubble.textContent = payload.message || "Sorry, no response.";
+        current.resolve();
+    } else if(payload.type === "cancelled"){
+        pending = null;
+        current.bubble.textContent = (current.text || "") + " [stopped]";
+        current.resolve();
+    } else if(payload.type === "error"){
+        pending = null;
+        current.reject(new Error(payload.error));
+    }
+}
+
+function socketReply(message, bubble){
+    return new Promise((resolve, reject) => {
+        pending = {bubble, text: "", resolve, reject};
+        bubble.textContent = "";
+        socket.send(JSON.stringify({type: "message", message}));
+    });
+}
+
+function reply(message, bubble){
+    if(socket && socket.readyState === WebSocket.OPEN && !pending) return socketReply(message, bubble);
+    return streamReply(message, bubble);
+}
+
+function cancelReply(){
+    if(pending && socket){
+        socket.send(JSON.stringify({type: "cancel"}));
+    } else if(httpStreaming && sessionId){
+        fetch("/api/chat/cancel/", {
+            method:"POST",
+            headers:{
+                "Content-Type":"application/json",
+                "X-CSRFToken":getCookie("csrftoken")
+            },
+            body: JSON.stringify({session_id: sessionId})
+        });
+    }
+}
+
+connectSocket();
+
+// Stream the reply over server-sent events, rendering tokens as they arrive
+async function streamReply(message, bubble) {
+    httpStreaming = true;
+    try {
+        return await readStream(message, bubble);
+    } finally {
+        httpStreaming = false;
+    }
+}
+
+async function readStream(message, bubble) {
+    const response = await fetch("/api/chat/", {
+        method:"POST",
+        headers:{
+            "Content-Type":"application/json",
+            "X-CSRFToken":getCookie("csrftoken")
+        },
+        body: JSON.stringify(sessionId ? {message, stream: true, session_id: sessionId} : {message, stream: true})
+    });
+
+    if(!response.ok || !response.body){
+        const data = await response.json();
+        bubble.textContent = data.message || data.error || "Sorry, no response.";
+        return;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let text = "";
+    bubble.textContent = "";
+
+    while(true){
+        const {value, done} = await reader.read();
+        if(done) break;
+        buffer += decoder.decode(value, {stream:true});
+
+        let boundary;
+        while((boundary = buffer.indexOf("\n\n")) !== -1){
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = "message";
+            let data = "";
+            for(const line of frame.split("\n")){
+                if(line.startsWith("event:")) event = line.slice(6).trim();
+                else if(line.startsWith("data:")) data += line.slice(5).trim();
+            }
+            const payload = data ? JSON.parse(data) : {};
+
+            if(event === "token"){
+                text += payload.content;
+                bubble.textContent = text;
+                messagesDiv.scrollTop = messagesDiv.scrollHeight;
+            } else if(event === "done"){
+                sessionId = payload.session_id;
+            } else if(event === "cancelled"){
+                sessionId = payload.session_id;
+                text += " [stopped]";
+                bubble.textContent = text;
+            } else if(event === "error"){
+                throw new Error(payload.error);
+            }
+        }
+    }
+
+    if(!text) bubble.textContent = "Sorry, no response.";
+}
+
+// Send message
+
+
+
+async function sendMessage() {
+    let message = input.value.trim();
+    if(!message) return;
+
+    if(!username) {
+        username = message;
+        addMessage("bot", `Hello ${username}! How can I assist you today?`, formatTime());
+        input.value = "";
+        return;
+    }
+
+    addMessage("user", message, formatTime());
+    input.value = "";
+
+    // Typing bubble
+    const botTyping = document.createElement("div");
+    botTyping.classList.add("message","bot");
+    botTyping.innerHTML = `<i class="icon bi-robot"></i><div class="bubble">Typing...</div>`;
+    messagesDiv.appendChild(botTyping);
+    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+
+    // Play sound
+    typingSound.play().catch(e=>console.log("Sound blocked", e));
+
+    try {
+        const bubble = botTyping.querySelector(".bubble");
+        await reply(message, bubble);
+
+        const timestamp = document.createElement("div");
+        timestamp.classList.add("timestamp");
+        timestamp.textContent = formatTime();
+        botTyping.querySelector(".bubble").appendChild(timestamp);
+
+    } catch(err){
+        console.error(err);
+        botTyping.querySelector(".bubble").textContent = "Error: Unable to fetch response.";
+    }
+}
+
+input.addEventListener("keydown", e=>{if(e.key==="Enter") sendMessage();});
+input.addEventListener("keydown", e => { if(e.key==="Escape") cancelReply(); });
+sendBtn.addEventListener("click", sendMessage);
+
+function getCookie(name){
+    let cookieValue = null;
+    if(document.cookie && document.cookie!==""){
+        const cookies = document.cookie.split(";");
+        for(let cookie of cookies){
+            cookie = cookie.trim();
+            if(cookie.startsWith(name+"=")){
+                cookieValue = decodeURIComponent(cookie.substring(name.length+1));
+                break;
+            }
+        }
+    }
+    return cookieValue;
+}
+
+// Initial greeting
+addMessage("bot","Welcome! What's your name?", formatTime());
+
+
+
+    // Apply pulse animation when chat is hidden
+function updatePulse() {
+    if (chatWrapper.style.display === "flex") {
+        chatToggleBtn.classList.remove("pulse");
+    } else {
+        chatToggleBtn.classList.add("pulse");
+    }
+}
+
+// Toggle chat
+chatToggleBtn.addEventListener("click", () => {
+    chatWrapper.style.display = chatWrapper.style.display === "flex" ? "none" : "flex";
+    if(chatWrapper.style.display === "flex") input.focus();
+    updatePulse();
+});
+chatToggleBtn.addEventListener("click", () => {
+    if (chatWrapper.style.display === "flex") {
+        chatWrapper.style.display = "none";
+    } else {
+        chatWrapper.style.display = "flex";
+        input.focus();
+    }
+    updatePulse();
+});
+// Initialize pulse
+updatePulse();
@@ -0,0 +1,49 @@
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+from .middleware import brotli, compress
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Fingerprinted static files with precompressed variants.
+
+    collectstatic writes each file under a content-hashed name (so it can be
+    cached forever) and, for text files, ``.gz`` and ``.br`` (with the
+    brotli package) siblings that chatbot.ui.static_file serves to clients
+    accepting them. Before collectstatic has run (a fresh checkout, the
+    tests) names resolve to the unhashed files instead of failing.
+    """
+
+    compressible = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+    # Below this, compression saves next to nothing.
+    min_compress_bytes = 256
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # The final names only; intermediate passes' files are gone by now.
+        for name in sorted(set(self.hashed_files.values())):
+            if name.endswith(self.compressible):
+                self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as file:
+            content = file.read()
+        if len(content) < self.min_compress_bytes:
+            return
+        for encoding, suffix in (('gzip', '.gz'), ('br', '.br')):
+            if encoding == 'br' and brotli is None:
+                continue
+            compressed = compress(content, encoding, best=True)
+            if len(compressed) < len(content):
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
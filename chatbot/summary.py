@@ -0,0 +1,73 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an "
+    "assistant. Merge the existing summary with the new messages into one "
+    "concise summary. Keep names, facts, decisions and open questions."
+)
+
+DEFAULT_SUMMARY_SETTINGS = {
+    'ENABLED': False,
+    'EVERY': 10,
+    'KEEP_RECENT': 6,
+    'MODEL': None,
+    'MAX_TOKENS': 400,
+    'BACKGROUND': False,
+}
+
+
+def summary_settings():
+    return {**DEFAULT_SUMMARY_SETTINGS, **getattr(settings, 'CHAT_SUMMARY', {})}
+
+
+def summary_request(summary, messages):
+    transcript = "\n".join(f"{msg.role}: {msg.content}" for msg in messages)
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}",
+        },
+    ]
+
+
+def summary_message(summary):
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+
+
+def fold_count(pending, config):
+    # How many of the pending (unsummarised) messages to fold into the
+    # summary now: none until EVERY messages have piled up beyond the
+    # KEEP_RECENT tail that is always sent verbatim.
+    if pending < config['EVERY'] + config['KEEP_RECENT']:
+        return 0
+    return pending - config['KEEP_RECENT']
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def run_in_background(fn, *args):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chat-summary')
+
+    def task():
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Background conversation summary failed")
+        finally:
+            close_old_connections()
+
+    return _executor.submit(task)
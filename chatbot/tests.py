@@ -4,12 +4,73 @@ from django.test import TestCase
 from django.test import TestCase
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from unittest.mock import patch, MagicMock
-from .models import Conversation, Message
-from .services import ChatbotService
+from unittest.mock import patch, MagicMock, AsyncMock
+from .models import ChatJob, Conversation, Message
+from .services import ChatbotService, AsyncChatbotService
+from .clients import ClientRegistry
+from .context import SYSTEM_PROMPT
+from .history import HistoryCache, history_cache, load_history
+from .cache import ExactCache, np, response_cache
+from .coalesce import SingleFlight, single_flight
+from .sqlite import run_write, tune_sqlite
+from .upstream import CacheWindow, TokenBucket, UpstreamBusy, UpstreamScheduler
+from .routing import ModelRouter
+from .jobs import drain, requeue_stale, job_settings, run as run_job
+from .batch import BatchRunner, parse_records, run_batch
+from .websocket import ChatSocket, ScopeSession
+from .cancellation import GenerationCancelled, generations
+from .metrics import Histogram, metrics, stage, stage_seconds, tokens_total, cost_total
+from openai import AsyncOpenAI, OpenAI
+from .bench import seed_conversations
+from .bench.fake_openai import FakeOpenAIServer
+from .bench.load import SCENARIOS, regressions, run_scenario
+from .search import SQLiteFTSBackend, search_backend
+from .retention import Archiver, restore
+from .renderers import dumps
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from rest_framework.renderers import JSONRenderer
+from .models import ArchivedConversation, TokenUsage
+from .quotas import (
+    Account, QuotaExceeded, quota_settings, quotas, scope_account, seconds_until_under, sliding_count
+)
+from django.contrib.auth import aget_user
+from django.contrib.auth.models import User
+from asgiref.sync import sync_to_async
+from io import StringIO
+from .services import new_message, save_turn
+from django.test import override_settings
+from django.conf import settings
+from unittest import skipIf
+from django.test.utils import CaptureQueriesContext
+from django.db import IntegrityError, connection, transaction
+from concurrent.futures import ThreadPoolExecutor
+from django.utils import timezone
+from datetime import timedelta
+import gzip
+import hashlib
+import hmac
+import json
+import socket
+import os
+import sqlite3
+import tempfile
+import threading
+import asyncio
+import time
 import uuid
 
 
+def make_stream_chunks(deltas):
+    chunks = []
+    for delta in deltas:
+        chunk = MagicMock()
+        chunk.choices = [MagicMock()]
+        chunk.choices[0].delta.content = delta
+        chunks.append(chunk)
+    return chunks
+
+
 # ============================================
 # MODEL TESTS
 # ============================================
@@ -102,6 +163,30 @@ class MessageModelTest(TestCase):
         self.assertEqual(str(message), 'user: This is a test message')
         print(f"✓ Message string representation: {str(message)}")
 
+    def test_sequence_numbers_per_conversation(self):
+        """Test messages are numbered 1, 2, 3... within their conversation"""
+        other = Conversation.objects.create(session_id=str(uuid.uuid4()))
+        for content in ['a', 'b', 'c']:
+            Message.objects.create(conversation=self.conversation, role='user', content=content)
+        Message.objects.create(conversation=other, role='user', content='x')
+
+        self.assertEqual(
+            list(self.conversation.messages.values_list('seq', flat=True)), [1, 2, 3]
+        )
+        self.assertEqual(other.messages.get().seq, 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_seq, 3)
+        print("✓ Per-conversation sequence numbers assigned")
+
+    def test_tail_returns_last_messages(self):
+        """Test tail() returns the newest messages oldest first"""
+        for i in range(5):
+            Message.objects.create(conversation=self.conversation, role='user', content=str(i))
+
+        tail = Message.objects.tail(self.conversation, 2)
+        self.assertEqual([m.content for m in tail], ['3', '4'])
+        print("✓ Tail query returns the last N messages")
+
     def test_related_messages(self):
         """Test accessing messages through conversation"""
         Message.objects.create(
@@ -206,6 +291,1457 @@ class ChatbotServiceTest(TestCase):
         print("✓ Error handling works correctly")
 
 
+    def test_chat_saves_turn_in_one_transaction(self):
+        """Test a turn inserts both messages at once and bumps updated_at"""
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Hello!"
+        client = MagicMock()
+        client.chat.completions.create.return_value = mock_response
+        service = ChatbotService(client=client)
+        conversation = service.get_or_create_conversation(self.session_id)
+
+        with CaptureQueriesContext(connection) as queries:
+            service.chat("Hi", self.session_id)
+
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT INTO "chatbot_message"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(
+            list(conversation.messages.values_list('role', flat=True)), ['user', 'assistant']
+        )
+        self.assertTrue(all(m.token_count for m in conversation.messages.all()))
+        conversation_after = Conversation.objects.get(pk=conversation.pk)
+        self.assertGreater(conversation_after.updated_at, conversation.updated_at)
+        print("✓ Turn saved with one bulk insert")
+
+    @patch('chatbot.services.OpenAI')
+    def test_stream_chat_yields_tokens_and_saves_message(self, mock_openai):
+        """Test streaming chat emits tokens and persists the assembled reply"""
+        mock_stream = MagicMock()
+        mock_stream.__iter__.return_value = iter(make_stream_chunks(["Hel", "lo", "!"]))
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = mock_stream
+        mock_openai.return_value = mock_client
+
+        service = ChatbotService()
+        events = list(service.stream_chat("Hi", self.session_id))
+
+        tokens = [data['content'] for event, data in events if event == 'token']
+        self.assertEqual(tokens, ["Hel", "lo", "!"])
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(events[-1][1]['message'], "Hello!")
+        self.assertTrue(mock_client.chat.completions.create.call_args.kwargs['stream'])
+
+        conversation = Conversation.objects.get(session_id=self.session_id)
+        self.assertEqual(conversation.messages.last().content, "Hello!")
+        mock_stream.close.assert_called_once()
+        print("✓ Streaming chat yields tokens and saves reply")
+
+    @patch('chatbot.services.OpenAI')
+    def test_stream_chat_client_disconnect(self, mock_openai):
+        """Test closing the stream early closes upstream and marks the partial reply"""
+        mock_stream = MagicMock()
+        mock_stream.__iter__.return_value = iter(make_stream_chunks(["a", "b", "c"]))
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = mock_stream
+        mock_openai.return_value = mock_client
+
+        service = ChatbotService()
+        events = service.stream_chat("Hi", self.session_id)
+        self.assertEqual(next(events), ('token', {'content': 'a'}))
+        events.close()
+
+        mock_stream.close.assert_called_once()
+        conversation = Conversation.objects.get(session_id=self.session_id)
+        user, partial = conversation.messages.all()
+        self.assertTrue(user.interrupted)
+        self.assertTrue(partial.interrupted)
+        self.assertEqual(partial.content, "a")
+        print("✓ Client disconnect closes upstream stream")
+
+
+class AsyncChatbotServiceTest(TestCase):
+    """Test cases for AsyncChatbotService"""
+
+    def setUp(self):
+        """Set up test data before each test"""
+        self.session_id = str(uuid.uuid4())
+
+    @patch('chatbot.services.AsyncOpenAI')
+    async def test_chat_success(self, mock_openai):
+        """Test successful async chat interaction"""
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Hello from async!"
+
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
+        mock_openai.return_value = mock_client
+
+        service = AsyncChatbotService()
+        result = await service.chat("Hello", self.session_id)
+
+        self.assertEqual(result['message'], "Hello from async!")
+        self.assertEqual(result['session_id'], self.session_id)
+        count = await Message.objects.filter(conversation__session_id=self.session_id).acount()
+        self.assertEqual(count, 2)
+        print("✓ Async chat interaction successful")
+
+    @patch('chatbot.services.AsyncOpenAI')
+    async def test_chat_error_handling(self, mock_openai):
+        """Test async chat error handling"""
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(side_effect=Exception("API Error"))
+        mock_openai.return_value = mock_client
+
+        service = AsyncChatbotService()
+        result = await service.chat("Hello", self.session_id)
+
+        self.assertIn('API Error', result['error'])
+        print("✓ Async error handling works correctly")
+
+    async def test_get_conversation_history_with_messages(self):
+        """Test async history iterates conversation messages in order"""
+        service = AsyncChatbotService()
+        conversation = await service.get_or_create_conversation(self.session_id)
+        await Message.objects.acreate(conversation=conversation, role='user', content='Hello')
+        await Message.objects.acreate(conversation=conversation, role='assistant', content='Hi!')
+
+        history = await service.get_conversation_history(conversation)
+        self.assertEqual([m['role'] for m in history], ['user', 'assistant'])
+        print(f"✓ Retrieved {len(history)} messages asynchronously")
+
+
+@override_settings(CHAT_CONTEXT={
+    'MODEL_BUDGETS': {'gpt-3.5-turbo': 450},
+    'RESERVE_TOKENS': 0,
+})
+class ContextWindowTest(TestCase):
+    """Test cases for token-budgeted prompt assembly"""
+
+    def setUp(self):
+        """Create a conversation of ten 100-token messages"""
+        self.service = ChatbotService(client=MagicMock())
+        self.conversation = Conversation.objects.create(session_id=str(uuid.uuid4()))
+        for i in range(10):
+            Message.objects.create(
+                conversation=self.conversation,
+                role='user' if i % 2 == 0 else 'assistant',
+                content=f'Message {i}',
+                token_count=100
+            )
+
+    def test_token_count_cached_on_save(self):
+        """Test messages store their token count when created"""
+        message = Message.objects.create(
+            conversation=self.conversation, role='user', content='Hello there'
+        )
+        self.assertGreater(message.token_count, 0)
+        print(f"✓ Token count cached: {message.token_count}")
+
+    def test_drop_oldest_keeps_newest_within_budget(self):
+        """Test the newest messages that fit are sent after the system prompt"""
+        messages = self.service.build_messages(self.conversation)
+
+        self.assertEqual(messages[0], {'role': 'system', 'content': SYSTEM_PROMPT})
+        self.assertEqual(
+            [m['content'] for m in messages[1:]],
+            ['Message 6', 'Message 7', 'Message 8', 'Message 9']
+        )
+        print(f"✓ Prompt truncated to {len(messages)} messages")
+
+    def test_keep_ends_pins_first_messages(self):
+        """Test keep_ends keeps the opening messages plus the newest ones"""
+        config = {
+            'MODEL_BUDGETS': {'gpt-3.5-turbo': 450},
+            'RESERVE_TOKENS': 0,
+            'POLICY': 'keep_ends',
+            'KEEP_FIRST': 1,
+            'KEEP_LAST': 2,
+        }
+        with override_settings(CHAT_CONTEXT=config):
+            messages = self.service.build_messages(self.conversation)
+
+        self.assertEqual(
+            [m['content'] for m in messages[1:]],
+            ['Message 0', 'Message 8', 'Message 9']
+        )
+        print("✓ keep_ends policy keeps first and last messages")
+
+    def test_newest_message_always_sent(self):
+        """Test an oversized newest message is still sent"""
+        Message.objects.create(
+            conversation=self.conversation, role='user', content='Huge', token_count=10000
+        )
+        messages = self.service.build_messages(self.conversation)
+
+        self.assertEqual([m['content'] for m in messages[1:]], ['Huge'])
+        print("✓ Newest message kept even over budget")
+
+    async def test_async_build_messages_matches_sync(self):
+        """Test the async service assembles the same window"""
+        service = AsyncChatbotService(client=MagicMock())
+        messages = await service.build_messages(self.conversation)
+
+        self.assertEqual(
+            [m['content'] for m in messages[1:]],
+            ['Message 6', 'Message 7', 'Message 8', 'Message 9']
+        )
+        print("✓ Async prompt truncated to the same window")
+
+
+@override_settings(CHAT_SUMMARY={'ENABLED': True, 'EVERY': 4, 'KEEP_RECENT': 2})
+class ConversationSummaryTest(TestCase):
+    """Test cases for rolling conversation summaries"""
+
+    def setUp(self):
+        """Set up a mocked client that answers every call with 'Summary'"""
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Summary"
+        self.client = MagicMock()
+        self.client.chat.completions.create.return_value = mock_response
+        self.service = ChatbotService(client=self.client)
+        self.session_id = str(uuid.uuid4())
+
+    def test_summary_folds_old_turns(self):
+        """Test older turns are folded into the summary after EVERY messages"""
+        for i in range(3):
+            self.service.chat(f"Question {i}", self.session_id)
+
+        conversation = Conversation.objects.get(session_id=self.session_id)
+        messages = list(conversation.messages.order_by('pk'))
+        self.assertEqual(conversation.summary, "Summary")
+        self.assertEqual(conversation.summarized_through, messages[3].pk)
+        print("✓ Old turns folded into the running summary")
+
+    def test_prompt_uses_summary_and_recent_tail(self):
+        """Test the prompt is the system prompt, summary and unsummarised tail"""
+        for i in range(3):
+            self.service.chat(f"Question {i}", self.session_id)
+        conversation = Conversation.objects.get(session_id=self.session_id)
+
+        messages = self.service.build_messages(conversation)
+
+        self.assertEqual(messages[0]['content'], SYSTEM_PROMPT)
+        self.assertIn("Summary", messages[1]['content'])
+        self.assertEqual([m['content'] for m in messages[2:]], ["Question 2", "Summary"])
+        print(f"✓ Prompt built from summary plus {len(messages) - 2} recent messages")
+
+    def test_summary_disabled_by_default(self):
+        """Test no summary call is made unless enabled"""
+        with override_settings(CHAT_SUMMARY={}):
+            for i in range(5):
+                self.service.chat(f"Question {i}", self.session_id)
+
+        self.assertEqual(self.client.chat.completions.create.call_count, 5)
+        conversation = Conversation.objects.get(session_id=self.session_id)
+        self.assertEqual(conversation.summary, '')
+        print("✓ Summaries are opt-in")
+
+
+class HistoryCacheTest(TestCase):
+    """Test cases for the per-session history cache"""
+
+    def setUp(self):
+        """Set up a conversation with two cached messages"""
+        self.conversation = Conversation.objects.create(session_id=str(uuid.uuid4()))
+        Message.objects.create(conversation=self.conversation, role='user', content='Hello')
+        Message.objects.create(conversation=self.conversation, role='assistant', content='Hi!')
+        load_history(self.conversation)
+
+    def test_new_messages_appended_without_rereading(self):
+        """Test a warm cache reads no history rows from the database"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(conversation=self.conversation, role='user', content='Again')
+
+        with self.assertNumQueries(1):
+            history = load_history(self.conversation)
+
+        self.assertEqual([m.content for m in history], ['Hello', 'Hi!', 'Again'])
+        print("✓ History extended in place from the cache")
+
+    def test_append_after_gap_drops_entry(self):
+        """Test a message that does not follow the cached tail is never appended"""
+        # Saved by another process: this one's cache never saw it.
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, role='user', content='Elsewhere', token_count=1, seq=3)
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(conversation=self.conversation, role='assistant', content='After', seq=4)
+
+        self.assertIsNone(history_cache.get(self.conversation.session_id))
+        self.assertEqual([m.content for m in load_history(self.conversation)],
+                         ['Hello', 'Hi!', 'Elsewhere', 'After'])
+        print("✓ Gapped append dropped the entry")
+
+    def test_rolled_back_message_not_cached(self):
+        """Test a message whose transaction rolls back never reaches the cache"""
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Message.objects.create(conversation=self.conversation, role='user', content='Phantom')
+                raise IntegrityError("rolled back")
+
+        history = history_cache.get(self.conversation.session_id)
+        self.assertEqual([m.content for m in history], ['Hello', 'Hi!'])
+        self.assertEqual([m.content for m in load_history(self.conversation)], ['Hello', 'Hi!'])
+        print("✓ Rolled-back message kept out of the cache")
+
+    def test_rows_saved_elsewhere_are_picked_up(self):
+        """Test messages created without signals are read incrementally"""
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, role='user', content='Bulk', token_count=1, seq=3)
+        ])
+
+        history = load_history(self.conversation)
+        self.assertEqual(history[-1].content, 'Bulk')
+        print("✓ Missing rows fetched by primary key")
+
+    def test_edit_and_delete_invalidate(self):
+        """Test editing or deleting a message drops the cached entry"""
+        message = self.conversation.messages.first()
+        message.content = 'Edited'
+        message.save()
+        self.assertIsNone(history_cache.get(self.conversation.session_id))
+        self.assertEqual(load_history(self.conversation)[0].content, 'Edited')
+
+        message.delete()
+        self.assertIsNone(history_cache.get(self.conversation.session_id))
+        self.assertEqual([m.content for m in load_history(self.conversation)], ['Hi!'])
+        print("✓ Edits and deletes invalidate the cache")
+
+    @override_settings(CHAT_HISTORY_CACHE={'BACKEND': 'default'})
+    def test_invalidation_reaches_other_processes(self):
+        """Test a local entry is dropped once another process invalidates it"""
+        session_id = self.conversation.session_id
+        other = HistoryCache()
+        history_cache.clear()
+        load_history(self.conversation)
+        other.set(session_id, history_cache.get(session_id))
+
+        # An edit handled by this process: the other one's copy is stale.
+        message = self.conversation.messages.first()
+        message.content = 'Edited'
+        message.save()
+
+        self.assertIsNone(other.get(session_id))
+        self.assertEqual(load_history(self.conversation)[0].content, 'Edited')
+        self.assertEqual(other.get(session_id)[0].content, 'Edited')
+        print("✓ Invalidation shared through the generation key")
+
+    @override_settings(CHAT_HISTORY_CACHE={'BACKEND': 'default'})
+    def test_history_read_before_invalidation_not_kept(self):
+        """Test history read before an edit's invalidation is never stored as current"""
+        session_id = self.conversation.session_id
+        history = load_history(self.conversation)
+        history_cache.clear()
+
+        generation, _ = history_cache.lookup(session_id)
+        # An edit invalidates between this reader's lookup and its set().
+        history_cache.invalidate(session_id)
+        history_cache.set(session_id, history, generation)
+
+        self.assertIsNone(history_cache.get(session_id))
+        print("✓ Stale read stored under its old generation")
+
+
+class SQLiteTuningTest(TestCase):
+    """Test cases for the SQLite production settings"""
+
+    def test_pragmas_applied_on_connect(self):
+        """Test the connection hook sets journaling, durability and timeouts"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # A fresh connection: TestCase holds the test database in a transaction.
+        raw = sqlite3.connect(os.path.join(directory.name, 'tuned.sqlite3'))
+        self.addCleanup(raw.close)
+        fresh = MagicMock(vendor='sqlite', connection=raw, in_atomic_block=False)
+        with override_settings(SQLITE_TUNING={'ENABLED': True, 'BUSY_TIMEOUT_MS': 1234,
+                                              'CACHE_SIZE_KB': 2048}):
+            tune_sqlite(sender=None, connection=fresh)
+
+        self.assertEqual(raw.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        # NORMAL
+        self.assertEqual(raw.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(raw.execute('PRAGMA busy_timeout').fetchone()[0], 1234)
+        self.assertEqual(raw.execute('PRAGMA cache_size').fetchone()[0], -2048)
+        print("✓ SQLite pragmas applied")
+
+    def test_pragmas_inside_transaction(self):
+        """Test a connection opened inside a transaction skips what SQLite refuses there"""
+        with override_settings(SQLITE_TUNING={'ENABLED': True, 'BUSY_TIMEOUT_MS': 1234}):
+            tune_sqlite(sender=None, connection=connection)
+
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1234)
+        print("✓ Durability pragmas skipped inside a transaction")
+
+    def test_writes_inside_transaction_stay_inline(self):
+        """Test the writer queue is bypassed inside an open transaction"""
+        with override_settings(SQLITE_TUNING={'SERIALIZE_WRITES': True}):
+            thread_name = run_write(lambda: threading.current_thread().name)
+
+        self.assertEqual(thread_name, threading.current_thread().name)
+        print("✓ Writes in a transaction run on the caller's connection")
+
+
+@override_settings(CHAT_RESPONSE_CACHE={'ENABLED': True})
+class ResponseCacheTest(TestCase):
+    """Test cases for the response cache in front of the upstream call"""
+
+    def setUp(self):
+        """Set up an empty cache and a mocked client"""
+        response_cache.clear()
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Python is a language."
+        self.client = MagicMock()
+        self.client.chat.completions.create.return_value = mock_response
+        self.service = ChatbotService(client=self.client)
+
+    def test_repeated_first_question_served_from_cache(self):
+        """Test the same first-turn question is only sent upstream once"""
+        first = self.service.chat("What is Python?")
+        second = self.service.chat("  what is   PYTHON? ")
+
+        self.assertEqual(second['message'], first['message'])
+        self.assertNotEqual(second['session_id'], first['session_id'])
+        self.assertEqual(self.client.chat.completions.create.call_count, 1)
+        self.assertEqual(response_cache.stats.snapshot()['exact_hits'], 1)
+        conversation = Conversation.objects.get(session_id=second['session_id'])
+        self.assertEqual(conversation.messages.count(), 2)
+        print("✓ Repeated question answered from the cache")
+
+    def test_bypass_skips_lookup(self):
+        """Test use_cache=False always calls upstream"""
+        self.service.chat("What is Python?")
+        self.service.chat("What is Python?", use_cache=False)
+
+        self.assertEqual(self.client.chat.completions.create.call_count, 2)
+        print("✓ Per-request cache bypass works")
+
+    def test_entries_expire(self):
+        """Test exact entries expire after their TTL and evict LRU"""
+        cache = ExactCache()
+        cache.set('a', 'A', ttl=10, max_entries=2, now=0)
+        cache.set('b', 'B', ttl=10, max_entries=2, now=0)
+        cache.get('a', now=1)
+        cache.set('c', 'C', ttl=10, max_entries=2, now=1)
+
+        self.assertIsNone(cache.get('b', now=2))
+        self.assertEqual(cache.get('a', now=2), 'A')
+        self.assertIsNone(cache.get('a', now=10))
+        print("✓ TTL and LRU eviction work")
+
+    @skipIf(np is None, "NumPy is not installed")
+    def test_semantic_tier_matches_paraphrase(self):
+        """Test a near-identical question hits the semantic tier"""
+        with override_settings(CHAT_RESPONSE_CACHE={'ENABLED': True, 'SEMANTIC': True}):
+            self.service.chat("What is Python")
+            result = self.service.chat("What is Python?!")
+
+        self.assertEqual(result['message'], "Python is a language.")
+        self.assertEqual(self.client.chat.completions.create.call_count, 1)
+        self.assertEqual(response_cache.stats.snapshot()['semantic_hits'], 1)
+        print("✓ Semantic tier reused a paraphrased answer")
+
+
+class SingleFlightTest(TestCase):
+    """Test cases for coalescing identical in-flight upstream calls"""
+
+    def test_concurrent_calls_share_one_upstream_request(self):
+        """Test threads asking the same prompt wait on a single call"""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def upstream():
+            calls.append(1)
+            release.wait(5)
+            return "shared reply"
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(flight.do, 'prompt', upstream) for _ in range(4)]
+            while flight.stats.snapshot().get('followers', 0) < 3:
+                time.sleep(0.01)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(results, ["shared reply"] * 4)
+        self.assertEqual(len(calls), 1)
+        print("✓ Concurrent identical prompts coalesced")
+
+    def test_leader_error_shared_with_followers(self):
+        """Test followers receive the leader's exception"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing():
+            started.set()
+            release.wait(5)
+            raise RuntimeError("upstream down")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            leader = pool.submit(flight.do, 'prompt', failing)
+            started.wait(5)
+            follower = pool.submit(flight.do, 'prompt', failing)
+            while not flight.stats.snapshot().get('followers'):
+                time.sleep(0.01)
+            release.set()
+            for future in (leader, follower):
+                with self.assertRaises(RuntimeError):
+                    future.result()
+        print("✓ Leader errors propagate to followers")
+
+    async def test_async_calls_coalesced(self):
+        """Test coroutines asking the same prompt share one call"""
+        flight = SingleFlight()
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "shared reply"
+
+        results = await asyncio.gather(*(flight.ado('prompt', upstream) for _ in range(5)))
+
+        self.assertEqual(results, ["shared reply"] * 5)
+        self.assertEqual(len(calls), 1)
+        print("✓ Concurrent async prompts coalesced")
+
+    @override_settings(CHAT_QUOTAS={'SESSION_TOKENS': 1000, 'FLUSH_INTERVAL': None})
+    def test_coalesced_callers_each_charged(self):
+        """Test every caller sharing a coalesced reply is charged its usage"""
+        quotas.reset()
+        release = threading.Event()
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message.content = "shared reply"
+        response.usage = MagicMock(prompt_tokens=10, completion_tokens=5)
+        client = MagicMock()
+        client.chat.completions.create.side_effect = lambda **kwargs: release.wait(5) and response
+
+        conversation = Conversation(session_id='coalesced')
+        history = [new_message(conversation, 'user', 'Same question')]
+        accounts = [Account(session_id=f'coalesced-{i}') for i in range(2)]
+        followers = single_flight.stats.snapshot().get('followers', 0)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(ChatbotService(client=client, account=account).answer,
+                            conversation, history, False)
+                for account in accounts
+            ]
+            while single_flight.stats.snapshot().get('followers', 0) <= followers:
+                time.sleep(0.01)
+            release.set()
+            replies = [future.result()[1] for future in futures]
+
+        self.assertEqual(replies, ["shared reply"] * 2)
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+        keys = [f'session:{account.session_id}' for account in accounts]
+        index, _ = quotas.clock(quota_settings())
+        self.assertEqual(quotas.local.totals(keys, index, 3600), [(15, 0), (15, 0)])
+        print("✓ Coalesced followers charged")
+
+    def test_coalesced_failure_recorded_once(self):
+        """Test one failed upstream call shared by several callers is one routing failure"""
+        release = threading.Event()
+
+        def create(**kwargs):
+            release.wait(5)
+            raise RuntimeError("upstream down")
+
+        client = MagicMock()
+        client.chat.completions.create.side_effect = create
+        conversation = Conversation(session_id='coalesced-failure')
+        history = [new_message(conversation, 'user', 'Failing question')]
+        followers = single_flight.stats.snapshot().get('followers', 0)
+
+        with patch('chatbot.services.router.record_failure') as record_failure, \
+                ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [pool.submit(ChatbotService(client=client).answer, conversation, history, False)
+                       for _ in range(3)]
+            while single_flight.stats.snapshot().get('followers', 0) < followers + 2:
+                time.sleep(0.01)
+            release.set()
+            for future in futures:
+                with self.assertRaises(RuntimeError):
+                    future.result()
+
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+        self.assertEqual(record_failure.call_count, 1)
+        print("✓ Shared failure recorded once")
+
+
+class ClientRegistryTest(TestCase):
+    """Test cases for the shared OpenAI client registry"""
+
+    def test_client_shared_across_threads(self):
+        """Test one client is built lazily and reused by every thread"""
+        registry = ClientRegistry()
+        factory = MagicMock()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            clients = list(pool.map(lambda _: registry.get(factory), range(32)))
+
+        self.assertEqual(factory.call_count, 1)
+        self.assertTrue(all(client is clients[0] for client in clients))
+        print("✓ Client built once and shared across threads")
+
+    def test_service_uses_shared_client(self):
+        """Test ChatbotService instances share the registry client"""
+        self.assertIs(ChatbotService().client, ChatbotService().client)
+        print("✓ ChatbotService reuses the pooled client")
+
+    def test_connection_reuse_counters(self):
+        """Test keep-alive connections are reused and counted"""
+        registry = ClientRegistry()
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            client = registry.get()
+            for _ in range(3):
+                client.chat.completions.create(
+                    model='gpt-3.5-turbo', messages=[{'role': 'user', 'content': 'Hi'}]
+                )
+
+        stats = registry.stats.snapshot()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['new_connections'], 1)
+        self.assertEqual(stats['reused_connections'], 2)
+        print(f"✓ Connection stats: {stats}")
+
+
+class UpstreamSchedulerTest(TestCase):
+    """Test cases for pacing and retrying upstream calls"""
+
+    def setUp(self):
+        self.scheduler = UpstreamScheduler()
+        self.messages = [{'role': 'user', 'content': 'Hi'}]
+
+    def call(self, upstream):
+        client = OpenAI(base_url=upstream.url, api_key='test', max_retries=0)
+        return self.scheduler.call(lambda: client.chat.completions.create(
+            model='gpt-3.5-turbo', messages=self.messages
+        ), self.messages)
+
+    def test_token_bucket_wait(self):
+        """Test reservations beyond the burst wait for the refill"""
+        bucket = TokenBucket(per_minute=60, burst_seconds=2)
+
+        self.assertEqual(bucket.reserve(1), 0.0)
+        self.assertEqual(bucket.reserve(1), 0.0)
+        # Third request in the same instant waits one refill (1/s).
+        self.assertAlmostEqual(bucket.reserve(1), 1.0, places=1)
+        self.assertAlmostEqual(bucket.reserve(1), 2.0, places=1)
+        print("✓ Token bucket queues requests past the burst")
+
+    def test_token_bucket_sheds_past_max_wait(self):
+        """Test a reservation that would wait past max_wait is refused and takes nothing"""
+        bucket = TokenBucket(per_minute=60, burst_seconds=1)
+        bucket.reserve(1)
+
+        with self.assertRaises(UpstreamBusy) as raised:
+            bucket.reserve(5, max_wait=2)
+        self.assertAlmostEqual(raised.exception.retry_after, 5.0, places=1)
+        self.assertAlmostEqual(bucket.reserve(1), 1.0, places=1)
+        print("✓ Token bucket sheds load past MAX_WAIT")
+
+    def test_cache_window_spreads_waiters(self):
+        """Test callers over a shared minute's limit get staggered slots in the next ones"""
+        window = CacheWindow(f'test-{uuid.uuid4()}', per_minute=4, alias='default')
+        start = 1_000_000 * 60 + 30
+        with patch('chatbot.upstream.time.time', return_value=start):
+            waits = [window.reserve(1) for _ in range(10)]
+
+        # Four now, then four per minute, 15s apart.
+        self.assertEqual(waits[:4], [0.0] * 4)
+        self.assertEqual(waits[4:], [30.0, 45.0, 60.0, 75.0, 90.0, 105.0])
+        with patch('chatbot.upstream.time.time', return_value=start), \
+                self.assertRaises(UpstreamBusy):
+            window.reserve(1, max_wait=100)
+        print(f"✓ Waiters spread over {waits[-1]:.0f}s instead of one boundary")
+
+    @override_settings(CHAT_UPSTREAM={'RPM': 60, 'BURST_SECONDS': 1, 'MAX_WAIT': 0.5})
+    def test_overloaded_scheduler_raises_busy(self):
+        """Test calls beyond the wait cap fail fast instead of sleeping"""
+        fn = MagicMock()
+        self.scheduler.call(fn, self.messages)
+
+        with self.assertRaises(UpstreamBusy):
+            self.scheduler.call(fn, self.messages)
+        self.assertEqual(fn.call_count, 1)
+        print("✓ Overloaded scheduler answers busy")
+
+    @override_settings(CHAT_UPSTREAM={'BACKOFF_BASE': 0.01})
+    def test_retries_429_honouring_retry_after(self):
+        """Test a 429 is retried after the upstream's Retry-After"""
+        with FakeOpenAIServer(reply="Recovered") as upstream:
+            upstream.fail(2, retry_after=0.2)
+            started = time.monotonic()
+            response = self.call(upstream)
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(response.choices[0].message.content, "Recovered")
+        self.assertEqual(len(upstream.requests), 3)
+        self.assertGreaterEqual(elapsed, 0.4)
+        print(f"✓ Recovered from two 429s in {elapsed:.2f}s")
+
+    @override_settings(CHAT_UPSTREAM={
+        'MAX_RETRIES': 1, 'BACKOFF_BASE': 0.01, 'BREAKER_THRESHOLD': 2, 'BREAKER_COOLDOWN': 60
+    })
+    def test_breaker_opens_after_failures(self):
+        """Test exhausted retries raise UpstreamBusy and open the breaker"""
+        with FakeOpenAIServer() as upstream:
+            upstream.fail(2, status=500)
+            with self.assertRaises(UpstreamBusy):
+                self.call(upstream)
+
+            with self.assertRaises(UpstreamBusy) as raised:
+                self.call(upstream)
+
+        # The second call failed fast without reaching the upstream.
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertGreater(raised.exception.retry_after, 50)
+        print("✓ Circuit breaker opened after repeated failures")
+
+    @override_settings(CHAT_UPSTREAM={
+        'MAX_RETRIES': 0, 'BACKOFF_BASE': 0.01, 'BREAKER_THRESHOLD': 1, 'BREAKER_COOLDOWN': 0.05
+    })
+    def test_breaker_recovers_after_inconclusive_trial(self):
+        """Test a trial call ending in a non-retryable error does not wedge the breaker"""
+        with FakeOpenAIServer(reply="Back") as upstream:
+            upstream.fail(1, status=500)
+            with self.assertRaises(UpstreamBusy):
+                self.call(upstream)
+            time.sleep(0.06)
+
+            def rejected():
+                raise GenerationCancelled()
+
+            with self.assertRaises(GenerationCancelled):
+                self.scheduler.call(rejected, self.messages)
+            response = self.call(upstream)
+
+        self.assertEqual(response.choices[0].message.content, "Back")
+        self.assertFalse(self.scheduler.breaker.trial)
+        self.assertIsNone(self.scheduler.breaker.opened_at)
+        print("✓ Breaker left half-open state after an inconclusive trial")
+
+    @override_settings(CHAT_UPSTREAM={'RPM': 60, 'BURST_SECONDS': 1, 'BREAKER_COOLDOWN': 0})
+    def test_trial_released_when_cancelled_while_paced(self):
+        """Test a trial caller cancelled during its pacing wait frees the trial"""
+        self.scheduler.breaker.opened_at = time.monotonic() - 1
+        self.scheduler.call(MagicMock(), self.messages)
+        self.scheduler.breaker.opened_at = time.monotonic() - 1
+        fn = MagicMock()
+
+        with patch('chatbot.upstream.time.sleep', side_effect=GenerationCancelled()):
+            with self.assertRaises(GenerationCancelled):
+                self.scheduler.call(fn, self.messages)
+
+        fn.assert_not_called()
+        self.assertFalse(self.scheduler.breaker.trial)
+        print("✓ Trial released by a caller cancelled while paced")
+
+    @override_settings(CHAT_UPSTREAM={'RPM': 600, 'BURST_SECONDS': 0.5})
+    def test_rpm_limit_paces_calls(self):
+        """Test sustained calls are spread to the requests-per-minute limit"""
+        with FakeOpenAIServer() as upstream:
+            started = time.monotonic()
+            for _ in range(15):
+                self.call(upstream)
+            elapsed = time.monotonic() - started
+
+        # 5 requests of burst, then 10 more at 10 per second.
+        self.assertGreaterEqual(elapsed, 0.9)
+        print(f"✓ 15 calls at 600 RPM took {elapsed:.2f}s")
+
+
+class ModelRouterTest(TestCase):
+    """Test cases for routing prompts between backends"""
+
+    def setUp(self):
+        self.session_id = str(uuid.uuid4())
+
+    def completion(self, content):
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message.content = content
+        return response
+
+    @override_settings(CHAT_ROUTING={'ROUTES': [
+        {'NAME': 'primary', 'MODEL': 'gpt-4o-mini'},
+        {'NAME': 'backup', 'MODEL': 'gpt-3.5-turbo', 'TIER': 1},
+    ]})
+    def test_falls_back_when_primary_fails(self):
+        """Test an erroring primary hands the prompt to the next backend"""
+        def create(model, messages, **kwargs):
+            if model == 'gpt-4o-mini':
+                raise RuntimeError("primary down")
+            return self.completion("From backup")
+
+        client = MagicMock()
+        client.chat.completions.create.side_effect = create
+        result = ChatbotService(client=client).chat("Hello", self.session_id, use_cache=False)
+
+        self.assertEqual(result['message'], "From backup")
+        self.assertEqual(result['backend'], 'backup')
+        self.assertEqual(result['model'], 'gpt-3.5-turbo')
+        print("✓ Failed over to the backup backend")
+
+    @override_settings(CHAT_ROUTING={'ROUTES': [
+        {'NAME': 'small', 'MODEL': 'gpt-3.5-turbo', 'MAX_PROMPT_TOKENS': 200},
+        {'NAME': 'large', 'MODEL': 'gpt-4o', 'TIER': 1},
+    ]})
+    def test_long_prompts_skip_small_models(self):
+        """Test prompt size picks the cheapest backend that fits"""
+        client = MagicMock()
+        client.chat.completions.create.return_value = self.completion("Answer")
+        service = ChatbotService(client=client)
+
+        short = service.chat("Hi", self.session_id, use_cache=False)
+        long = service.chat("word " * 500, self.session_id, use_cache=False)
+
+        self.assertEqual(short['backend'], 'small')
+        self.assertEqual(long['backend'], 'large')
+        print("✓ Prompt size routed to the right tier")
+
+    @override_settings(CHAT_ROUTING={'ROUTES': [
+        {'NAME': 'a', 'MODEL': 'gpt-4o'},
+        {'NAME': 'b', 'MODEL': 'gpt-4o'},
+    ], 'SLOW_P95': 1.0})
+    def test_prefers_faster_backend(self):
+        """Test rolling latency reorders backends of the same tier"""
+        router = ModelRouter()
+        a, b = router.routes()
+        for _ in range(10):
+            a.latency.observe(0.8)
+            b.latency.observe(0.2)
+        self.assertEqual([route.name for route in router.candidates(10)], ['b', 'a'])
+
+        # A slow tail demotes b even with the lower median.
+        for _ in range(5):
+            b.latency.observe(5.0)
+        self.assertEqual([route.name for route in router.candidates(10)], ['a', 'b'])
+        print(f"✓ Latency-aware ordering: {router.stats()}")
+
+    def test_falls_back_to_second_endpoint(self):
+        """Test a failing endpoint fails over to another base URL"""
+        with FakeOpenAIServer(reply="Primary") as primary, \
+                FakeOpenAIServer(reply="Secondary") as secondary:
+            primary.fail(5, status=500)
+            routes = {'ROUTES': [
+                {'NAME': 'primary', 'MODEL': 'gpt-3.5-turbo', 'BASE_URL': primary.url,
+                 'API_KEY': 'test', 'UPSTREAM': {'MAX_RETRIES': 0}},
+                {'NAME': 'secondary', 'MODEL': 'gpt-3.5-turbo', 'BASE_URL': secondary.url,
+                 'API_KEY': 'test', 'TIER': 1},
+            ]}
+            with override_settings(CHAT_ROUTING=routes):
+                result = ChatbotService(client=MagicMock()).chat(
+                    "Hello", self.session_id, use_cache=False
+                )
+
+        self.assertEqual(result['message'], "Secondary")
+        self.assertEqual(result['backend'], 'secondary')
+        self.assertEqual(len(primary.requests), 1)
+        print("✓ Failed over between endpoints")
+
+
+class CancellationTest(TestCase):
+    """Test cases for stopping generations in progress"""
+
+    def setUp(self):
+        self.session_id = str(uuid.uuid4())
+
+    async def start_slow_chat(self, upstream):
+        client = AsyncOpenAI(base_url=upstream.url, api_key='test', max_retries=0)
+        service = AsyncChatbotService(client=client)
+        task = asyncio.create_task(service.chat("Hello", self.session_id, use_cache=False))
+        # Wait until the upstream request is in flight.
+        deadline = time.monotonic() + 2
+        while not upstream.requests and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        self.assertEqual(len(upstream.requests), 1)
+        return task
+
+    async def test_cancel_aborts_upstream_request(self):
+        """Test a cancel frees an async chat waiting on a slow upstream"""
+        with FakeOpenAIServer(latency=5.0) as upstream:
+            task = await self.start_slow_chat(upstream)
+            started = time.monotonic()
+            self.assertEqual(generations.cancel(self.session_id), 1)
+            result = await asyncio.wait_for(task, 1.0)
+            elapsed = time.monotonic() - started
+
+        self.assertTrue(result['cancelled'])
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(generations.active(self.session_id), 0)
+        messages = [m async for m in Message.objects.filter(conversation__session_id=self.session_id)]
+        self.assertEqual([(m.role, m.interrupted) for m in messages], [('user', True)])
+        print(f"✓ Cancelled generation released in {elapsed * 1000:.0f}ms")
+
+    async def test_disconnect_releases_worker(self):
+        """Test a client disconnect (task cancellation) aborts the upstream wait"""
+        with FakeOpenAIServer(latency=5.0) as upstream:
+            task = await self.start_slow_chat(upstream)
+            started = time.monotonic()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(task, 1.0)
+            elapsed = time.monotonic() - started
+
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(generations.active(self.session_id), 0)
+        self.assertTrue(await Message.objects.filter(
+            conversation__session_id=self.session_id, role='user', interrupted=True
+        ).aexists())
+        print(f"✓ Disconnected request released in {elapsed * 1000:.0f}ms")
+
+    def test_cancel_endpoint_stops_stream(self):
+        """Test the cancel endpoint ends a stream and keeps the partial reply"""
+        with FakeOpenAIServer(reply=" ".join(["word"] * 200), token_delay=0.02) as upstream:
+            client = OpenAI(base_url=upstream.url, api_key='test', max_retries=0)
+            events = ChatbotService(client=client).stream_chat("Hello", self.session_id, use_cache=False)
+            self.assertEqual(next(events)[0], 'token')
+
+            response = self.client.post(
+                '/api/chat/cancel/', {'session_id': self.session_id}, content_type='application/json'
+            )
+            started = time.monotonic()
+            remaining = list(events)
+            elapsed = time.monotonic() - started
+
+            deadline = time.monotonic() + 2
+            while not upstream.aborted and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json()['cancelled'], 1)
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(upstream.aborted, 1)
+        event, data = remaining[-1]
+        self.assertEqual(event, 'cancelled')
+        partial = Message.objects.get(conversation__session_id=self.session_id, role='assistant')
+        self.assertTrue(partial.interrupted)
+        self.assertEqual(partial.content, data['message'])
+        self.assertLess(len(partial.content.split()), 200)
+        print(f"✓ Stream cancelled after {len(partial.content.split())} words")
+
+    def test_cancel_unknown_session(self):
+        """Test cancelling a session with nothing in progress is a 404"""
+        response = self.client.post(
+            '/api/chat/cancel/', {'session_id': 'idle'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        print("✓ Cancel of an idle session rejected")
+
+
+class MetricsTest(TestCase):
+    """Test cases for hot-path instrumentation"""
+
+    def setUp(self):
+        self.session_id = str(uuid.uuid4())
+        metrics.reset()
+
+    def test_histogram_exposition(self):
+        """Test histograms render cumulative Prometheus buckets"""
+        histogram = Histogram('demo_seconds', 'Demo.', ['stage'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, 'a')
+
+        lines = [f'{name} {value}' for name, value in histogram.samples()]
+        self.assertEqual(lines, [
+            'demo_seconds_bucket{stage="a",le="0.1"} 1',
+            'demo_seconds_bucket{stage="a",le="1.0"} 2',
+            'demo_seconds_bucket{stage="a",le="+Inf"} 3',
+            'demo_seconds_sum{stage="a"} 5.55',
+            'demo_seconds_count{stage="a"} 3',
+        ])
+        print("✓ Histogram exposition format")
+
+    @override_settings(CHAT_METRICS={'PRICES': {'gpt-3.5-turbo': {'PROMPT': 1.0, 'COMPLETION': 2.0}}})
+    def test_chat_request_timed_per_stage(self):
+        """Test a chat request reports its stages, tokens and cost"""
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            response = self.client.post(
+                '/api/chat/', {'message': 'Hello', 'session_id': self.session_id, 'cache': False},
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stages = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        for name in ('validation', 'conversation', 'history', 'upstream_ttfb', 'upstream',
+                     'persistence'):
+            self.assertIn(name, stages)
+            self.assertEqual(stage_seconds.count(name), 1)
+
+        prompt = tokens_total.value('gpt-3.5-turbo', 'prompt')
+        self.assertGreater(prompt, 0)
+        self.assertEqual(tokens_total.value('gpt-3.5-turbo', 'completion'), 5)
+        self.assertAlmostEqual(cost_total.value('gpt-3.5-turbo'), (prompt + 2 * 5) / 1000)
+
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('chat_stage_seconds_count{stage="upstream_ttfb"} 1', body)
+        self.assertIn('chat_request_seconds_count{view="chat",status="200"} 1', body)
+        self.assertIn('chat_tokens_total{model="gpt-3.5-turbo",kind="completion"} 5', body)
+        print(f"✓ Server-Timing: {response['Server-Timing']}")
+
+    def test_stream_records_usage_and_first_token(self):
+        """Test streamed replies record time to first token and usage"""
+        with FakeOpenAIServer() as upstream:
+            client = OpenAI(base_url=upstream.url, api_key='test', max_retries=0)
+            events = list(ChatbotService(client=client).stream_chat("Hi", self.session_id, use_cache=False))
+
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(stage_seconds.count('upstream_ttfb'), 1)
+        self.assertEqual(stage_seconds.count('upstream'), 1)
+        self.assertEqual(tokens_total.value('gpt-3.5-turbo', 'completion'), 5)
+        print("✓ Streamed reply instrumented")
+
+    def test_stage_overhead(self):
+        """Test timing a stage costs microseconds"""
+        runs = 10000
+        started = time.perf_counter()
+        for _ in range(runs):
+            with stage('noop'):
+                pass
+        per_stage = (time.perf_counter() - started) / runs
+        self.assertLess(per_stage, 50e-6)
+        print(f"✓ Stage overhead: {per_stage * 1e6:.1f}µs")
+
+    @override_settings(CHAT_METRICS={'ENABLED': False})
+    def test_metrics_disabled(self):
+        """Test /metrics is hidden when metrics are off"""
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_404_NOT_FOUND)
+        print("✓ Metrics endpoint disabled")
+
+
+class LoadBenchTest(TestCase):
+    """Test cases for the load benchmark harness"""
+
+    def test_seed_conversations(self):
+        """Test seeding bulk-creates whole conversations"""
+        sessions = seed_conversations(3, 4)
+
+        self.assertEqual(len(sessions), 3)
+        self.assertEqual(Message.objects.filter(conversation__session_id__in=sessions).count(), 12)
+        self.assertEqual(Conversation.objects.get(session_id=sessions[0]).last_seq, 4)
+        print("✓ Seeded conversations")
+
+    def test_scenarios_run(self):
+        """Test every scenario completes against the fake upstream"""
+        sessions = seed_conversations(4, 6)
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            results = {
+                name: run_scenario(scenario(sessions, {'hot_sessions': 2}), 4, 1)
+                for name, scenario in SCENARIOS.items()
+            }
+
+        for name, result in results.items():
+            self.assertEqual(result['requests'], 4, name)
+            self.assertEqual(result['errors'], 0, name)
+            self.assertGreater(result['queries_per_request'], 0, name)
+        print(f"✓ Scenarios ran: {', '.join(results)}")
+
+    def test_regressions_against_baseline(self):
+        """Test slower or chattier runs are flagged, others are not"""
+        parameters = {'requests': 100}
+        before = {'rps': 100.0, 'p50': 0.01, 'p95': 0.02, 'p99': 0.03,
+                  'queries_per_request': 5.0, 'errors': 0, 'requests': 100}
+        baseline = {'new_sessions': {'parameters': parameters, 'result': before}}
+
+        self.assertEqual(regressions({'new_sessions': dict(before, rps=90.0)}, baseline, parameters, 0.2), [])
+        found = regressions(
+            {'new_sessions': dict(before, rps=50.0, queries_per_request=9.0)}, baseline, parameters, 0.2
+        )
+        self.assertEqual(len(found), 2)
+        # A baseline taken with other parameters is not comparable.
+        self.assertEqual(regressions({'new_sessions': dict(before, rps=1.0)}, baseline, {}, 0.2), [])
+        print(f"✓ Regressions flagged: {found}")
+
+
+class RetentionTest(TestCase):
+    """Test cases for archiving idle conversations"""
+
+    def setUp(self):
+        """Set up an archive directory and one idle and one active conversation"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(CHAT_RETENTION={
+            'ARCHIVE_AFTER_DAYS': 30, 'DIR': self.tmp.name, 'CHUNK_SIZE': 2, 'DELETE_BATCH': 2
+        })
+        self.settings.enable()
+        self.idle = self.conversation('idle-session', 5, days=60)
+        self.active = self.conversation('active-session', 2, days=1)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def conversation(self, session_id, messages, days):
+        conversation = Conversation.objects.create(session_id=session_id)
+        save_turn(conversation, *[
+            new_message(conversation, 'user' if i % 2 == 0 else 'assistant', f'{session_id} message {i}')
+            for i in range(messages)
+        ])
+        Conversation.objects.filter(pk=conversation.pk).update(
+            updated_at=timezone.now() - timedelta(days=days)
+        )
+        return conversation
+
+    def test_idle_conversations_archived(self):
+        """Test idle conversations move to an archive file, active ones stay"""
+        stats = Archiver().run()
+
+        self.assertEqual(stats['archived'], 1)
+        self.assertEqual(stats['messages'], 5)
+        self.assertFalse(Conversation.objects.filter(session_id='idle-session').exists())
+        self.assertFalse(Message.objects.filter(conversation_id=self.idle.pk).exists())
+        self.assertTrue(Conversation.objects.filter(session_id='active-session').exists())
+        archived = ArchivedConversation.objects.get(session_id='idle-session')
+        self.assertEqual(archived.message_count, 5)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, archived.file)))
+        print(f"✓ Archived into {archived.file}")
+
+    def test_archived_session_restored_on_access(self):
+        """Test an archived session comes back with its ids and timestamps"""
+        original = list(Message.objects.filter(conversation_id=self.idle.pk).values_list('pk', 'timestamp'))
+        Archiver().run()
+
+        response = self.client.get('/api/conversations/idle-session/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        restored = Conversation.objects.get(session_id='idle-session')
+        self.assertEqual(restored.pk, self.idle.pk)
+        self.assertEqual(
+            list(Message.objects.filter(conversation=restored).values_list('pk', 'timestamp')), original
+        )
+        self.assertFalse(ArchivedConversation.objects.exists())
+
+        # A chat turn restores it too, and continues its numbering.
+        Archiver(days=0).run()
+        conversation = ChatbotService(client=MagicMock()).get_or_create_conversation('idle-session')
+        self.assertEqual(conversation.last_seq, 5)
+        print("✓ Archived session restored on access")
+
+    def test_rearchiving_keeps_shared_files(self):
+        """Test archiving restored conversations again never replaces a file others use"""
+        middle = self.conversation('middle-session', 3, days=60)
+        self.conversation('last-session', 2, days=60)
+        with override_settings(CHAT_RETENTION={**settings.CHAT_RETENTION, 'CHUNK_SIZE': 3}):
+            Archiver().run()
+        shared = ArchivedConversation.objects.get(session_id='middle-session').file
+
+        # Same first and last primary key as the first chunk.
+        restore('idle-session')
+        restore('last-session')
+        # Restoring marks them active; idle them again.
+        Conversation.objects.filter(session_id__in=['idle-session', 'last-session']).update(
+            updated_at=timezone.now() - timedelta(days=60)
+        )
+        self.assertEqual(Archiver().run()['archived'], 2)
+
+        rewritten = ArchivedConversation.objects.get(session_id='idle-session').file
+        self.assertNotEqual(rewritten, shared)
+        for name in (shared, rewritten):
+            self.assertTrue(os.path.exists(os.path.join(self.tmp.name, name)))
+        self.assertEqual(restore('middle-session').pk, middle.pk)
+        self.assertEqual(Message.objects.filter(conversation_id=middle.pk).count(), 3)
+        self.assertIsNotNone(restore('idle-session'))
+        self.assertIsNotNone(restore('last-session'))
+        print("✓ Re-archived chunk written to a new file")
+
+    def test_interrupted_run_resumes(self):
+        """Test a run stopped after indexing a chunk is finished by the next"""
+        with patch.object(Archiver, 'evict_pending'):
+            Archiver().run(limit=1)
+        self.assertTrue(ArchivedConversation.objects.filter(session_id='idle-session').exists())
+        self.assertTrue(Conversation.objects.filter(session_id='idle-session').exists())
+
+        stats = Archiver().run()
+        self.assertEqual(stats['archived'], 1)
+        self.assertFalse(Conversation.objects.filter(session_id='idle-session').exists())
+        print("✓ Interrupted archival resumed")
+
+    def test_turn_during_eviction_keeps_conversation(self):
+        """Test a conversation that got a new turn after archival stays hot"""
+        with patch.object(Archiver, 'evict_pending'):
+            Archiver().run()
+        Message.objects.filter(pk=Message.objects.filter(conversation_id=self.idle.pk).first().pk).delete()
+        save_turn(self.idle, new_message(self.idle, 'user', 'Back again'))
+
+        stats = Archiver().run()
+        self.assertEqual(stats['reactivated'], 1)
+        self.assertEqual(Message.objects.filter(conversation_id=self.idle.pk).count(), 6)
+        self.assertFalse(ArchivedConversation.objects.filter(session_id='idle-session').exists())
+        print("✓ Reactivated conversation kept, deleted messages put back")
+
+    def test_purge(self):
+        """Test expired archives and their files are removed"""
+        Archiver().run()
+        (name,) = os.listdir(self.tmp.name)
+        expired = (timezone.now() - timedelta(days=50)).timestamp()
+        os.utime(os.path.join(self.tmp.name, name), (expired, expired))
+        with override_settings(CHAT_RETENTION={
+            'ARCHIVE_AFTER_DAYS': 30, 'PURGE_AFTER_DAYS': 45, 'DIR': self.tmp.name
+        }):
+            stats = Archiver().purge()
+
+        self.assertEqual(stats['purged'], 1)
+        self.assertEqual(stats['files_removed'], 1)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        print("✓ Expired archives purged")
+
+    def test_purge_keeps_files_of_running_archivers(self):
+        """Test unindexed files newer than the purge cutoff, and partial ones, are kept"""
+        for name in ('conversations-0000000001-0000000002-0123456789ab.jsonl.gz',
+                     'conversations-0000000003-0000000004-0123456789ab.jsonl.gz.partial'):
+            with open(os.path.join(self.tmp.name, name), 'w'):
+                pass
+        with override_settings(CHAT_RETENTION={
+            'ARCHIVE_AFTER_DAYS': 30, 'PURGE_AFTER_DAYS': 45, 'DIR': self.tmp.name
+        }):
+            stats = Archiver().purge()
+
+        self.assertEqual(stats['files_removed'], 0)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 2)
+        print("✓ Files still being archived left alone")
+
+
+class StaticUITest(TestCase):
+    """Test cases for serving the chat UI pages and their assets"""
+
+    def test_page_revalidates_with_304(self):
+        """Test a repeat load with the page's ETag gets an empty 304"""
+        first = self.client.get('/chat/')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('no-cache', first['Cache-Control'])
+        self.assertNotIn(b'<style>', first.content)
+        self.assertRegex(first.content, rb'/static/chatbot/chatbot(\.[0-9a-f]{12})?\.js')
+
+        again = self.client.get('/chat/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+        print(f"✓ Page revalidated with 304 ({len(first.content)} bytes saved)")
+
+    def test_page_sent_compressed(self):
+        """Test the page is sent gzipped to clients that accept it"""
+        plain = self.client.get('/studio/')
+        compressed = self.client.get('/studio/', HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        self.assertEqual(compressed['ETag'], plain['ETag'])
+        print(f"✓ Page sent as {len(compressed.content)} of {len(plain.content)} bytes")
+
+    def test_fingerprinted_assets(self):
+        """Test collected assets are hashed, precompressed and cached forever"""
+        with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            script = staticfiles_storage.stored_name('chatbot/chatbot.js')
+            self.assertRegex(script, r'^chatbot/chatbot\.[0-9a-f]{12}\.js$')
+            self.assertTrue(os.path.exists(os.path.join(root, script + '.gz')))
+
+            page = self.client.get('/chat/')
+            self.assertIn(f'/static/{script}'.encode(), page.content)
+
+            response = self.client.get(f'/static/{script}', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertIn('javascript', response['Content-Type'])
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertIn('max-age=31536000', response['Cache-Control'])
+            body = gzip.decompress(b''.join(response.streaming_content))
+            with open(os.path.join(root, script), 'rb') as file:
+                self.assertEqual(body, file.read())
+
+            self.assertEqual(self.client.get('/static/../settings.py').status_code, 404)
+            self.assertEqual(self.client.get('/static/chatbot/missing.js').status_code, 404)
+        print(f"✓ Asset served as {script} with far-future caching")
+
+
+class QuotaTest(TestCase):
+    """Test cases for token quotas and usage accounting"""
+
+    def setUp(self):
+        self.session_id = str(uuid.uuid4())
+        quotas.reset()
+
+    def chat(self, **extra):
+        return self.client.post(
+            '/api/chat/', {'message': 'Hello', 'session_id': self.session_id, 'cache': False},
+            content_type='application/json', **extra
+        )
+
+    def test_sliding_window(self):
+        """Test the previous window fades out and Retry-After matches it"""
+        self.assertEqual(sliding_count(10, 100, 900, 3600), 85)
+
+        wait = seconds_until_under(100, 60, 80, 900, 3600)
+        self.assertAlmostEqual(sliding_count(60, 80, 900 + wait, 3600), 100)
+        # Over quota within this window alone: wait for it to slide out.
+        wait = seconds_until_under(100, 150, 0, 900, 3600)
+        self.assertAlmostEqual(sliding_count(0, 150, wait - (3600 - 900), 3600), 100)
+        print(f"✓ Sliding window frees up after {wait:.0f}s")
+
+    @override_settings(CHAT_QUOTAS={'SESSION_TOKENS': 10, 'FLUSH_INTERVAL': 3600})
+    def test_session_over_quota_rejected_early(self):
+        """Test a session over quota gets a 429 without touching the database"""
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            first = self.chat()
+            with CaptureQueriesContext(connection) as queries:
+                second = self.chat()
+            calls = len(upstream.requests)
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreater(int(second['Retry-After']), 0)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(calls, 1)
+        self.assertEqual(Message.objects.filter(conversation__session_id=self.session_id).count(), 2)
+        print(f"✓ Rejected in 0 queries, retry after {second['Retry-After']}s")
+
+    @override_settings(CHAT_QUOTAS={'IP_TOKENS': 10, 'FLUSH_INTERVAL': None})
+    def test_ip_quota_covers_new_sessions(self):
+        """Test a client address cannot dodge its quota with new sessions"""
+        Account(ip='10.0.0.1').charge('gpt-3.5-turbo', MagicMock(prompt_tokens=8, completion_tokens=4))
+
+        response = self.client.post(
+            '/api/chat/', {'message': 'Hello'}, content_type='application/json', REMOTE_ADDR='10.0.0.1'
+        )
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('ip', response.json()['error'])
+        Account(ip='10.0.0.2').check()
+        print("✓ Address quota applies across sessions")
+
+    @override_settings(CHAT_QUOTAS={'SESSION_TOKENS': 10, 'BACKEND': 'default', 'FLUSH_INTERVAL': None})
+    def test_shared_counters(self):
+        """Test counters kept in a Django cache, sync and async"""
+        account = Account(session_id=self.session_id)
+        account.check()
+        asyncio.run(account.acharge('gpt-3.5-turbo', MagicMock(prompt_tokens=8, completion_tokens=4)))
+
+        with self.assertRaises(QuotaExceeded):
+            account.check()
+        with self.assertRaises(QuotaExceeded):
+            asyncio.run(account.acheck())
+        # Nothing in this process's memory.
+        self.assertEqual(quotas.local.totals([f'session:{self.session_id}'], 0, 3600), [(0, 0)])
+        print("✓ Shared quota counters")
+
+    @override_settings(CHAT_QUOTAS={'USER_TOKENS': 10, 'FLUSH_INTERVAL': 3600})
+    def test_user_usage_recorded_for_billing(self):
+        """Test per-user quotas, conversation ownership and the usage table"""
+        user = User.objects.create_user('billing', password='secret')
+        self.client.force_login(user)
+
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            first = self.chat(REMOTE_ADDR='10.0.0.3')
+            self.session_id = str(uuid.uuid4())
+            second = self.chat(REMOTE_ADDR='10.0.0.3')
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('user', second.json()['error'])
+        self.assertEqual(Conversation.objects.get(session_id=first.json()['session_id']).user, user)
+
+        self.assertEqual(quotas.ledger.flush(), 1)
+        usage = TokenUsage.objects.get()
+        self.assertEqual((usage.user, usage.ip, usage.calls), (user, '10.0.0.3', 1))
+        self.assertEqual(usage.session_id, first.json()['session_id'])
+        self.assertEqual(usage.completion_tokens, 5)
+        self.assertGreater(usage.prompt_tokens, 0)
+
+        out = StringIO()
+        call_command('chat_usage', stdout=out)
+        self.assertIn('billing', out.getvalue())
+        print(f"✓ Usage recorded: {usage.prompt_tokens}+{usage.completion_tokens} tokens")
+
+    @override_settings(CHAT_QUOTAS={'USER_TOKENS': 10, 'FLUSH_INTERVAL': None},
+                       CHAT_JOBS={'BACKEND': 'database'})
+    def test_background_job_charged_to_user(self):
+        """Test a queued job's tokens count against the user who submitted it"""
+        user = User.objects.create_user('worker', password='secret')
+        self.client.force_login(user)
+        response = self.client.post(
+            '/api/chat/', {'message': 'Hello', 'background': True},
+            content_type='application/json', REMOTE_ADDR='10.0.0.5'
+        )
+        job = ChatJob.objects.get(pk=response.json()['job_id'])
+        self.assertEqual((job.user, job.ip), (user, '10.0.0.5'))
+
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            run_job(job)
+
+        self.assertEqual(job.status, ChatJob.DONE)
+        self.assertEqual(Conversation.objects.get(session_id=job.session_id).user, user)
+        with self.assertRaises(QuotaExceeded):
+            Account(user_id=user.pk).check()
+        print("✓ Background job charged to its user")
+
+    @override_settings(CHAT_QUOTAS={'USER_TOKENS': 10, 'FLUSH_INTERVAL': None},
+                       CHAT_JOBS={'BACKEND': 'database'})
+    async def test_async_background_job_charged_to_user(self):
+        """Test a job queued through the async endpoint is charged to its user"""
+        user = await sync_to_async(User.objects.create_user)('async-worker', password='secret')
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.post(
+            '/api/chat/async/', {'message': 'Hello', 'background': True}, content_type='application/json'
+        )
+        job = await ChatJob.objects.aget(pk=response.json()['job_id'])
+        self.assertEqual((job.user_id, job.ip), (user.pk, '127.0.0.1'))
+
+        with FakeOpenAIServer() as upstream, \
+                override_settings(OPENAI_BASE_URL=upstream.url, OPENAI_API_KEY='test'):
+            await sync_to_async(run_job)(job)
+
+        self.assertEqual(job.status, ChatJob.DONE)
+        with self.assertRaises(QuotaExceeded):
+            await Account(user_id=user.pk).acheck()
+        print("✓ Async background job charged to its user")
+
+    @override_settings(CHAT_QUOTAS={'SESSION_TOKENS': 10, 'FLUSH_INTERVAL': None})
+    def test_batch_checks_each_record(self):
+        """Test batch records are checked against their session's quota one by one"""
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message.content = "Batch reply"
+        response.usage = MagicMock(prompt_tokens=8, completion_tokens=4)
+        upstream = MagicMock()
+        upstream.chat.completions.create.return_value = response
+        runner = BatchRunner(concurrency=1, use_cache=False,
+                             service=ChatbotService(client=upstream, account=Account(ip='10.0.0.6')))
+        lines = [json.dumps({'message': message, 'session_id': session_id})
+                 for message, session_id in [('First', 'quota-a'), ('Second', 'quota-a'), ('Other', 'quota-b')]]
+
+        results = {result['line']: result for result in runner.results(parse_records(lines))}
+
+        self.assertEqual([results[line]['status'] for line in (1, 2, 3)], ['ok', 'error', 'ok'])
+        self.assertGreater(results[2]['retry_after'], 0)
+        self.assertEqual(upstream.chat.completions.create.call_count, 2)
+        print("✓ Batch record over its session's quota rejected")
+
+    async def test_socket_account_has_logged_in_user(self):
+        """Test a WebSocket opened with a login session counts against its user"""
+        user = await sync_to_async(User.objects.create_user)('socket', password='secret')
+        await self.async_client.aforce_login(user)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.async_client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        scope = {'type': 'websocket', 'headers': [(b'cookie', cookie.encode())], 'client': ('10.0.0.7', 5000)}
+
+        account = scope_account({**scope, 'user': await aget_user(ScopeSession(scope))}, 'ws-user')
+        anonymous = scope_account({'headers': [], 'user': await aget_user(ScopeSession({'headers': []}))})
+
+        self.assertEqual((account.user_id, account.session_id, account.ip), (user.pk, 'ws-user', '10.0.0.7'))
+        self.assertIsNone(anonymous.user_id)
+        print("✓ WebSocket account resolved from the session cookie")
+
+
 # ============================================
 # API TESTS
 # ============================================
@@ -287,6 +1823,80 @@ class ChatAPITest(APITestCase):
         self.assertIn('error', response.data)
         print("✓ API error handled correctly")
 
+    @patch('chatbot.services.ChatbotService.chat')
+    def test_chat_post_upstream_busy(self, mock_chat):
+        """Test POST when the upstream is rate limiting"""
+        mock_chat.return_value = {
+            'error': 'Upstream unavailable',
+            'session_id': self.session_id,
+            'retry_after': 2.5
+        }
+
+        response = self.client.post(self.chat_url, {'message': 'Hello'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '3')
+        print("✓ Upstream throttling returned 503 with Retry-After")
+
+
+    @patch('chatbot.services.OpenAI')
+    def test_chat_post_stream(self, mock_openai):
+        """Test POST with stream=true returns server-sent events"""
+        mock_stream = MagicMock()
+        mock_stream.__iter__.return_value = iter(make_stream_chunks(["Hi", " there"]))
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = mock_stream
+        mock_openai.return_value = mock_client
+
+        data = {'message': 'Hello', 'session_id': self.session_id, 'stream': True}
+        response = self.client.post(self.chat_url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode()
+        self.assertIn('event: token\ndata: {"content": "Hi"}', body)
+        self.assertIn('event: done', body)
+        self.assertEqual(
+            Message.objects.filter(role='assistant').get().content, "Hi there"
+        )
+        print("✓ Streaming endpoint sends tokens as SSE")
+
+
+class AsyncChatAPITest(TestCase):
+    """Test cases for the async chat endpoint"""
+
+    def setUp(self):
+        """Set up URL and session"""
+        self.chat_url = '/api/chat/async/'
+        self.session_id = str(uuid.uuid4())
+
+    @patch('chatbot.services.AsyncChatbotService.chat', new_callable=AsyncMock)
+    async def test_async_chat_post(self, mock_chat):
+        """Test POST to the async chat endpoint"""
+        mock_chat.return_value = {
+            'message': 'Hello! How can I help?',
+            'session_id': self.session_id,
+            'conversation_id': 1
+        }
+
+        response = await self.async_client.post(
+            self.chat_url, {'message': 'Hello'}, content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['session_id'], self.session_id)
+        print("✓ Async chat endpoint returns reply")
+
+    async def test_async_chat_post_missing_message(self):
+        """Test async endpoint validation"""
+        response = await self.async_client.post(
+            self.chat_url, {}, content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('message', response.json())
+        print("✓ Async endpoint validation works")
+
 
 class ConversationAPITest(APITestCase):
     """Test cases for Conversation API endpoints"""
@@ -349,6 +1959,521 @@ class ConversationAPITest(APITestCase):
         self.assertEqual(messages[1]['role'], 'assistant')
         print("✓ Messages returned in correct order")
 
+    def test_list_is_summary_without_messages(self):
+        """Test the list returns message counts instead of nested messages"""
+        response = self.client.get('/api/conversations/')
+
+        conversation = response.data['results'][0]
+        self.assertNotIn('messages', conversation)
+        self.assertEqual(conversation['message_count'], 2)
+        self.assertIsNotNone(conversation['last_message_at'])
+        print("✓ Conversation list is a lightweight summary")
+
+    def test_list_query_count_constant(self):
+        """Test listing conversations does not issue a query per conversation"""
+        for i in range(5):
+            other = Conversation.objects.create(session_id=str(uuid.uuid4()))
+            Message.objects.create(conversation=other, role='user', content=f'Hi {i}')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/conversations/?page_size=3')
+
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertIsNotNone(response.data['next'])
+        print("✓ Conversation list paginated in a single query")
+
+    def test_messages_endpoint_keyset_pagination(self):
+        """Test the messages endpoint pages through history by cursor"""
+        url = f'/api/conversations/{self.session_id}/messages/?page_size=1'
+        first = self.client.get(url)
+        self.assertEqual([m['content'] for m in first.data['results']], ['Hello'])
+
+        second = self.client.get(first.data['next'])
+        self.assertEqual([m['content'] for m in second.data['results']], ['Hi there!'])
+        self.assertIsNone(second.data['next'])
+        print("✓ Messages paginated by (timestamp, id) cursor")
+
+    def test_messages_endpoint_invalid_cursor(self):
+        """Test a malformed cursor is rejected"""
+        url = f'/api/conversations/{self.session_id}/messages/?cursor=not-a-cursor'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        print("✓ Invalid cursor rejected")
+
+
+class SearchAPITest(APITestCase):
+    """Test cases for full-text search over messages"""
+
+    def setUp(self):
+        """Set up two conversations written the way chat turns are"""
+        self.client = APIClient()
+        self.first = Conversation.objects.create(session_id=str(uuid.uuid4()))
+        self.second = Conversation.objects.create(session_id=str(uuid.uuid4()))
+        # save_turn uses bulk_create, which sends no signals.
+        save_turn(
+            self.first,
+            new_message(self.first, 'user', 'How do I request a refund for my order?'),
+            new_message(self.first, 'assistant', 'Refunds are issued within 5 days <b>of</b> the request.'),
+        )
+        save_turn(
+            self.second,
+            new_message(self.second, 'user', 'Tell me about the refund refund policy.'),
+            new_message(self.second, 'assistant', 'Shipping is free on orders over $50.'),
+        )
+
+    def search(self, **params):
+        response = self.client.get('/api/search/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_ranked_hits_with_snippets(self):
+        """Test hits are ranked and snippets mark the matches"""
+        results = self.search(q='refund')['results']
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual([hit['rank'] for hit in results], sorted((hit['rank'] for hit in results), reverse=True))
+        self.assertTrue(all('<mark>' in hit['snippet'] for hit in results))
+        # Message text is escaped; only the marks are markup.
+        snippets = ' '.join(hit['snippet'] for hit in results)
+        self.assertNotIn('<b>', snippets)
+        print(f"✓ Ranked hits: {[hit['snippet'] for hit in results]}")
+
+    def test_filters_and_pagination(self):
+        """Test session and role filters, and following the next link"""
+        results = self.search(q='refund', session_id=self.first.session_id, role='assistant')['results']
+        self.assertEqual([hit['message_id'] for hit in results],
+                         [self.first.messages.get(role='assistant').pk])
+
+        page = self.search(q='refund', page_size=2)
+        self.assertEqual(len(page['results']), 2)
+        self.assertIsNone(page['previous'])
+        second = self.client.get(page['next']).data
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next'])
+        print("✓ Search filtered and paginated")
+
+    def test_index_follows_updates_and_deletes(self):
+        """Test edited and deleted messages are reflected in the index"""
+        message = self.second.messages.get(role='assistant')
+        message.content = 'Refund shipping costs are covered too.'
+        message.save()
+        self.assertIn(message.pk, [hit['message_id'] for hit in self.search(q='refund')['results']])
+        self.assertEqual(self.search(q='free')['results'], [])
+
+        Message.objects.filter(conversation=self.first).delete()
+        self.assertEqual(len(self.search(q='refund')['results']), 2)
+        print("✓ Index follows updates and deletes")
+
+    def test_query_syntax_is_inert(self):
+        """Test punctuation and operators in the query are not errors"""
+        for q in ['"refund', 'refund AND OR NOT', 'refund*', 'NEAR(refund', ')(*:']:
+            self.search(q=q)
+        self.assertEqual(len(self.search(q='refu*')['results']), 3)
+
+        response = self.client.get('/api/search/', {'q': ''})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("✓ Query syntax cannot break the search")
+
+    @skipIf(connection.vendor != 'sqlite', "SQLite only")
+    def test_sqlite_uses_fts5(self):
+        """Test SQLite databases get the FTS5 backend"""
+        self.assertIsInstance(search_backend(), SQLiteFTSBackend)
+        # The FTS5 table lookup is not repeated per request.
+        with self.assertNumQueries(0):
+            self.assertIsInstance(search_backend(), SQLiteFTSBackend)
+        print("✓ SQLite search backed by FTS5")
+
+    @override_settings(CHAT_SEARCH={'BACKEND': 'chatbot.search.ScanBackend'})
+    def test_scan_backend(self):
+        """Test the unindexed fallback finds the same messages"""
+        results = self.search(q='refund', role='user')['results']
+
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all('<mark>' in hit['snippet'] for hit in results))
+        print("✓ Scan backend fallback")
+
+
+class FastSerializationTest(APITestCase):
+    """Test cases for the fast serialization path"""
+
+    def setUp(self):
+        """Set up a conversation long enough to be compressed"""
+        self.client = APIClient()
+        self.conversation = Conversation.objects.create(session_id='fast-session')
+        save_turn(self.conversation, *[
+            new_message(self.conversation, 'user' if i % 2 == 0 else 'assistant', f'Message {i} ünïcode \u2028')
+            for i in range(200)
+        ])
+
+    def both_modes(self, url):
+        responses = []
+        for fast in (False, True):
+            with override_settings(CHAT_SERIALIZATION={'FAST': fast, 'COMPRESS_MIN_BYTES': None}):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            responses.append(response.json())
+        return responses
+
+    def test_same_output_as_serializers(self):
+        """Test every conversation endpoint returns what the serializers did"""
+        for url in (
+            '/api/conversations/',
+            '/api/conversations/fast-session/',
+            '/api/conversations/fast-session/messages/?page_size=20',
+        ):
+            slow, fast = self.both_modes(url)
+            self.assertEqual(fast, slow, url)
+
+        first, _ = self.both_modes('/api/conversations/fast-session/messages/?page_size=20')
+        slow, fast = self.both_modes(first['next'])
+        self.assertEqual(fast, slow)
+        print("✓ Fast path output identical to the serializers")
+
+    def test_dumps_matches_json_renderer(self):
+        """Test the renderer writes the same bytes as DRF's JSONRenderer"""
+        data = {
+            'message': 'Grüße \u2028 "quoted"',
+            'when': timezone.now(),
+            'id': uuid.uuid4(),
+            'items': [1, 2.5, None, True],
+        }
+        self.assertEqual(dumps(data), JSONRenderer().render(data))
+        print("✓ Renderer output matches JSONRenderer")
+
+    @override_settings(CHAT_SERIALIZATION={'FAST': True, 'COMPRESS_MIN_BYTES': 1024})
+    def test_large_responses_compressed(self):
+        """Test large JSON responses are gzipped for clients that accept it"""
+        url = '/api/conversations/fast-session/'
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+
+        compressed = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(compressed.content)), plain.json())
+        self.assertLess(len(compressed.content), len(plain.content) / 3)
+
+        small = self.client.get('/api/conversations/?page_size=1', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(small.has_header('Content-Encoding'))
+        print(f"✓ {len(plain.content)} bytes sent as {len(compressed.content)} gzipped")
+
+
+@override_settings(CHAT_JOBS={'BACKEND': 'database'})
+class ChatJobAPITest(APITestCase):
+    """Test cases for background chat jobs"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.chat_url = '/api/chat/'
+
+    def submit(self, **data):
+        return self.client.post(self.chat_url, {'message': 'Hello', 'background': True, **data},
+                                format='json')
+
+    @patch('chatbot.services.ChatbotService.chat')
+    def test_background_job_polled_to_completion(self, mock_chat):
+        """Test POST returns 202 at once and the job result can be polled"""
+        response = self.submit()
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], ChatJob.QUEUED)
+        self.assertTrue(response['Location'].endswith(f"/api/chat/jobs/{response.data['job_id']}/"))
+        mock_chat.assert_not_called()
+
+        mock_chat.return_value = {
+            'message': 'Hi!',
+            'session_id': response.data['session_id'],
+            'conversation_id': 1
+        }
+        self.assertEqual(drain(once=True), 1)
+
+        job = self.client.get(response['Location'])
+        self.assertEqual(job.data['status'], ChatJob.DONE)
+        self.assertEqual(job.data['result']['message'], 'Hi!')
+        mock_chat.assert_called_once_with('Hello', response.data['session_id'], True)
+        print(f"✓ Background job completed: {job.data['job_id']}")
+
+    @override_settings(CHAT_WEBHOOKS={'SECRET': 'hook-secret', 'ALLOWED_HOSTS': ['example.com']})
+    @patch('chatbot.jobs.httpx.post')
+    @patch('chatbot.services.ChatbotService.chat')
+    def test_webhook_called_with_result(self, mock_chat, mock_post):
+        """Test a failed job is recorded and posted, signed, to its webhook"""
+        mock_chat.return_value = {'error': 'API Error', 'session_id': 'abc'}
+        response = self.submit(webhook_url='https://example.com/hook')
+
+        run_job(ChatJob.objects.get(pk=response.data['job_id']))
+
+        job = ChatJob.objects.get(pk=response.data['job_id'])
+        self.assertEqual(job.status, ChatJob.FAILED)
+        self.assertEqual(mock_post.call_args.args[0], 'https://example.com/hook')
+        body = mock_post.call_args.kwargs['content']
+        self.assertIn(b'"status":"failed"', body)
+        headers = mock_post.call_args.kwargs['headers']
+        expected = hmac.new(
+            b'hook-secret', headers['X-Webhook-Timestamp'].encode() + b'.' + body, hashlib.sha256
+        ).hexdigest()
+        self.assertEqual(headers['X-Webhook-Signature'], f'sha256={expected}')
+        print("✓ Webhook received the signed job result")
+
+    @override_settings(CHAT_WEBHOOKS={'SECRET': 'hook-secret'})
+    def test_internal_webhook_urls_rejected(self):
+        """Test webhooks to loopback, private and metadata addresses are refused"""
+        for url in ('http://127.0.0.1:8000/admin/', 'http://10.0.0.5/hook',
+                    'http://169.254.169.254/latest/meta-data/', 'http://[::1]/hook', 'ftp://example.com/'):
+            response = self.submit(webhook_url=url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, url)
+        self.assertFalse(ChatJob.objects.exists())
+        with override_settings(CHAT_WEBHOOKS={}):
+            self.assertEqual(self.submit(webhook_url='https://example.com/hook').status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        print("✓ Internal and unsigned webhook URLs rejected")
+
+    @override_settings(CHAT_WEBHOOKS={'SECRET': 'hook-secret'})
+    @patch('chatbot.jobs.httpx.post')
+    @patch('chatbot.webhooks.socket.getaddrinfo')
+    @patch('chatbot.services.ChatbotService.chat')
+    def test_webhook_resolving_to_private_address_not_called(self, mock_chat, mock_resolve, mock_post):
+        """Test a webhook host that resolves to a private address is not called"""
+        mock_chat.return_value = {'message': 'Hi!', 'session_id': 'abc'}
+        mock_resolve.return_value = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.168.1.10', 80))]
+        response = self.submit(webhook_url='http://hooks.internal.example/job')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        run_job(ChatJob.objects.get(pk=response.data['job_id']))
+
+        mock_resolve.assert_called_once()
+        mock_post.assert_not_called()
+        print("✓ Webhook to a private address never sent")
+
+    def test_stale_running_job_requeued(self):
+        """Test jobs orphaned by a crashed worker go back to the queue"""
+        job = ChatJob.objects.create(
+            session_id='abc', message='Hello', status=ChatJob.RUNNING, attempts=1,
+            started_at=timezone.now() - timedelta(hours=1)
+        )
+
+        self.assertEqual(requeue_stale(job_settings()), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.QUEUED)
+        print("✓ Stale job requeued")
+
+    def test_stream_and_background_rejected(self):
+        """Test a request cannot ask for both streaming and a background job"""
+        response = self.submit(stream=True)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("✓ stream + background rejected")
+
+    def test_unknown_job_404(self):
+        """Test polling an unknown job id"""
+        response = self.client.get(f'/api/chat/jobs/{uuid.uuid4()}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        print("✓ Unknown job returns 404")
+
+
+class BatchChatTest(TestCase):
+    """Test cases for bulk processing of JSONL chat records"""
+
+    def setUp(self):
+        history_cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.directory.name, 'out.jsonl')
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message.content = "Batch reply"
+        self.upstream = MagicMock()
+        self.upstream.chat.completions.create.return_value = response
+        self.service = ChatbotService(client=self.upstream)
+        self.lines = [
+            json.dumps({'message': 'First', 'session_id': 'batch-a'}),
+            json.dumps({'message': 'Solo'}),
+            'not json',
+            json.dumps({'message': 'Second', 'session_id': 'batch-a'}),
+        ]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_batch(self, **options):
+        return list(run_batch(self.lines, self.output, concurrency=1, use_cache=False,
+                              service=self.service, **options))
+
+    def test_batch_writes_result_per_record(self):
+        """Test every record gets a status and sessions keep their order"""
+        results = self.run_batch()
+
+        statuses = {result['line']: result['status'] for result in results}
+        self.assertEqual(statuses, {1: 'ok', 2: 'ok', 3: 'error', 4: 'ok'})
+        conversation = Conversation.objects.get(session_id='batch-a')
+        self.assertEqual(
+            list(conversation.messages.filter(role='user').values_list('content', flat=True)),
+            ['First', 'Second']
+        )
+        with open(self.output) as output:
+            self.assertEqual(len(output.readlines()), 4)
+        print(f"✓ Batch answered {len(results)} records")
+
+    def test_batch_resumes_after_crash(self):
+        """Test a rerun skips records the previous run already answered"""
+        with open(self.output, 'w') as output:
+            output.write(json.dumps({'line': 1, 'status': 'ok'}) + '\n')
+            output.write('{"line": 2, "sta')
+
+        results = self.run_batch(retry_failed=True)
+
+        self.assertEqual(sorted(result['line'] for result in results), [2, 3, 4])
+        self.assertEqual(self.upstream.chat.completions.create.call_count, 2)
+        print("✓ Batch resumed after the last answered record")
+
+    def test_prepare_loads_chunk_in_bulk(self):
+        """Test a chunk's conversations and histories load with a few queries"""
+        for session_id in ('bulk-1', 'bulk-2'):
+            conversation = Conversation.objects.create(session_id=session_id)
+            Message.objects.create(conversation=conversation, role='user', content='Earlier')
+        history_cache.clear()
+        records = list(parse_records([
+            json.dumps({'message': 'Hi', 'session_id': session_id})
+            for session_id in ('bulk-1', 'bulk-2', 'bulk-3', 'bulk-4')
+        ]))
+
+        with CaptureQueriesContext(connection) as queries:
+            invalid, groups = BatchRunner(service=self.service).prepare(records)
+
+        self.assertEqual(len(groups), 4)
+        # Including the lookup of archived sessions among the missing ones.
+        self.assertLessEqual(len(queries), 5)
+        self.assertEqual(len(history_cache.get('bulk-1')), 1)
+        print(f"✓ Chunk of 4 sessions prepared in {len(queries)} queries")
+
+    @patch('chatbot.services.ChatbotService.reply')
+    def test_batch_endpoint_streams_results(self, mock_reply):
+        """Test the batch endpoint streams one JSON line per record"""
+        mock_reply.return_value = {'message': 'Batch reply', 'session_id': 'batch-a'}
+
+        with override_settings(CHAT_BATCH={'DIR': self.directory.name, 'CONCURRENCY': 1}):
+            response = self.client.post(
+                '/api/chat/batch/', '\n'.join(self.lines), content_type='application/x-ndjson'
+            )
+            results = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory.name, f"{response['X-Batch-Id']}.jsonl")
+        ))
+        print(f"✓ Batch endpoint streamed {len(results)} results")
+
+
+class SlowStreamService:
+    # Stands in for AsyncChatbotService.stream_chat with a slow upstream.
+    def __init__(self, tokens, delay=0.01):
+        self.tokens = tokens
+        self.delay = delay
+        self.cancelled = False
+
+    async def stream_chat(self, message, session_id=None, use_cache=True):
+        try:
+            for token in self.tokens:
+                await asyncio.sleep(self.delay)
+                yield 'token', {'content': token}
+            yield 'done', {'message': ''.join(self.tokens), 'session_id': session_id}
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+class SocketHarness:
+    # Drives ChatSocket through in-memory ASGI receive/send queues.
+    def __init__(self, service, headers=(), query=b''):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/ws/chat/', 'headers': list(headers),
+                 'query_string': query}
+        self.socket = ChatSocket(scope, self.incoming.get, self.outgoing.put, service=service)
+
+    async def __aenter__(self):
+        await self.incoming.put({'type': 'websocket.connect'})
+        self.task = asyncio.create_task(self.socket.run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, 2)
+
+    async def send(self, payload):
+        await self.incoming.put({'type': 'websocket.receive', 'text': json.dumps(payload)})
+
+    async def receive(self):
+        event = await asyncio.wait_for(self.outgoing.get(), 2)
+        return json.loads(event['text']) if 'text' in event else event
+
+    async def receive_until(self, kind):
+        frames = []
+        while not frames or frames[-1].get('type') != kind:
+            frames.append(await self.receive())
+        return frames
+
+
+@patch('chatbot.websocket.close_old_connections', MagicMock())
+class ChatSocketTest(TestCase):
+    """Test cases for the WebSocket chat transport"""
+
+    async def test_message_streams_tokens(self):
+        """Test a message frame streams tokens and a done frame"""
+        async with SocketHarness(SlowStreamService(["Hel", "lo"]), query=b'session_id=ws-1') as ws:
+            self.assertEqual((await ws.receive())['type'], 'websocket.accept')
+            self.assertEqual(await ws.receive(), {'type': 'session', 'session_id': 'ws-1'})
+
+            await ws.send({'type': 'message', 'message': 'Hi'})
+            frames = await ws.receive_until('done')
+
+        self.assertEqual([f['content'] for f in frames if f['type'] == 'token'], ["Hel", "lo"])
+        self.assertEqual(frames[-1]['message'], "Hello")
+        print("✓ WebSocket streamed a reply")
+
+    async def test_cancel_stops_generation(self):
+        """Test a cancel frame aborts the generation in progress"""
+        service = SlowStreamService(["tok"] * 100, delay=0.05)
+        async with SocketHarness(service) as ws:
+            await ws.receive_until('session')
+            await ws.send({'type': 'message', 'message': 'Long answer please'})
+            await ws.receive_until('token')
+            await ws.send({'type': 'cancel'})
+            frames = await ws.receive_until('cancelled')
+
+        self.assertTrue(service.cancelled)
+        self.assertNotIn('done', [frame['type'] for frame in frames])
+        print("✓ WebSocket cancel stopped the generation")
+
+    async def test_disconnect_cancels_generation(self):
+        """Test closing the socket aborts the generation in progress"""
+        service = SlowStreamService(["tok"] * 100, delay=0.05)
+        async with SocketHarness(service) as ws:
+            await ws.receive_until('session')
+            await ws.send({'type': 'message', 'message': 'Long answer please'})
+            await ws.receive_until('token')
+
+        self.assertTrue(service.cancelled)
+        print("✓ WebSocket disconnect stopped the generation")
+
+    @override_settings(CHAT_WEBSOCKET={'HEARTBEAT_INTERVAL': 0.05})
+    async def test_heartbeat_pings(self):
+        """Test the server pings an idle connection"""
+        async with SocketHarness(SlowStreamService([])) as ws:
+            await ws.receive_until('session')
+            await ws.send({'type': 'pong'})
+            self.assertEqual(await ws.receive(), {'type': 'ping'})
+        print("✓ WebSocket heartbeat sent")
+
+    @override_settings(ALLOWED_HOSTS=['example.com'])
+    async def test_foreign_origin_rejected(self):
+        """Test handshakes from other sites are refused"""
+        harness = SocketHarness(SlowStreamService([]), headers=[(b'origin', b'https://evil.test')])
+        await harness.incoming.put({'type': 'websocket.connect'})
+        await harness.socket.run()
+
+        self.assertEqual(await harness.receive(), {'type': 'websocket.close', 'code': 4403})
+        print("✓ Foreign origin rejected")
+
 
 # ============================================
 # INTEGRATION TESTS
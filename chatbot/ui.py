@@ -0,0 +1,157 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import FileResponse, Http404, HttpResponse
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import condition
+
+from .middleware import brotli, compress, preferred_encoding
+
+
+DEFAULT_UI_SETTINGS = {
+    # Render each UI page once per process, send it precompressed, and
+    # answer revalidations with 304.
+    'PAGE_CACHE': True,
+    # Cache-Control max-age, in seconds, of fingerprinted static files.
+    'ASSET_MAX_AGE': 365 * 24 * 3600,
+}
+
+
+def ui_settings():
+    return {**DEFAULT_UI_SETTINGS, **getattr(settings, 'CHAT_UI', {})}
+
+
+class Page:
+    """A rendered page with its ETag and compressed variants."""
+
+    def __init__(self, content):
+        self.content = content
+        # Weak: the compressed variants share it.
+        self.etag = f'W/"{hashlib.sha256(content).hexdigest()[:32]}"'
+        self.variants = {'gzip': compress(content, 'gzip', best=True)}
+        if brotli is not None:
+            self.variants['br'] = compress(content, 'br', best=True)
+
+    def body(self, encoding):
+        # (content, Content-Encoding or None)
+        if encoding in self.variants and len(self.variants[encoding]) < len(self.content):
+            return self.variants[encoding], encoding
+        return self.content, None
+
+
+class PageCache:
+    """Rendered pages by template name. The templates must not depend on
+    the request (no csrf_token, user or messages): everyone gets the same
+    bytes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def get(self, template_name):
+        page = self._pages.get(template_name)
+        if page is None:
+            page = Page(render_to_string(template_name).encode())
+            with self._lock:
+                self._pages[template_name] = page
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+pages = PageCache()
+
+
+@receiver(setting_changed)
+def settings_changed(*, setting, **kwargs):
+    # Rendered pages embed static URLs; drop them when those may change.
+    if setting in ('STORAGES', 'STATIC_URL', 'STATIC_ROOT', 'TEMPLATES', 'CHAT_UI'):
+        pages.clear()
+
+
+def static_page(template_name):
+    """A view serving ``template_name`` from the page cache.
+
+    Browsers revalidate on every load (the asset URLs inside change with
+    each deploy), and get a body-less 304 while the page is unchanged.
+    """
+    def etag(request):
+        if not ui_settings()['PAGE_CACHE']:
+            return None
+        return pages.get(template_name).etag
+
+    @condition(etag_func=etag)
+    def view(request):
+        if not ui_settings()['PAGE_CACHE']:
+            return render(request, template_name)
+        content, encoding = pages.get(template_name).body(preferred_encoding(request))
+        response = HttpResponse(content)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    return view
+
+
+# Names written by ManifestStaticFilesStorage: name.<12 hex digits>.ext
+_fingerprinted = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+_suffixes = {'br': '.br', 'gzip': '.gz'}
+
+
+def static_file(request, path):
+    """Serves collected static files from STATIC_ROOT when nothing in front
+    of Django does (runserver serves the app directories itself in DEBUG).
+
+    Fingerprinted names are immutable and cached for ASSET_MAX_AGE; other
+    names are revalidated by ETag. The .br/.gz siblings written by
+    chatbot.storage are sent to clients that accept them.
+    """
+    if not settings.STATIC_ROOT:
+        raise Http404
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    stat = os.stat(fullpath)
+    etag = f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        served, encoding = fullpath, preferred_encoding(request)
+        if encoding and os.path.isfile(fullpath + _suffixes[encoding]):
+            served += _suffixes[encoding]
+        else:
+            encoding = None
+        content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+        response = FileResponse(
+            open(served, 'rb'), content_type=content_type, filename=os.path.basename(fullpath)
+        )
+        if encoding:
+            response['Content-Encoding'] = encoding
+        response['Last-Modified'] = http_date(stat.st_mtime)
+
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if _fingerprinted.search(path):
+        patch_cache_control(response, public=True, max_age=ui_settings()['ASSET_MAX_AGE'], immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
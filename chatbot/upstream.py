@@ -0,0 +1,317 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+
+DEFAULT_UPSTREAM_SETTINGS = {
+    'RPM': None,
+    'TPM': None,
+    'BURST_SECONDS': 5,
+    # Callers that would wait longer than this for the RPM/TPM budget get
+    # UpstreamBusy (a 503) instead. None waits however long it takes.
+    'MAX_WAIT': 30.0,
+    'BACKEND': None,
+    'COMPLETION_TOKENS': 500,
+    'MAX_RETRIES': 4,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 20.0,
+    'BREAKER_THRESHOLD': 5,
+    'BREAKER_COOLDOWN': 30.0,
+}
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def upstream_settings():
+    return {**DEFAULT_UPSTREAM_SETTINGS, **getattr(settings, 'CHAT_UPSTREAM', {})}
+
+
+class UpstreamBusy(Exception):
+    """The upstream is rate limiting or failing; try again after ``retry_after`` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills at ``per_minute / 60`` per second up to ``BURST_SECONDS`` worth.
+
+    ``reserve`` takes the amount and returns how long the caller must wait
+    before spending it, so waiters queue up in arrival order instead of
+    polling, and sustained throughput converges on the configured rate. A
+    wait over ``max_wait`` raises UpstreamBusy and takes nothing.
+    """
+
+    def __init__(self, per_minute, burst_seconds):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount, max_wait=None):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (amount - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                raise UpstreamBusy("Upstream rate limit backlog is full", wait)
+            self.tokens -= amount
+            return wait
+
+    def settle(self, amount):
+        # Corrects an earlier reservation once the real cost is known.
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class CacheWindow:
+    """Per-minute counters in a shared Django cache, for limits across processes.
+
+    A caller over the current minute's limit reserves a slot in the first
+    later minute with room, and waits until its place in that minute: the
+    n-th reservation there starts ``n / limit`` of the way through it. Waiters
+    are spread at the limit's pace instead of all firing at the boundary.
+    """
+
+    def __init__(self, name, per_minute, alias):
+        self.name = name
+        self.limit = per_minute
+        self.alias = alias
+
+    def _key(self, minute):
+        return f'chatbot:ratelimit:{self.name}:{minute}'
+
+    def reserve(self, amount, max_wait=None):
+        backend = caches[self.alias]
+        now = time.time()
+        minute = int(now // 60)
+        while True:
+            key = self._key(minute)
+            backend.add(key, 0, int(minute * 60 - now) + 120)
+            total = backend.incr(key, amount)
+            # Room left, or an empty minute for a reservation over the limit.
+            if total <= self.limit or total == amount:
+                if minute * 60 <= now:
+                    return 0.0
+                wait = minute * 60 - now + (total - amount) / self.limit * 60
+                if max_wait is None or wait <= max_wait:
+                    return wait
+                backend.decr(key, amount)
+                raise UpstreamBusy("Upstream rate limit backlog is full", wait)
+            backend.decr(key, amount)
+            minute += 1
+            if max_wait is not None and minute * 60 - now > max_wait:
+                raise UpstreamBusy("Upstream rate limit backlog is full", minute * 60 - now)
+
+    def settle(self, amount):
+        backend = caches[self.alias]
+        key = self._key(int(time.time() // 60))
+        try:
+            backend.incr(key, amount)
+        except ValueError:
+            pass
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive upstream failures.
+
+    While open, calls fail fast for ``cooldown`` seconds; then one trial
+    call is let through and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def before_call(self, config):
+        # True when this caller makes the trial call.
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + config['BREAKER_COOLDOWN'] - time.monotonic()
+            if remaining > 0 or self.trial:
+                raise UpstreamBusy("Upstream circuit breaker is open", max(remaining, 1.0))
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def abandon_trial(self):
+        # The trial call ended without telling whether the upstream is back
+        # (a 4xx, a cancel): the next call becomes the trial instead.
+        with self._lock:
+            self.trial = False
+
+    def record_failure(self, config):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= config['BREAKER_THRESHOLD']:
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt, error, config):
+    # Full jitter, but never sooner than the upstream asked for.
+    delay = random.uniform(0, min(config['BACKOFF_MAX'], config['BACKOFF_BASE'] * 2 ** attempt))
+    hint = retry_after(error)
+    return max(delay, hint) if hint is not None else delay
+
+
+def estimate_tokens(messages, config):
+    # Same estimate the provider's limiter uses: ~4 characters per token
+    # for the prompt plus the completion allowance.
+    return sum(len(message['content']) for message in messages) // 4 + config['COMPLETION_TOKENS']
+
+
+class UpstreamScheduler:
+    """Paces, retries and guards calls to the chat completions API.
+
+    Requests-per-minute and tokens-per-minute buckets are shared by every
+    thread (or, with ``BACKEND``, every process through that cache). Rate
+    limits, timeouts, connection errors and 5xx responses are retried with
+    jittered exponential backoff that honours Retry-After, and feed a
+    circuit breaker. When retries run out, or a caller would wait longer than
+    ``MAX_WAIT`` for the budget, ``UpstreamBusy`` is raised.
+
+    ``overrides`` replace ``CHAT_UPSTREAM`` keys for this scheduler only, and
+    ``name`` keeps its shared counters apart from other schedulers'.
+    """
+
+    def __init__(self, name='default', overrides=None):
+        self.name = name
+        self.overrides = overrides or {}
+        self._lock = threading.Lock()
+        self._limits = None
+        self.breaker = CircuitBreaker()
+
+    def settings(self):
+        return {**upstream_settings(), **self.overrides}
+
+    def limits(self, config):
+        key = (config['RPM'], config['TPM'], config['BURST_SECONDS'], config['BACKEND'])
+        with self._lock:
+            if self._limits is None or self._limits[0] != key:
+                self._limits = key, self._bucket('rpm', config['RPM'], config), \
+                    self._bucket('tpm', config['TPM'], config)
+            return self._limits[1:]
+
+    def _bucket(self, name, per_minute, config):
+        if not per_minute:
+            return None
+        if config['BACKEND']:
+            return CacheWindow(f'{self.name}:{name}', per_minute, config['BACKEND'])
+        return TokenBucket(per_minute, config['BURST_SECONDS'])
+
+    def _admit(self, messages, config):
+        # Returns (seconds to wait, reserved tokens).
+        rpm, tpm = self.limits(config)
+        tokens = estimate_tokens(messages, config)
+        wait = rpm.reserve(1, config['MAX_WAIT']) if rpm else 0.0
+        if tpm:
+            try:
+                wait = max(wait, tpm.reserve(tokens, config['MAX_WAIT']))
+            except UpstreamBusy:
+                if rpm:
+                    rpm.settle(-1)
+                raise
+        return wait, tokens
+
+    def _settle(self, response, tokens, config):
+        usage = getattr(response, 'usage', None)
+        total = getattr(usage, 'total_tokens', None)
+        _, tpm = self.limits(config)
+        if tpm and isinstance(total, int):
+            tpm.settle(total - tokens)
+
+    def _failed(self, attempt, error, config):
+        self.breaker.record_failure(config)
+        delay = backoff(attempt, error, config)
+        if attempt >= config['MAX_RETRIES']:
+            raise UpstreamBusy(f"Upstream unavailable: {error}", delay) from error
+        return delay
+
+    def call(self, fn, messages):
+        config = self.settings()
+        for attempt in range(config['MAX_RETRIES'] + 1):
+            trial = self.breaker.before_call(config)
+            try:
+                # Pacing is inside: a caller cancelled while it waits must
+                # still give up the trial.
+                wait, tokens = self._admit(messages, config)
+                if wait:
+                    time.sleep(wait)
+                response = fn()
+            except RETRYABLE_ERRORS as e:
+                time.sleep(self._failed(attempt, e, config))
+                continue
+            except BaseException:
+                if trial:
+                    self.breaker.abandon_trial()
+                raise
+            self.breaker.record_success()
+            self._settle(response, tokens, config)
+            return response
+
+    async def acall(self, fn, messages):
+        config = self.settings()
+        for attempt in range(config['MAX_RETRIES'] + 1):
+            trial = self.breaker.before_call(config)
+            try:
+                wait, tokens = self._admit(messages, config)
+                if wait:
+                    await asyncio.sleep(wait)
+                response = await fn()
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(self._failed(attempt, e, config))
+                continue
+            except BaseException:
+                if trial:
+                    self.breaker.abandon_trial()
+                raise
+            self.breaker.record_success()
+            self._settle(response, tokens, config)
+            return response
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ChatView, ConversationViewSet, chatbot_ui,chat_ui
+from .views import ChatView, AsyncChatView, BatchChatView, CancelChatView, ChatJobView, ConversationViewSet, SearchView, chatbot_ui,chat_ui, metrics_view
 
 router = DefaultRouter()
 router.register(r"conversations", ConversationViewSet, basename="conversation")
@@ -9,5 +9,11 @@ urlpatterns = [
     path("chat/", chatbot_ui, name="chatbot-ui"),
     path("studio/", chat_ui, name="chat-ui"),
     path("api/chat/", ChatView.as_view(), name="chat-api"),
+    path("api/chat/async/", AsyncChatView.as_view(), name="chat-async-api"),
+    path("api/chat/batch/", BatchChatView.as_view(), name="chat-batch"),
+    path("api/chat/cancel/", CancelChatView.as_view(), name="chat-cancel"),
+    path("api/chat/jobs/<uuid:pk>/", ChatJobView.as_view(), name="chat-job"),
+    path("api/search/", SearchView.as_view(), name="chat-search"),
     path("api/", include(router.urls)),
+    path("metrics", metrics_view, name="metrics"),
 ]
@@ -1,44 +1,364 @@
-from django.shortcuts import render
+import json
+import math
+
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views import View
 
 # Create your views here.
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework import status, viewsets
-from .serializers import ChatRequestSerializer, ConversationSerializer
-from .services import ChatbotService
-from .models import Conversation
-from django.shortcuts import render
+from rest_framework.decorators import action
+from .pagination import ConversationCursorPagination, MessageKeysetPagination, RankedPagination
+from .serializers import (
+    CancelRequestSerializer, ChatJobSerializer, ChatRequestSerializer, ConversationSerializer,
+    ConversationSummarySerializer, MessageSerializer, SearchHitSerializer, SearchQuerySerializer
+)
+from .services import ChatbotService, AsyncChatbotService
+from .jobs import submit
+from .cancellation import cancellation_settings, generations
+from .metrics import instrument, metrics, metrics_settings, stage
+from .quotas import QuotaExceeded, request_account
+from .batch import output_path, run_batch
+from .renderers import FastJsonResponse
+from .retention import restore
+from .rows import MESSAGE_ROWS, SUMMARY_ROWS, conversation_data, serialization_settings
+from .search import search_backend
+from .ui import static_page
+from .models import ChatJob, Conversation, Message
+from asgiref.sync import sync_to_async
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+import uuid
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 
 
-def chatbot_ui(request):
-    return render(request, "chatbot.html")
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_stream(events):
+    # Close the service generator explicitly when the server closes the
+    # response (client disconnect) so the upstream stream is released.
+    try:
+        for event, data in events:
+            yield sse_event(event, data)
+    finally:
+        events.close()
+
+
+async def async_sse_stream(events):
+    try:
+        async for event, data in events:
+            yield sse_event(event, data)
+    finally:
+        await events.aclose()
+
+
+def ndjson_stream(results):
+    # Closing the response stops the batch from starting new records.
+    try:
+        for result in results:
+            yield json.dumps(result) + '\n'
+    finally:
+        results.close()
+
+
+def event_stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def error_response(result, response_class):
+    # Upstream throttling is the client's cue to back off, not a server fault.
+    if 'retry_after' not in result:
+        return response_class(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    response = response_class(result, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(math.ceil(result['retry_after']))
+    return response
+
+
+def quota_response(error, response_class):
+    # 429: the client's own usage, unlike the upstream's 503 above.
+    response = response_class(
+        {'error': str(error), 'retry_after': error.retry_after},
+        status=status.HTTP_429_TOO_MANY_REQUESTS
+    )
+    response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
+def job_accepted(request, job, response_class):
+    # 202 with the job; poll the Location (or wait for the webhook).
+    data = ChatJobSerializer(job).data
+    response = response_class(data, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = request.build_absolute_uri(reverse('chat-job', args=[job.pk]))
+    return response
+
+
+def metrics_view(request):
+    # Prometheus scrape target.
+    if not metrics_settings()['ENABLED']:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Rendered once per process; see chatbot/ui.py.
+chatbot_ui = static_page("chatbot.html")
+chat_ui = static_page("chatwindow.html")
 
-def chat_ui(request):
-    return render(request, "chatwindow.html")
 
 @method_decorator(csrf_exempt, name='dispatch')
 class ChatView(APIView):
+    @instrument('chat')
     def post(self, request):
-        serializer = ChatRequestSerializer(data=request.data)
+        with stage('validation'):
+            serializer = ChatRequestSerializer(data=request.data)
+            valid = serializer.is_valid()
 
-        if serializer.is_valid():
+        if valid:
             message = serializer.validated_data['message']
             session_id = serializer.validated_data.get('session_id')
 
-            chatbot = ChatbotService()
-            result = chatbot.chat(message, session_id)
+            use_cache = serializer.validated_data['cache']
+
+            # Before any database or upstream work.
+            account = request_account(request, request.user, session_id)
+            try:
+                with stage('quota'):
+                    account.check()
+            except QuotaExceeded as e:
+                return quota_response(e, Response)
+
+            if serializer.validated_data['background']:
+                job = submit(
+                    message, session_id, use_cache, serializer.validated_data['webhook_url'],
+                    account=account
+                )
+                return job_accepted(request, job, Response)
+
+            chatbot = ChatbotService(account=account)
+
+            if serializer.validated_data['stream']:
+                events = chatbot.stream_chat(message, session_id, use_cache)
+                return event_stream_response(sse_stream(events))
+
+            result = chatbot.chat(message, session_id, use_cache)
 
             if 'error' in result:
-                return Response(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                return error_response(result, Response)
 
             return Response(result, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(View):
+    # Native async variant of ChatView for ASGI deployments. DRF views are
+    # sync-only, so this one parses and validates the request by hand.
+    @instrument('chat_async')
+    async def post(self, request):
+        with stage('validation'):
+            try:
+                data = json.loads(request.body or b'{}')
+            except ValueError:
+                return FastJsonResponse({'detail': 'Invalid JSON.'}, status=status.HTTP_400_BAD_REQUEST)
+
+            serializer = ChatRequestSerializer(data=data)
+            valid = serializer.is_valid()
+
+        if not valid:
+            return FastJsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        message = serializer.validated_data['message']
+        session_id = serializer.validated_data.get('session_id')
+
+        use_cache = serializer.validated_data['cache']
+
+        account = request_account(request, await request.auser(), session_id)
+        try:
+            with stage('quota'):
+                await account.acheck()
+        except QuotaExceeded as e:
+            return quota_response(e, FastJsonResponse)
+
+        if serializer.validated_data['background']:
+            job = await sync_to_async(submit)(
+                message, session_id, use_cache, serializer.validated_data['webhook_url'],
+                account=account
+            )
+            return job_accepted(request, job, FastJsonResponse)
+
+        chatbot = AsyncChatbotService(account=account)
+
+        if serializer.validated_data['stream']:
+            events = chatbot.stream_chat(message, session_id, use_cache)
+            return event_stream_response(async_sse_stream(events))
+
+        result = await chatbot.chat(message, session_id, use_cache)
+
+        if 'error' in result:
+            return error_response(result, FastJsonResponse)
+
+        return FastJsonResponse(result, status=status.HTTP_200_OK)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchChatView(APIView):
+    # Answers a JSONL upload (multipart "file", or the raw request body) and
+    # streams one result line per record. Reposting the same input with
+    # ?batch_id= set to the X-Batch-Id of an interrupted run resumes it.
+    def post(self, request):
+        batch_id = request.query_params.get('batch_id') or str(uuid.uuid4())
+        try:
+            batch_id = str(uuid.UUID(batch_id))
+        except ValueError:
+            return Response({'batch_id': 'Must be a UUID.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Checked here to turn away a client already over quota, then again
+        # before each record (see BatchRunner).
+        account = request_account(request, request.user)
+        try:
+            account.check()
+        except QuotaExceeded as e:
+            return quota_response(e, Response)
+
+        if request.content_type.startswith('multipart/'):
+            lines = request.FILES.get('file')
+            if lines is None:
+                return Response({'file': 'This field is required.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        else:
+            lines = request.body.splitlines()
+
+        use_cache = request.query_params.get('cache', 'true').lower() != 'false'
+        results = run_batch(
+            lines, output_path(batch_id), use_cache=use_cache, service=ChatbotService(account=account)
+        )
+        response = StreamingHttpResponse(ndjson_stream(results), content_type='application/x-ndjson')
+        response['X-Batch-Id'] = batch_id
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CancelChatView(APIView):
+    # Stops the reply being generated for a session, whichever connection
+    # (HTTP, SSE or WebSocket) it is streaming to. The generation ends with
+    # a 'cancelled' event or result and keeps its partial reply.
+    def post(self, request):
+        serializer = CancelRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        session_id = serializer.validated_data['session_id']
+        stopped = generations.cancel(session_id)
+        data = {'session_id': session_id, 'cancelled': stopped}
+        # Without a shared BACKEND nothing else can be running it.
+        if not stopped and not cancellation_settings()['BACKEND']:
+            return Response(data, status=status.HTTP_404_NOT_FOUND)
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+
+class ChatJobView(APIView):
+    def get(self, request, pk):
+        job = get_object_or_404(ChatJob, pk=pk)
+        return Response(ChatJobSerializer(job).data)
+
+
+class SearchView(APIView):
+    # Full-text search over every conversation's messages, best match
+    # first; see chatbot/search.py for the backends.
+    def get(self, request):
+        serializer = SearchQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        query = serializer.validated_data
+        backend = search_backend()
+        paginator = RankedPagination()
+        hits = paginator.paginate_queryset(
+            lambda offset, limit: backend.search(
+                query['q'], offset, limit, query.get('session_id'), query.get('role')
+            ),
+            request, view=self,
+        )
+        return paginator.get_paginated_response(SearchHitSerializer(hits, many=True).data)
+
+
+def message_stats(field):
+    # Correlated subquery, evaluated only for the conversations on the page.
+    return Subquery(
+        Message.objects.filter(conversation=OuterRef('pk'))
+        .order_by()
+        .values('conversation')
+        .annotate(value=field)
+        .values('value')
+    )
+
+
 class ConversationViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Conversation.objects.all()
     serializer_class = ConversationSerializer
-    lookup_field = 'session_id'
\ No newline at end of file
+    pagination_class = ConversationCursorPagination
+    lookup_field = 'session_id'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            return queryset.annotate(
+                message_count=Coalesce(message_stats(Count('pk')), 0),
+                last_message_at=message_stats(Max('timestamp')),
+            )
+        if self.action == 'retrieve' and not self.fast():
+            return queryset.prefetch_related('messages')
+        return queryset
+
+    def fast(self):
+        # .values() rows and RowMapper instead of the serializers.
+        return serialization_settings()['FAST']
+
+    def list(self, request, *args, **kwargs):
+        if not self.fast():
+            return super().list(request, *args, **kwargs)
+        rows = self.filter_queryset(self.get_queryset()).values(*SUMMARY_ROWS.columns)
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response(SUMMARY_ROWS.many(rows))
+        return self.get_paginated_response(SUMMARY_ROWS.many(page))
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.fast():
+            return super().retrieve(request, *args, **kwargs)
+        return Response(conversation_data(self.get_object()))
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            # An archived session is restored on first access.
+            if restore(self.kwargs[self.lookup_field]) is None:
+                raise
+            return super().get_object()
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ConversationSummarySerializer
+        return super().get_serializer_class()
+
+    @action(detail=True, methods=['get'])
+    def messages(self, request, session_id=None):
+        conversation = self.get_object()
+        paginator = MessageKeysetPagination()
+        if self.fast():
+            rows = conversation.messages.values(*MESSAGE_ROWS.columns)
+            page = paginator.paginate_queryset(rows, request, view=self)
+            return paginator.get_paginated_response(MESSAGE_ROWS.many(page))
+        page = paginator.paginate_queryset(conversation.messages.all(), request, view=self)
+        return paginator.get_paginated_response(MessageSerializer(page, many=True).data)
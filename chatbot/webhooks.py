@@ -0,0 +1,83 @@
+import hashlib
+import hmac
+import ipaddress
+import socket
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.http.request import validate_host
+
+
+DEFAULT_WEBHOOK_SETTINGS = {
+    # Shared with receivers. Every webhook POST carries X-Webhook-Timestamp
+    # and X-Webhook-Signature: "sha256=" and the hex HMAC-SHA256 of
+    # "<timestamp>.<body>" under this secret. Webhooks are refused while it
+    # is unset.
+    'SECRET': None,
+    # Hosts webhooks may be sent to, matched as ALLOWED_HOSTS is
+    # ('.example.com' covers its subdomains). Empty allows any host whose
+    # addresses are all public: never loopback, private, link-local (cloud
+    # metadata) or reserved ones.
+    'ALLOWED_HOSTS': [],
+}
+
+
+def webhook_settings():
+    return {**DEFAULT_WEBHOOK_SETTINGS, **getattr(settings, 'CHAT_WEBHOOKS', {})}
+
+
+class WebhookRefused(ValueError):
+    """A webhook URL this server will not call."""
+
+
+def public(address):
+    # Drops an IPv6 zone ("fe80::1%eth0").
+    return ipaddress.ip_address(address.split('%')[0]).is_global
+
+
+def check_url(url, resolve=True):
+    """Raise WebhookRefused unless ``url`` may receive job results.
+
+    Without an allowlist the host's addresses must all be public. With
+    ``resolve=False`` only a literal IP is checked, for request validation
+    that must not wait on DNS; delivery checks again with ``resolve``, as
+    the name may point elsewhere by then.
+    """
+    config = webhook_settings()
+    if not config['SECRET']:
+        raise WebhookRefused("Webhooks are not enabled on this server.")
+    parts = urlsplit(url)
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError:
+        raise WebhookRefused("Webhook URL has an invalid port.") from None
+    host = parts.hostname
+    if parts.scheme not in ('http', 'https') or not host:
+        raise WebhookRefused("Webhook URLs must be http or https URLs.")
+
+    if config['ALLOWED_HOSTS']:
+        if not validate_host(host, config['ALLOWED_HOSTS']):
+            raise WebhookRefused(f"Webhook host {host} is not allowed.")
+        return
+    try:
+        ipaddress.ip_address(host)
+        addresses = [host]
+    except ValueError:
+        if not resolve:
+            return
+        try:
+            addresses = [info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)]
+        except (OSError, UnicodeError):
+            raise WebhookRefused(f"Webhook host {host} does not resolve.") from None
+    if not all(public(address) for address in addresses):
+        raise WebhookRefused(f"Webhook host {host} is not a public address.")
+
+
+def signature_headers(body, timestamp=None):
+    """The headers that let a receiver check a webhook ``body`` came from us."""
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    digest = hmac.new(
+        webhook_settings()['SECRET'].encode(), timestamp.encode() + b'.' + body, hashlib.sha256
+    ).hexdigest()
+    return {'X-Webhook-Timestamp': timestamp, 'X-Webhook-Signature': f'sha256={digest}'}
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import aget_user
+from django.db import close_old_connections
+from django.http.cookie import parse_cookie
+from django.http.request import validate_host
+from django.utils.module_loading import import_string
+
+from .quotas import QuotaExceeded, scope_account
+from .serializers import ChatRequestSerializer
+from .services import AsyncChatbotService
+
+
+logger = logging.getLogger(__name__)
+
+CHAT_SOCKET_PATH = '/ws/chat/'
+
+DEFAULT_WEBSOCKET_SETTINGS = {
+    # Seconds between server pings; a client silent for two intervals is
+    # dropped.
+    'HEARTBEAT_INTERVAL': 20,
+    'MAX_MESSAGE_BYTES': 64 * 1024,
+}
+
+
+def websocket_settings():
+    return {**DEFAULT_WEBSOCKET_SETTINGS, **getattr(settings, 'CHAT_WEBSOCKET', {})}
+
+
+def allowed_origin(scope):
+    # Browsers send Origin on WebSocket handshakes but no CSRF token, so the
+    # origin's host is held to ALLOWED_HOSTS like a request's Host header.
+    headers = dict(scope.get('headers', []))
+    origin = headers.get(b'origin')
+    if origin is None:
+        return True
+    allowed = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed:
+        allowed = ['.localhost', '127.0.0.1', '[::1]']
+    return validate_host(urlsplit(origin.decode('latin-1')).netloc, allowed)
+
+
+class ScopeSession:
+    # Just enough of an HttpRequest for aget_user(): the session named by
+    # the connection's session cookie.
+    def __init__(self, scope):
+        cookies = parse_cookie(dict(scope.get('headers', [])).get(b'cookie', b'').decode('latin-1'))
+        store = import_string(f'{settings.SESSION_ENGINE}.SessionStore')
+        self.session = store(cookies.get(settings.SESSION_COOKIE_NAME))
+
+
+class ChatSocket:
+    """One WebSocket connection carrying one chat session.
+
+    Client frames are JSON objects: ``{"type": "message", "message": ...,
+    "cache": true}`` starts a generation, ``{"type": "cancel"}`` stops the
+    current one, and ``{"type": "pong"}`` answers a heartbeat. The server
+    sends ``session`` once on connect, then ``token``/``done``/``error``
+    frames shaped like the SSE events of ``/api/chat/``, ``cancelled`` after
+    a cancel, and a ``ping`` every ``HEARTBEAT_INTERVAL`` seconds. One
+    generation runs at a time; cancelling it (here, through
+    ``/api/chat/cancel/``, or by disconnecting) closes the upstream stream
+    and saves the partial reply marked as interrupted.
+    """
+
+    def __init__(self, scope, receive, send, service=None):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.config = websocket_settings()
+        query = parse_qs(scope.get('query_string', b'').decode())
+        self.session_id = query.get('session_id', [None])[0] or str(uuid.uuid4())
+        self.account = scope_account(scope, self.session_id)
+        self.service = service or AsyncChatbotService(account=self.account)
+        self.generation = None
+        self.last_seen = time.monotonic()
+        self.closed = False
+
+    async def send_json(self, payload):
+        if not self.closed:
+            await self.send({'type': 'websocket.send', 'text': json.dumps(payload)})
+
+    async def close(self, code=1000):
+        if not self.closed:
+            await self.send({'type': 'websocket.close', 'code': code})
+            self.closed = True
+
+    async def run(self):
+        event = await self.receive()
+        if event['type'] != 'websocket.connect':
+            return
+        if not allowed_origin(self.scope):
+            await self.send({'type': 'websocket.close', 'code': 4403})
+            return
+        await self.send({'type': 'websocket.accept'})
+        await self.send_json({'type': 'session', 'session_id': self.session_id})
+
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            while True:
+                event = await self.receive()
+                if event['type'] == 'websocket.disconnect':
+                    self.closed = True
+                    break
+                self.last_seen = time.monotonic()
+                await self.dispatch(event.get('text') or event.get('bytes') or '')
+        finally:
+            heartbeat.cancel()
+            await self.cancel()
+
+    async def dispatch(self, raw):
+        if len(raw) > self.config['MAX_MESSAGE_BYTES']:
+            await self.send_json({'type': 'error', 'error': 'Frame too large.'})
+            return
+        try:
+            frame = json.loads(raw)
+            kind = frame.get('type')
+        except (ValueError, AttributeError):
+            await self.send_json({'type': 'error', 'error': 'Frames must be JSON objects.'})
+            return
+
+        if kind == 'message':
+            await self.start(frame)
+        elif kind == 'cancel':
+            if await self.cancel():
+                await self.send_json({'type': 'cancelled', 'session_id': self.session_id})
+        elif kind == 'ping':
+            await self.send_json({'type': 'pong'})
+        elif kind != 'pong':
+            await self.send_json({'type': 'error', 'error': f'Unknown frame type: {kind}'})
+
+    async def start(self, frame):
+        if self.generation is not None and not self.generation.done():
+            await self.send_json({'type': 'error', 'error': 'A reply is already being generated.'})
+            return
+        serializer = ChatRequestSerializer(data={
+            'message': frame.get('message'), 'cache': frame.get('cache', True)
+        })
+        if not serializer.is_valid():
+            await self.send_json({'type': 'error', 'error': serializer.errors})
+            return
+        try:
+            await self.account.acheck()
+        except QuotaExceeded as e:
+            await self.send_json({'type': 'error', 'error': str(e), 'retry_after': e.retry_after})
+            return
+        self.generation = asyncio.create_task(self.generate(
+            serializer.validated_data['message'], serializer.validated_data['cache']
+        ))
+        self.generation.add_done_callback(self.finished)
+
+    def finished(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Chat generation failed", exc_info=task.exception())
+
+    async def generate(self, message, use_cache):
+        events = self.service.stream_chat(message, self.session_id, use_cache)
+        try:
+            async for event, data in events:
+                await self.send_json({'type': event, **data})
+        finally:
+            await events.aclose()
+            await sync_to_async(close_old_connections)()
+
+    async def cancel(self):
+        # Cancelling the task raises CancelledError inside stream_chat, which
+        # closes the upstream stream and saves the partial reply.
+        task, self.generation = self.generation, None
+        if task is None or task.done():
+            return False
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Already logged by finished().
+            pass
+        return True
+
+    async def heartbeat(self):
+        interval = self.config['HEARTBEAT_INTERVAL']
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_seen > 2 * interval:
+                await self.cancel()
+                await self.close(1001)
+                return
+            await self.send_json({'type': 'ping'})
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI app for WebSocket connections; see OpenAiChatbot/asgi.py."""
+    if scope['path'] != CHAT_SOCKET_PATH:
+        await receive()
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    if 'user' not in scope:
+        # What AuthenticationMiddleware does for requests, unless an outer
+        # auth middleware stack already set it: usage of a logged-in
+        # browser counts against its user.
+        scope = {**scope, 'user': await aget_user(ScopeSession(scope))}
+    await ChatSocket(scope, receive, send).run()